@@ -2,25 +2,29 @@
 
 # astroPhoto_stage1.bash
 
-if [ $# != 4 ] ; then
+if ( [ $# != 4 ] && [ $# != 5 ] ) || ( [ $# == 5 ] && [ "$5" != "single-pass" ] ) ; then
     echo "bash astroPhoto_stage1.bash"
     echo "    \$1 : Light frame dir"
     echo "    \$2 : Dark frame of the light frame dir"
     echo "    \$3 : Flat frame dir"
     echo "    \$4 : Dark frame of the flat frame dir"
+    echo "    \$5 : (optional) single-pass"
+    echo "         Skip the dark subtraction of the light frames (no ./l_drk_subt)."
+    echo "         Pass the master dark to astroPhoto_stage3.bash instead."
     exit
 else
     d_light=$1
     d_dark_of_light=$2
     d_flat=$3
     d_dark_of_flat=$4
+    single_pass=$5
 fi
 
 PYTHON="python3"
 d_script_home=$(cd $(dirname $0) && pwd)
 tools_dir="${d_script_home}/scripts"
 tool_composite_smpl="${tools_dir}/composite_simple.py"
-tool_subtract="subtract.py"
+tool_subtract="${tools_dir}/subtract.py"
 
 f_dark_of_light="drk_light_16bit.tif"
 f_dark_of_flat="drk_flat_16bit.tif"
@@ -39,7 +43,7 @@ if [ -e $f_flat ] ; then
     rm -f $f_flat
 fi
 ### Check directories
-if [ ! -e $d_light_subtract ] ; then
+if [ -z "$single_pass" ] && [ ! -e $d_light_subtract ] ; then
     mkdir $d_light_subtract
 fi
 if [ ! -e $d_flat_subtract ] ; then
@@ -81,7 +85,7 @@ fi
 
 ### Subtract the dark frame from flat frames
 status=0
-if [ "$d_dark_of_light" != "NONE" ] ; then
+if [ "$d_dark_of_flat" != "NONE" ] ; then
     $PYTHON $tool_subtract $d_flat $f_dark_of_flat $d_flat_subtract
     status=$?
 fi
@@ -90,9 +94,9 @@ if [ "$status" != 0 ] ; then
     exit
 fi
 
-### Subtract the dark frame from light frames
+### Subtract the dark frame from light frames (single-pass : done by calibrate.py in stage3)
 status=0
-if [ "$d_dark_of_light" != "NONE" ] ; then
+if [ "$d_dark_of_light" != "NONE" ] && [ -z "$single_pass" ] ; then
     $PYTHON $tool_subtract $d_light $f_dark_of_light $d_light_subtract
     status=$?
 fi
@@ -2,12 +2,15 @@
 
 # astroPhoto_stage2.bash
 
-if [ $# != 1 ] ; then
+if [ $# != 1 ] && [ $# != 2 ] ; then
     echo "bash astroPhoto_stage2.bash"
     echo "    \$1 : Flat rgb image"
+    echo "    \$2 : (optional) Percentile used as the peak value of each channel."
+    echo "         If given, all channels are made at once without the GUI."
     exit
 else
     f_flat=$1
+    percentile=$2
 fi
 
 PYTHON="python3"
@@ -15,6 +18,12 @@ d_script_home=$(cd $(dirname $0) && pwd)
 tools_dir="${d_script_home}/scripts"
 tool_mkflat="${tools_dir}/mkVignetRawImage.py"
 
+if [ -n "$percentile" ] ; then
+    echo "*** BEGIN :: All Channels (batch)"
+    $PYTHON $tool_mkflat $f_flat --batch --percentile $percentile
+    exit
+fi
+
 f_flat_r=$(echo $f_flat | sed 's/\.tif/_r.tif/g')
 f_flat_g=$(echo $f_flat | sed 's/\.tif/_g.tif/g')
 f_flat_b=$(echo $f_flat | sed 's/\.tif/_b.tif/g')
@@ -2,24 +2,29 @@
 
 # astroPhoto_stage3.bash
 
-if [ $# != 4 ] ; then
+if [ $# != 4 ] && [ $# != 5 ] ; then
     echo "bash astroPhoto_stage3.bash"
     echo "    \$1 : Light frame dir"
     echo "    \$2 : Flat frame of red channel"
     echo "    \$3 : Flat frame of gleen channel"
     echo "    \$4 : Flat frame of blue channel"
+    echo "    \$5 : (optional) Dark frame of the light frames"
+    echo "         If given, \$1 is the raw light frame dir and dark subtraction"
+    echo "         and flat correction are done in a single pass."
     exit
 else
     d_light=$1
     f_flat_r=$2
     f_flat_g=$3
     f_flat_b=$4
+    f_dark_of_light=$5
 fi
 
 PYTHON="python3"
 d_script_home=$(cd $(dirname $0) && pwd)
 tools_dir="${d_script_home}/scripts"
 tool_composite_smpl="${tools_dir}/flat_correction.py"
+tool_calibrate="${tools_dir}/calibrate.py"
 d_flat_corr="l_flat_corr"
 
 ### Check directopries
@@ -27,4 +32,8 @@ if [ ! -e $d_flat_corr ] ; then
     mkdir $d_flat_corr
 fi
 
-$PYTHON $tool_composite_smpl --flat_r $f_flat_r --flat_g $f_flat_g --flat_b $f_flat_b $d_light $d_flat_corr
+if [ -n "$f_dark_of_light" ] ; then
+    $PYTHON $tool_calibrate --dark $f_dark_of_light --flat_r $f_flat_r --flat_g $f_flat_g --flat_b $f_flat_b $d_light $d_flat_corr
+else
+    $PYTHON $tool_composite_smpl --flat_r $f_flat_r --flat_g $f_flat_g --flat_b $f_flat_b $d_light $d_flat_corr
+fi
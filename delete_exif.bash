@@ -16,26 +16,11 @@ if [ ! -e "$indir" ] ; then
     echo "abort."
     exit
 fi
-if [ ! -e "$outdir" ] ; then
-    mkdir $outdir
-fi
-
-### Set directories
-fullpath_indir=$(cd $indir && pwd)
-fullpath_outdir=$(cd $outdir && pwd)
-d_org=$(pwd)
-
-cd $outdir
-
-for file in $(ls -1 $fullpath_indir) ; do
-    
-    cp $fullpath_indir/$file .
-    exiftool -Orientation= -n $file
-    status=$?
-    echo "status = $status"
-    echo ""
 
-done
+PYTHON="python3"
+d_script_home=$(cd $(dirname $0) && pwd)
+tools_dir="${d_script_home}/scripts"
+tool_strip="${tools_dir}/strip_orientation.py"
 
-rm -f *original*
-cd $d_org
+### Copy the files to outdir and reset the Orientation tag of the copies
+$PYTHON $tool_strip $indir -o $outdir
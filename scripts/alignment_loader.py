@@ -0,0 +1,17 @@
+#!/usr/bin/env python3
+
+import os
+import importlib.util
+
+# composite_2star-alignment.py はファイル名にハイフンを含み import 文では読めないため、パスから読み込む
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_alignment() :
+
+    spec = importlib.util.spec_from_file_location("composite_2star_alignment",
+                                                  os.path.join(TOOLS_DIR, "composite_2star-alignment.py"))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
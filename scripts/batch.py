@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import os
+import shutil
+import multiprocessing
+from glob import glob
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from multiprocessing import shared_memory
+import numpy as np
+
+# ワーカーから参照する読み取り専用の共有配列 (マスターダーク・フラットなど)
+SHARED = {}
+_attached = []
+
+
+def resolve_jobs(jobs) :
+
+    if jobs is None or jobs < 1:
+        return os.cpu_count() or 1
+    return jobs
+
+
+def map_ordered(func, items, jobs=1, max_inflight=None, initializer=None, initargs=()) :
+
+    # 入力順に (item, result, error) を返す。各ファイルの失敗はバッチを止めない
+    if jobs <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in items:
+            try:
+                yield item, func(item), None
+            except Exception as e:
+                yield item, None, e
+        return
+
+    if max_inflight is None:
+        max_inflight = 2 * jobs
+
+    # rawpy (OpenMP) は fork 後にデッドロックし得るため spawn で起動する
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=initializer, initargs=initargs) as pool:
+        pending = deque()
+        for item in items:
+            pending.append((item, pool.submit(func, item)))
+            if len(pending) >= max_inflight:
+                yield _collect(*pending.popleft())
+        while pending:
+            yield _collect(*pending.popleft())
+
+
+def _collect(item, future) :
+
+    try:
+        return item, future.result(), None
+    except Exception as e:
+        return item, None, e
+
+
+@contextmanager
+def shared_arrays(arrays, jobs=1) :
+
+    # (initializer, initargs) を返す。並列時は共有メモリに1度だけコピーし、各ワーカーはそれを参照する
+    if jobs <= 1:
+        SHARED.update(arrays)
+        try:
+            yield None, ()
+        finally:
+            for key in arrays:
+                SHARED.pop(key, None)
+        return
+
+    blocks = []
+    specs = {}
+    try:
+        for key, array in arrays.items():
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            blocks.append(shm)
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+            specs[key] = (shm.name, array.shape, array.dtype.str)
+        yield attach_shared, (specs,)
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
+
+
+def attach_shared(specs) :
+
+    for key, (name, shape, dtype) in specs.items():
+        # spawn したワーカーは親と同じ resource_tracker を使うため、解放は親の unlink に任せる
+        shm = shared_memory.SharedMemory(name=name)
+        _attached.append(shm)
+        array = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+        array.flags.writeable = False
+        SHARED[key] = array
+
+
+def list_inputs(inputs, extensions) :
+
+    # ディレクトリは直下の該当する拡張子 (大文字・小文字を区別しない) のファイル、ファイルはそのまま
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            files += sorted(p for p in glob(os.path.join(item, "*")) if p.lower().endswith(extensions))
+        else:
+            files.append(item)
+    return files
+
+
+def copy_to_output(path, output_dir=None) :
+
+    # 出力先があればコピーし、書き換える対象のパスを返す
+    if output_dir is None:
+        return path
+    out_path = os.path.join(output_dir, os.path.basename(path))
+    shutil.copyfile(path, out_path)
+    return out_path
+
+
+def modify_files(func, files, output_dir=None, jobs=0, report=str) :
+
+    # func(path, output_dir) -> (書き換えたパス, 結果) を各ファイルに適用し、失敗した数を返す
+    # 小さな書き換えで I/O 待ちが主なのでスレッドで並列化
+    if output_dir is not None and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=resolve_jobs(jobs)) as pool:
+        futures = [(path, pool.submit(func, path, output_dir)) for path in files]
+        for path, future in futures:
+            try:
+                out_path, result = future.result()
+                print(f"{os.path.basename(out_path)} : {report(result)}")
+            except Exception as e:
+                print(f"*** Failed {path}: {e}")
+                failed += 1
+    return failed
@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import resource
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+import numpy as np
+from tifffile import imread, imwrite
+
+# 合成した星野フレーム (ガウス星・既知の sub-pixel 平行移動と回転・周辺減光・ダーク) で
+# 各スクリプトの処理時間・スループット・最大メモリを計測し、基準値と比較する。
+
+TRUTH_NAME = "truth.json"
+
+
+def parse_size(text):
+    width, height = (int(v) for v in text.lower().split("x"))
+    return width, height
+
+
+def vignetting(width, height, strength):
+    y, x = np.mgrid[0:height, 0:width].astype(np.float32)
+    r2 = ((x - width / 2) ** 2 + (y - height / 2) ** 2) / ((width / 2) ** 2 + (height / 2) ** 2)
+    return np.stack([1 - s * r2 for s in strength], axis=-1)
+
+
+def render_stars(stars, matrix, width, height, sigma=1.5):
+    # stars : (x, y, flux) の基準フレーム座標。matrix (2x3) で各フレームの座標に写す
+    image = np.zeros((height, width), dtype=np.float32)
+    radius = int(np.ceil(4 * sigma))
+    positions = stars[:, :2] @ matrix[:, :2].T + matrix[:, 2]
+    for (x, y), flux in zip(positions, stars[:, 2]):
+        ix, iy = int(round(x)), int(round(y))
+        if not (radius <= ix < width - radius and radius <= iy < height - radius):
+            continue
+        dy, dx = np.mgrid[iy - radius:iy + radius + 1, ix - radius:ix + radius + 1]
+        image[iy - radius:iy + radius + 1, ix - radius:ix + radius + 1] += \
+            flux / (2 * np.pi * sigma ** 2) * np.exp(-((dx - x) ** 2 + (dy - y) ** 2) / (2 * sigma ** 2))
+    return image
+
+
+def frame_matrix(dx, dy, angle, width, height):
+    # 画像中心回りの回転 + 平行移動 (基準フレーム -> 各フレーム)
+    c, s = np.cos(np.radians(angle)), np.sin(np.radians(angle))
+    cx, cy = width / 2, height / 2
+    return np.array([[c, -s, cx - c * cx + s * cy + dx],
+                     [s, c, cy - s * cx - c * cy + dy]])
+
+
+def to_uint16(image, rng):
+    noisy = image + rng.normal(0, 1, image.shape).astype(np.float32) * np.sqrt(np.maximum(image, 1))
+    return np.clip(noisy, 0, 65535).astype(np.uint16)
+
+
+def generate_dataset(data_dir, width, height, count, n_stars=300, max_shift=20.0, max_angle=0.5, seed=0):
+    rng = np.random.default_rng(seed)
+    for sub in ["lights", "darks"]:
+        os.makedirs(os.path.join(data_dir, sub), exist_ok=True)
+
+    stars = np.stack([rng.uniform(0, width, n_stars), rng.uniform(0, height, n_stars),
+                      20000 * rng.pareto(1.5, n_stars) + 2000], axis=1)
+    vignette = vignetting(width, height, (0.45, 0.4, 0.35))
+    # ダーク : オフセット + ホットピクセル (フレーム間で共通の固定パターン)
+    dark_pattern = np.full((height, width, 3), 200.0, dtype=np.float32)
+    hot = rng.random((height, width)) < 5e-4
+    dark_pattern[hot] += rng.uniform(1000, 8000, (np.count_nonzero(hot), 1))
+
+    truth = {"width": width, "height": height, "frames": {}}
+    for i in range(count):
+        dx, dy = (0.0, 0.0) if i == 0 else tuple(rng.uniform(-max_shift, max_shift, 2))
+        angle = 0.0 if i == 0 else float(rng.uniform(-max_angle, max_angle))
+        matrix = frame_matrix(dx, dy, angle, width, height)
+        sky = (render_stars(stars, matrix, width, height) + 800.0)[..., np.newaxis] * vignette
+        name = f"light_{i:04d}.tif"
+        imwrite(os.path.join(data_dir, "lights", name), to_uint16(sky + dark_pattern, rng))
+        imwrite(os.path.join(data_dir, "darks", f"dark_{i:04d}.tif"), to_uint16(dark_pattern, rng))
+        truth["frames"][name] = {"dx": dx, "dy": dy, "angle": angle, "matrix": matrix.tolist()}
+        print(f"    Generated {name} (dx={dx:+.2f}, dy={dy:+.2f}, angle={angle:+.3f})")
+
+    imwrite(os.path.join(data_dir, "master_dark.tif"), np.round(dark_pattern).astype(np.uint16))
+    imwrite(os.path.join(data_dir, "flat.tif"), np.clip(vignette * 30000, 0, 65535).astype(np.uint16))
+    with open(os.path.join(data_dir, TRUTH_NAME), "w") as f:
+        json.dump(truth, f, indent=1)
+
+
+def light_files(data_dir):
+    return sorted(glob(os.path.join(data_dir, "lights", "*.tif")))
+
+
+### Benchmark cases : 各ケースは独立したプロセスで実行し、処理した画素数を返す
+
+def case_composite_mean(data_dir, work_dir):
+    from composite_simple import load_tiff_images_from_directory, composite_images
+    images = load_tiff_images_from_directory(os.path.join(data_dir, "lights"))
+    composite_images(images, "mean")
+    return {"frames": len(images)}
+
+
+def case_composite_sigma_clip(data_dir, work_dir):
+    from composite_simple import load_tiff_images_from_directory, composite_images
+    images = load_tiff_images_from_directory(os.path.join(data_dir, "lights"))
+    composite_images(images, "sigma-clip")
+    return {"frames": len(images)}
+
+
+def case_composite_tiled(data_dir, work_dir):
+    from composite_simple import open_tiff_frames_from_directory, composite_images_tiled
+    frames = open_tiff_frames_from_directory(os.path.join(data_dir, "lights"), work_dir)
+    composite_images_tiled(frames, "median", 256 * 1024 ** 2)
+    return {"frames": len(frames)}
+
+
+def case_subtract(data_dir, work_dir):
+    from subtract import subtract_images
+    subtract_images(os.path.join(data_dir, "lights"), os.path.join(data_dir, "master_dark.tif"), os.path.join(work_dir, "out"))
+    return {"frames": len(light_files(data_dir))}
+
+
+def case_process_images(data_dir, work_dir):
+    from flat_correction import process_images
+    flat = os.path.join(data_dir, "flat.tif")
+    process_images(os.path.join(data_dir, "lights"), os.path.join(work_dir, "out"), flat, flat, flat)
+    return {"frames": len(light_files(data_dir))}
+
+
+def case_correct_image(data_dir, work_dir):
+    from flat_correction import correct_image, normalize_flat
+    flat = imread(os.path.join(data_dir, "flat.tif"))
+    flats = [normalize_flat(flat, c) for c in range(3)]
+    files = light_files(data_dir)
+    for path in files:
+        correct_image(imread(path), *flats)
+    return {"frames": len(files)}
+
+
+def case_align(data_dir, work_dir):
+    from alignment_loader import load_alignment
+    alignment = load_alignment()
+    solutions = os.path.join(work_dir, "solutions.json")
+    # 自動マッチングに失敗しても手動選択の GUI で止まらないよう、失敗フレームは failed として数える
+    alignment.main(os.path.join(data_dir, "lights"), os.path.join(work_dir, "composite.tif"), 30, auto=True,
+                   solutions_file=solutions, interactive=False)
+    with open(os.path.join(data_dir, TRUTH_NAME)) as f:
+        truth = json.load(f)
+    with open(solutions) as f:
+        store = json.load(f)
+
+    # 推定した変換で写した格子点と真の位置との rms 誤差 (px)
+    w, h = truth["width"], truth["height"]
+    grid = np.stack(np.meshgrid(np.linspace(0, w, 5), np.linspace(0, h, 5)), axis=-1).reshape(-1, 2)
+    errors, failed = [], 0
+    for name, frame in truth["frames"].items():
+        entry = store["frames"].get(name)
+        if entry is None:
+            continue
+        if entry.get("status") != "ok":
+            failed += 1
+            continue
+        true_matrix, found = np.array(frame["matrix"]), np.array(entry["matrix"])
+        moved = grid @ true_matrix[:, :2].T + true_matrix[:, 2]
+        back = moved @ found[:, :2].T + found[:, 2]
+        errors.append(np.sqrt(np.mean(np.sum((back - grid) ** 2, axis=1))))
+    return {"frames": len(truth["frames"]), "failed": failed,
+            "error_px": float(np.max(errors)) if errors else None}
+
+
+CASES = {
+    "composite_mean": case_composite_mean,
+    "composite_sigma_clip": case_composite_sigma_clip,
+    "composite_tiled": case_composite_tiled,
+    "subtract": case_subtract,
+    "process_images": case_process_images,
+    "correct_image": case_correct_image,
+    "align": case_align,
+}
+
+
+def run_case(name, data_dir, work_dir):
+    start = time.perf_counter()
+    extra = CASES[name](data_dir, work_dir)
+    seconds = time.perf_counter() - start
+    # ru_maxrss は Linux では KiB 単位
+    rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return seconds, rss / 1024.0, extra
+
+
+def measure(name, data_dir, megapixels, repeat=1):
+    best = None
+    for _ in range(repeat):
+        work_dir = tempfile.mkdtemp(prefix=f"bench_{name}_")
+        try:
+            # ケースごとに新しいプロセスで実行し、最大メモリ使用量を分離する
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn")) as executor:
+                seconds, rss, extra = executor.submit(run_case, name, data_dir, work_dir).result()
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        if best is None or seconds < best["seconds"]:
+            best = dict(extra, seconds=seconds, peak_rss_mb=rss)
+    best["mp_per_s"] = megapixels * best["frames"] / best["seconds"]
+    return best
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get("results", {}).get(name)
+        if base is None or "error" in result or "error" in base:
+            continue
+        checks = [("seconds", result["seconds"] > base["seconds"] * (1 + tolerance)),
+                  ("peak_rss_mb", result["peak_rss_mb"] > base["peak_rss_mb"] * (1 + tolerance))]
+        if base.get("error_px") is not None:
+            checks.append(("error_px", result.get("error_px") is None or result["error_px"] > base["error_px"] + 0.05))
+        for key, worse in checks:
+            if worse:
+                value = result.get(key)
+                regressions.append(f"{name}.{key}: {base[key]:.3f} -> {'-' if value is None else f'{value:.3f}'}")
+    return regressions
+
+
+if __name__ == "__main__" :
+
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline scripts on synthetic star fields.")
+    parser.add_argument("-o", "--output", default="benchmark_results.json", help="Results file (default: benchmark_results.json)")
+    parser.add_argument("--size", type=parse_size, default=(2048, 1365), help="Frame size WxH (default: 2048x1365)")
+    parser.add_argument("--count", type=int, default=8, help="Number of light / dark frames (default: 8)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed (default: 0)")
+    parser.add_argument("--cases", nargs="+", choices=list(CASES), default=list(CASES), help="Cases to run (default: all)")
+    parser.add_argument("--repeat", type=int, default=1, help="Run each case N times and keep the fastest (default: 1)")
+    parser.add_argument("--data-dir", default=None, help="Keep / reuse the synthetic frames in this directory")
+    parser.add_argument("--baseline", default=None, help="Compare with this results file and exit with 1 on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.15, help="Allowed slowdown / memory growth vs the baseline (default: 0.15)")
+    args = parser.parse_args()
+
+    width, height = args.size
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="bench_data_")
+    config = {"width": width, "height": height, "count": args.count, "seed": args.seed}
+    config_path = os.path.join(data_dir, "config.json")
+    stored = None
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            stored = json.load(f)
+    if stored != config:
+        print(f"Generating {args.count} frames of {width}x{height} in {data_dir}")
+        generate_dataset(data_dir, width, height, args.count, seed=args.seed)
+        with open(config_path, "w") as f:
+            json.dump(config, f)
+
+    results = {}
+    try:
+        for name in args.cases:
+            print(f"\n=== {name} ===")
+            try:
+                results[name] = measure(name, data_dir, width * height / 1e6, args.repeat)
+            except Exception as e:
+                print(f"*** {name} failed: {e}")
+                results[name] = {"error": str(e)}
+    finally:
+        if args.data_dir is None:
+            shutil.rmtree(data_dir, ignore_errors=True)
+
+    report = {"config": config,
+              "machine": {"python": platform.python_version(), "numpy": np.__version__,
+                          "platform": platform.platform(), "cpus": os.cpu_count()},
+              "results": results}
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=1)
+
+    print(f"\n{'case':22s} {'seconds':>9s} {'MP/s':>9s} {'RSS MB':>9s}")
+    for name, r in results.items():
+        if "error" in r:
+            print(f"{name:22s} {'failed':>9s}")
+        else:
+            print(f"{name:22s} {r['seconds']:9.2f} {r['mp_per_s']:9.1f} {r['peak_rss_mb']:9.0f}"
+                  + (f"   error {r['error_px']:.3f} px" if r.get("error_px") is not None else ""))
+    print(f"    Output : {args.output}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != config:
+            print("Warning: baseline was measured with a different configuration.")
+        regressions = compare(results, baseline, args.tolerance)
+        for line in regressions:
+            print(f"*** REGRESSION {line}")
+        if regressions:
+            sys.exit(1)
+        print("    No regressions against the baseline.")
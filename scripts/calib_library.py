@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+import argparse
+import threading
+from collections import Counter
+from datetime import datetime
+from glob import glob
+from tiff_io import read_exif
+from nef2tif_with_NR import file_hash, load_manifest
+
+# マスターダーク・フラットを撮影条件 (機種・ISO・露出時間・レンズ・焦点距離・絞り・温度・日付) で索引して再利用する
+
+LIBRARY_ENV = "ASTRO_CALIB_LIBRARY"
+DEFAULT_LIBRARY = os.path.join(os.path.expanduser("~"), ".astro_calib")
+INDEX_NAME = "library.json"
+KINDS = ["dark", "flat"]
+# フラットは周辺減光が光学系で決まるため、機種に加えてこれらがすべて分かっていて一致するものだけを使う
+OPTICS_KEYS = ["lens", "focal_length", "aperture"]
+DATE_FORMAT = "%Y:%m:%d %H:%M:%S"
+
+_index_lock = threading.Lock()
+
+
+def library_dir(path=None):
+    return path or os.environ.get(LIBRARY_ENV, DEFAULT_LIBRARY)
+
+
+def load_index(library):
+    path = os.path.join(library, INDEX_NAME)
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path) as f:
+            return json.load(f).get("masters", [])
+    except (OSError, ValueError) as e:
+        print(f"Warning: ignoring unreadable {path}: {e}")
+        return []
+
+
+def save_index(library, entries):
+    path = os.path.join(library, INDEX_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": 1, "masters": entries}, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def frame_settings(directory):
+    # NEF があればそのタグ、なければ nef2tif の manifest、最後に TIF 自体のタグから撮影条件を集める
+    records = [read_exif(path) for path in sorted(glob(os.path.join(directory, "*.NEF")))]
+    if not any(records):
+        records = [entry.get("exif") for entry in load_manifest(directory).values()]
+    if not any(records):
+        records = [read_exif(path) for path in sorted(glob(os.path.join(directory, "*.tif")))[:1]]
+    records = [r for r in records if r and r.get("model")]
+    if not records:
+        return None
+
+    keys = ["model", "iso", "exposure"] + OPTICS_KEYS
+    settings, count = Counter(tuple(r.get(key) for key in keys) for r in records).most_common(1)[0]
+    if count != len(records):
+        print(f"Warning: {len(records) - count} frame(s) in {directory} were shot with different settings.")
+    dates = sorted(r["date"] for r in records if r.get("date"))
+    return dict(zip(keys, settings), date=dates[0] if dates else None)
+
+
+def parse_date(text):
+    try:
+        return datetime.strptime(text, DATE_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+def days_between(a, b):
+    a, b = parse_date(a), parse_date(b)
+    if a is None or b is None:
+        return 0.0
+    return abs((a - b).total_seconds()) / 86400.0
+
+
+def master_path(library, entry):
+    return os.path.join(library, entry["file"])
+
+
+def is_valid(library, entry):
+    path = master_path(library, entry)
+    return os.path.exists(path) and os.path.getsize(path) == entry.get("size")
+
+
+def add_master(library, kind, source, settings, temperature=None, frames=None):
+    os.makedirs(os.path.join(library, kind), exist_ok=True)
+    digest = file_hash(source)
+    date = parse_date(settings.get("date"))
+    name = "_".join([settings["model"].replace(" ", "-"), f"ISO{settings['iso']}", f"{settings['exposure']:g}s",
+                     date.strftime("%Y%m%d") if date else "nodate", digest[:8]]) + ".tif"
+    rel_path = os.path.join(kind, name)
+    shutil.copyfile(source, os.path.join(library, rel_path))
+
+    entry = dict(settings, kind=kind, file=rel_path, temperature=temperature, frames=frames,
+                 size=os.path.getsize(source), sha256=digest)
+    with _index_lock:
+        entries = [e for e in load_index(library) if e["file"] != rel_path]
+        entries.append(entry)
+        save_index(library, entries)
+    print(f"    Library : added {kind} {rel_path}")
+    return entry
+
+
+def optics_match(entry, settings):
+    for key in OPTICS_KEYS:
+        if entry.get(key) is None or settings.get(key) is None:
+            return False
+        if key == "lens" and entry[key] != settings[key]:
+            return False
+        if key != "lens" and abs(entry[key] - settings[key]) > 0.01 * settings[key]:
+            return False
+    return True
+
+
+def select_master(library, kind, settings, temperature=None, max_temp_diff=5.0, max_days=None):
+    # ダークは機種・ISO・露出時間が一致するもの、フラットは機種・レンズ・焦点距離・絞りが一致するものから
+    # 温度 (分かる場合) と撮影日が最も近いものを選ぶ (ピント位置やフィルターは EXIF から分からないため、
+    # フラットの自動選択は同じ光学系の確認にとどまる)
+    candidates = []
+    for entry in load_index(library):
+        if entry["kind"] != kind or entry["model"] != settings["model"] or not is_valid(library, entry):
+            continue
+        if kind == "flat" and not optics_match(entry, settings):
+            continue
+        if kind == "dark":
+            if entry["iso"] != settings["iso"]:
+                continue
+            if entry["exposure"] is None or settings["exposure"] is None or abs(entry["exposure"] - settings["exposure"]) > 0.01 * settings["exposure"]:
+                continue
+        temp_diff = 0.0
+        if temperature is not None and entry.get("temperature") is not None:
+            temp_diff = abs(entry["temperature"] - temperature)
+            if temp_diff > max_temp_diff:
+                continue
+        days = days_between(entry.get("date"), settings.get("date"))
+        if max_days is not None and days > max_days:
+            continue
+        candidates.append((temp_diff, days, entry))
+
+    if not candidates:
+        return None
+    return min(candidates, key=lambda c: c[:2])[2]
+
+
+def describe(entry):
+    temperature = f"{entry['temperature']:.1f}C" if entry.get("temperature") is not None else "-"
+    return (f"{entry['kind']:5s} {entry['model']:20s} ISO{entry['iso']:<6} {entry['exposure']:>8g}s "
+            f"{temperature:>7s} {entry.get('date') or '-':20s} {entry['file']}")
+
+
+if __name__ == "__main__" :
+
+    parser = argparse.ArgumentParser(description="Library of master darks / flats indexed by camera settings.")
+    parser.add_argument("--library", default=None, help=f"Library directory (default: ${LIBRARY_ENV} or {DEFAULT_LIBRARY})")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p_add = subparsers.add_parser("add", help="Add a master frame to the library")
+    p_add.add_argument("kind", choices=KINDS)
+    p_add.add_argument("source", help="Master TIFF, or a directory of frames to stack (mean)")
+    p_add.add_argument("--settings-from", default=None, help="Frame directory to read EXIF from (default: source directory)")
+    p_add.add_argument("--temperature", type=float, default=None, help="Sensor / ambient temperature (C)")
+    p_add.add_argument("--model", default=None, help="Override camera model")
+    p_add.add_argument("--iso", type=int, default=None, help="Override ISO")
+    p_add.add_argument("--exposure", type=float, default=None, help="Override exposure time (s)")
+    p_add.add_argument("--date", default=None, help="Override date (YYYY:MM:DD HH:MM:SS)")
+    p_add.add_argument("--lens", default=None, help="Override lens model (flats are matched on lens, focal length and aperture)")
+    p_add.add_argument("--focal-length", type=float, default=None, help="Override focal length (mm)")
+    p_add.add_argument("--aperture", type=float, default=None, help="Override f-number")
+
+    p_select = subparsers.add_parser("select", help="Print the master that matches a light-frame directory")
+    p_select.add_argument("kind", choices=KINDS)
+    p_select.add_argument("light_dir", help="Light frame directory (NEF, or TIFs converted by nef2tif_with_NR.py)")
+    p_select.add_argument("--temperature", type=float, default=None, help="Temperature of the light frames (C)")
+    p_select.add_argument("--max-temp-diff", type=float, default=5.0, help="Max temperature difference (default: 5)")
+    p_select.add_argument("--max-days", type=float, default=None, help="Max age difference in days")
+
+    subparsers.add_parser("list", help="List masters in the library")
+    args = parser.parse_args()
+    library = library_dir(args.library)
+
+    if args.command == "list":
+        for entry in load_index(library):
+            print(describe(entry) + ("" if is_valid(library, entry) else "  (missing)"))
+
+    elif args.command == "select":
+        settings = frame_settings(args.light_dir)
+        if settings is None:
+            parser.error(f"no EXIF found in {args.light_dir}")
+        entry = select_master(library, args.kind, settings, args.temperature, args.max_temp_diff, args.max_days)
+        if entry is None:
+            print("*** No matching master found.")
+        else:
+            print(master_path(library, entry))
+
+    else:
+        settings = frame_settings(args.settings_from or (args.source if os.path.isdir(args.source) else os.path.dirname(args.source) or "."))
+        settings = settings or dict.fromkeys(["model", "iso", "exposure", "date"] + OPTICS_KEYS)
+        for key in ["model", "iso", "exposure", "date"] + OPTICS_KEYS:
+            if getattr(args, key) is not None:
+                settings[key] = getattr(args, key)
+        if settings["model"] is None or settings["iso"] is None or settings["exposure"] is None:
+            parser.error("camera settings not found in EXIF; give --model, --iso and --exposure")
+
+        if os.path.isdir(args.source):
+            from composite_simple import composite_directory, list_tiff_files
+            os.makedirs(library, exist_ok=True)
+            stacked = os.path.join(library, f".{args.kind}_stack.tif")
+            if composite_directory(args.source, stacked, "mean") is None:
+                parser.error(f"failed to stack {args.source}")
+            add_master(library, args.kind, stacked, settings, args.temperature, len(list_tiff_files(args.source)))
+            os.remove(stacked)
+        else:
+            add_master(library, args.kind, args.source, settings, args.temperature)
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+from glob import glob
+import numpy as np
+from tifffile import imread, imwrite
+from flat_correction import normalize_flat
+from defect_map import load_defect_map, correct_defects
+
+def load_calibration(dark_path=None, flat_r_path=None, flat_g_path=None, flat_b_path=None, defects=None):
+    dark = None
+    if dark_path is not None:
+        dark = imread(dark_path).astype(np.float32)
+        # ライトと同じ画素を置き換えておき、補正後の値からホットピクセル分を二重に引かないようにする
+        if defects is not None:
+            correct_defects(dark, defects)
+
+    flat = None
+    if flat_r_path is not None:
+        flat = np.stack([normalize_flat(imread(flat_r_path), 0),    # Red
+                         normalize_flat(imread(flat_g_path), 1),    # Green
+                         normalize_flat(imread(flat_b_path), 2)],   # Blue
+                        axis=-1)
+    return dark, flat
+
+
+def calibrate_frame(image, dark=None, flat=None, defects=None):
+    # (light - dark) / flat を float32 の1パスで計算 (subtract.py -> flat_correction.py と同じ結果)
+    frame = image.astype(np.float32)
+    if defects is not None:
+        correct_defects(frame, defects)
+    if dark is not None:
+        frame -= dark
+        np.maximum(frame, 0, out=frame)
+    if flat is not None:
+        frame /= flat
+    np.clip(frame, 0, 65535, out=frame)
+    return frame.astype(np.uint16)
+
+
+def calibrate_frames(files, dark=None, flat=None, defects=None):
+    for path in files:
+        image = imread(path)
+        if (dark is not None and image.shape != dark.shape) or (flat is not None and image.shape != flat.shape) \
+                or (defects is not None and image.shape != defects["shape"]):
+            print(f"Skipping {path}: shape mismatch.")
+            continue
+        yield path, calibrate_frame(image, dark, flat, defects)
+
+
+def calibrate_images(input_dir, output_dir, dark_path=None, flat_r_path=None, flat_g_path=None, flat_b_path=None,
+                     defects_path=None):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    files = sorted(glob(os.path.join(input_dir, "*.tif")))
+    if not files:
+        print("*** No TIFF files found in input directory.")
+        return
+
+    print(f"Found {len(files)} files.")
+    defects = load_defect_map(defects_path) if defects_path is not None else None
+    dark, flat = load_calibration(dark_path, flat_r_path, flat_g_path, flat_b_path, defects)
+
+    for path, calibrated in calibrate_frames(files, dark, flat, defects):
+        print(f"    Processing {os.path.basename(path)} ...")
+        imwrite(os.path.join(output_dir, os.path.basename(path)), calibrated)
+
+    print(f"\nCalibrated images saved to: {output_dir}")
+
+
+if __name__ == "__main__" :
+
+    parser = argparse.ArgumentParser(description="Dark subtraction and flat-field correction in a single pass.")
+    parser.add_argument("input_dir", help="Input directory with light frame TIFF images")
+    parser.add_argument("output_dir", help="Output directory for calibrated TIFF images")
+    parser.add_argument("--dark", default=None, help="Master dark frame of the light frames")
+    parser.add_argument("--flat_r", default=None, help="Flat-field image for Red channel")
+    parser.add_argument("--flat_g", default=None, help="Flat-field image for Green channel")
+    parser.add_argument("--flat_b", default=None, help="Flat-field image for Blue channel")
+    parser.add_argument("--defects", default=None, help="Defect map from defect_map.py; hot pixels are replaced before dark subtraction")
+    args = parser.parse_args()
+
+    flats = [args.flat_r, args.flat_g, args.flat_b]
+    if any(flats) and not all(flats):
+        parser.error("--flat_r, --flat_g and --flat_b must be given together")
+
+    calibrate_images(args.input_dir, args.output_dir, args.dark, args.flat_r, args.flat_g, args.flat_b, args.defects)
@@ -3,18 +3,26 @@
 import numpy as np
 import cv2
 import matplotlib
-matplotlib.use('GTK3Agg')
-import matplotlib.pyplot as plt
-from tifffile import imread, imwrite
+from tifffile import imread, imwrite, TiffFile
 import argparse
 import os
 from glob import glob
-import tempfile
-import pickle
+import json
 import gc
+import time
+import queue
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import combinations
+from batch import resolve_jobs
+from frame_quality import add_quality_arguments, quality_thresholds, select_frames
+from instrument import stage, file_size, add_instrument_arguments, run_instrumented
+from tiff_io import frame_hash, parse_memory_size
+from partial_stack import empty_partial, accumulate, save_partial, parse_shard, shard_indices, frame_key
 
 
-def compute_centroid(image, cx, cy, box_size) :
+def compute_centroid(image, cx, cy, box_size, verbose=True) :
 
     half = box_size // 2
     y1, y2 = int(cy - half), int(cy + half)
@@ -26,22 +34,81 @@ def compute_centroid(image, cx, cy, box_size) :
         return (cx, cy)
     cx_centroid = np.sum(X * subimg) / total
     cy_centroid = np.sum(Y * subimg) / total
-    print(f"    (x, y)   = {cx_centroid:.1f}, {cy_centroid:.1f} ")
-    print(f"    (Rx, Ry) = {cx}, {cy}")
+    if verbose:
+        print(f"    (x, y)   = {cx_centroid:.1f}, {cy_centroid:.1f} ")
+        print(f"    (Rx, Ry) = {cx}, {cy}")
     return (cx_centroid, cy_centroid)
 
 
-def select_star_point(image, title, box_size) :
+PREVIEW_SIZE = 1600
+ZOOM_TILE = 256
 
+
+def stretch_uint8(image, low=1.0, high=99.9) :
+
+    # パーセンタイルで切り出して平方根ストレッチした表示用の 8bit 画像
+    lo, hi = np.percentile(image, [low, high])
+    scaled = (np.asarray(image, dtype=np.float32) - lo) / max(hi - lo, 1e-6)
+    np.clip(scaled, 0, 1, out=scaled)
+    return (np.sqrt(scaled) * 255).astype(np.uint8)
+
+
+def make_preview(gray, max_size=PREVIEW_SIZE) :
+
+    # 長辺が max_size 以下になるよう整数倍で縮小し、元画像の座標系での表示範囲 (extent) と組で返す
+    h, w = gray.shape[:2]
+    step = max(1, -(-max(h, w) // max_size))
+    small = gray if step == 1 else cv2.resize(gray, (w // step, h // step), interpolation=cv2.INTER_AREA)
+    extent = (-0.5, small.shape[1] * step - 0.5, small.shape[0] * step - 0.5, -0.5)
+    return stretch_uint8(small), extent, step
+
+
+def select_star_point(image, title, box_size, preview=None) :
+
+    # 縮小画像をクリックするとその周辺を原寸のタイルで表示し、タイル上のクリックで星を選ぶ (右クリックで全体表示に戻る)
+    if preview is None:
+        preview = make_preview(image)
+    small, extent, step = preview
     coords = []
+    zoomed = [False]
+
+    # GTK のバックエンドは手動選択のときだけ読み込む (無人実行や GTK のない環境で import だけで失敗しないように)
+    matplotlib.use('GTK3Agg')
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=(10, 8))
+    shown = ax.imshow(small, cmap='gray', extent=extent, vmin=0, vmax=255, interpolation='nearest')
+    ax.set_title(title)
+
+    def show(data, data_extent):
+        shown.set_data(data)
+        shown.set_extent(data_extent)
+        ax.set_xlim(data_extent[0], data_extent[1])
+        ax.set_ylim(data_extent[2], data_extent[3])
+        fig.canvas.draw_idle()
+
+    def show_tile(x, y):
+        h, w = image.shape[:2]
+        x0 = min(max(int(round(x)) - ZOOM_TILE // 2, 0), max(w - ZOOM_TILE, 0))
+        y0 = min(max(int(round(y)) - ZOOM_TILE // 2, 0), max(h - ZOOM_TILE, 0))
+        tile = image[y0:y0 + ZOOM_TILE, x0:x0 + ZOOM_TILE]
+        show(stretch_uint8(tile), (x0 - 0.5, x0 + tile.shape[1] - 0.5, y0 + tile.shape[0] - 0.5, y0 - 0.5))
+        zoomed[0] = True
 
     def onclick(event):
-        if event.xdata is not None and event.ydata is not None:
-            coords.append((int(event.xdata), int(event.ydata)))
-            plt.close()
+        if event.xdata is None or event.ydata is None:
+            return
+        if event.button == 3:
+            show(small, extent)
+            zoomed[0] = False
+        elif zoomed[0] or step == 1:
+            # 表示は元画像の座標系なので、クリック位置をそのまま重心計算に使える
+            coords.append((int(round(event.xdata)), int(round(event.ydata))))
+            plt.close(fig)
+        else:
+            show_tile(event.xdata, event.ydata)
 
     def onscroll(event):
-        ax = plt.gca()
         cur_xlim = ax.get_xlim()
         cur_ylim = ax.get_ylim()
         xdata = event.xdata
@@ -55,11 +122,8 @@ def select_star_point(image, title, box_size) :
         rely = (cur_ylim[1] - ydata) / (cur_ylim[1] - cur_ylim[0])
         ax.set_xlim([xdata - new_width * (1 - relx), xdata + new_width * relx])
         ax.set_ylim([ydata - new_height * (1 - rely), ydata + new_height * rely])
-        plt.draw()
+        fig.canvas.draw_idle()
 
-    fig, ax = plt.subplots(figsize=(10, 8))
-    ax.imshow(image, cmap='gray')
-    ax.set_title(title)
     fig.canvas.mpl_connect('button_press_event', onclick)
     fig.canvas.mpl_connect('scroll_event', onscroll)
     plt.show()
@@ -71,6 +135,25 @@ def select_star_point(image, title, box_size) :
         return None
 
 
+def select_reference_points(gray_ref, box_size, preview=None) :
+
+    if preview is None:
+        preview = make_preview(gray_ref)
+    ref_star1 = select_star_point(gray_ref, "    Click on reference star 1", box_size, preview)
+    ref_star2 = select_star_point(gray_ref, "    Click on reference star 2", box_size, preview)
+    if ref_star1 is None or ref_star2 is None:
+        print("*** Reference selection failed.")
+        return None
+    return [ref_star1, ref_star2]
+
+
+def transform_residual(matrix, src, dst) :
+
+    src = np.asarray(src, dtype=np.float64)
+    dst = np.asarray(dst, dtype=np.float64)
+    return float(np.sqrt(np.mean(np.sum((src @ matrix[:, :2].T + matrix[:, 2] - dst) ** 2, axis=1))))
+
+
 def compute_transform(ref_pts, tgt_pts) :
 
     ref = np.array(ref_pts, dtype=np.float32)
@@ -79,83 +162,428 @@ def compute_transform(ref_pts, tgt_pts) :
     return matrix
 
 
-def main(input_dir, output_file, box_size) :
+def detect_stars(image, box_size, max_stars=50, nsigma=5.0) :
+
+    image = image.astype(np.float32)
+    sample = image[::4, ::4]
+    background = np.median(sample)
+    noise = 1.4826 * np.median(np.abs(sample - background))
+    signal = np.clip(image - background, 0, None)
+
+    smooth = cv2.GaussianBlur(signal, (0, 0), 1.5)
+    local_max = cv2.dilate(smooth, np.ones((box_size, box_size), np.uint8))
+    half = box_size // 2 + 1
+    peaks = (smooth == local_max) & (smooth > nsigma * max(noise, 1e-6))
+    peaks[:half, :] = peaks[-half:, :] = False
+    peaks[:, :half] = peaks[:, -half:] = False
+
+    ys, xs = np.nonzero(peaks)
+    order = np.argsort(smooth[ys, xs])[::-1][:max_stars]
+    stars = [compute_centroid(signal, x, y, box_size, verbose=False) for x, y in zip(xs[order], ys[order])]
+    return np.array(stars, dtype=np.float32).reshape(-1, 2)
+
+
+def triangle_invariants(points) :
+
+    idx = np.array(list(combinations(range(len(points)), 3)))
+    tri = points[idx]
+    # 各頂点の対辺の長さ
+    sides = np.stack([np.linalg.norm(tri[:, 1] - tri[:, 2], axis=1),
+                      np.linalg.norm(tri[:, 0] - tri[:, 2], axis=1),
+                      np.linalg.norm(tri[:, 0] - tri[:, 1], axis=1)], axis=1)
+    order = np.argsort(sides, axis=1)
+    sides = np.take_along_axis(sides, order, axis=1)
+    vertices = np.take_along_axis(idx, order, axis=1)
+    valid = sides[:, 0] > 0
+    invariants = np.stack([sides[:, 0], sides[:, 1]], axis=1) / np.maximum(sides[:, 2:3], 1e-6)
+    return invariants[valid], vertices[valid]
+
+
+def match_stars(ref_stars, tgt_stars, n_brightest=15, tolerance=0.005, radius=3.0) :
+
+    if len(ref_stars) < 3 or len(tgt_stars) < 3:
+        return None, 0, None
+
+    ref_inv, ref_vtx = triangle_invariants(ref_stars[:n_brightest])
+    tgt_inv, tgt_vtx = triangle_invariants(tgt_stars[:n_brightest])
+    dist = np.linalg.norm(tgt_inv[:, None, :] - ref_inv[None, :, :], axis=2)
+    nearest = np.argmin(dist, axis=1)
+    matched = dist[np.arange(len(tgt_inv)), nearest] < tolerance
+
+    # 一致した三角形の頂点対応に投票
+    votes = np.zeros((min(len(tgt_stars), n_brightest), min(len(ref_stars), n_brightest)), dtype=np.int32)
+    np.add.at(votes, (tgt_vtx[matched].ravel(), ref_vtx[nearest[matched]].ravel()), 1)
+    best_ref = np.argmax(votes, axis=1)
+    best_tgt = np.argmax(votes, axis=0)
+    tgt_idx = np.nonzero((votes[np.arange(len(votes)), best_ref] >= 2) & (best_tgt[best_ref] == np.arange(len(votes))))[0]
+    if len(tgt_idx) < 3:
+        return None, 0, None
+
+    matrix, _ = cv2.estimateAffinePartial2D(tgt_stars[tgt_idx], ref_stars[best_ref[tgt_idx]],
+                                            method=cv2.RANSAC, ransacReprojThreshold=radius)
+    if matrix is None:
+        return None, 0, None
+
+    # 初期解で全ての検出星を対応付けて再推定
+    projected = tgt_stars @ matrix[:, :2].T + matrix[:, 2]
+    d = np.linalg.norm(projected[:, None, :] - ref_stars[None, :, :], axis=2)
+    nearest = np.argmin(d, axis=1)
+    close = d[np.arange(len(tgt_stars)), nearest] < radius
+    if np.count_nonzero(close) < 3:
+        return None, 0, None
+    matrix, inliers = cv2.estimateAffinePartial2D(tgt_stars[close], ref_stars[nearest[close]],
+                                                  method=cv2.RANSAC, ransacReprojThreshold=radius)
+    if matrix is None:
+        return None, 0, None
+    inliers = inliers.ravel().astype(bool)
+    if np.count_nonzero(inliers) < 3:
+        return None, 0, None
+    src = tgt_stars[close][inliers]
+    dst = ref_stars[nearest[close]][inliers]
+    return matrix, int(np.count_nonzero(inliers)), transform_residual(matrix, src, dst)
+
+
+def phase_correlate(ref, tgt) :
+
+    window = cv2.createHanningWindow(ref.shape[::-1], cv2.CV_32F)
+    cross = np.fft.rfft2((tgt - tgt.mean()) * window) * np.conj(np.fft.rfft2((ref - ref.mean()) * window))
+    cross /= np.maximum(np.abs(cross), 1e-12)
+    surface = np.fft.fftshift(np.fft.irfft2(cross, s=ref.shape))
+
+    # ピークと大きい方の隣の値の比から sub-pixel 位置を求める (位相相関のピークは sinc 形で、
+    # 整数ずれでは隣がほぼ 0 になるため、対数を取るガウスフィットはノイズで大きくずれる)
+    h, w = surface.shape
+    py, px = np.unravel_index(np.argmax(surface), surface.shape)
+    def subpixel(m, c, p):
+        if c <= 0:
+            return 0.0
+        if p >= m:
+            r = max(p, 0.0) / c
+            return r / (1 + r)
+        r = max(m, 0.0) / c
+        return -r / (1 + r)
+    dx = subpixel(surface[py, (px - 1) % w], surface[py, px], surface[py, (px + 1) % w])
+    dy = subpixel(surface[(py - 1) % h, px], surface[py, px], surface[(py + 1) % h, px])
+    return px - w // 2 + dx, py - h // 2 + dy, float(surface[py, px])
+
+
+def phase_shift(ref, tgt, levels=3, crop=1024) :
+
+    # 縮小画像で粗く推定し、中央部の等倍切り出しで sub-pixel 精度に詰める
+    ref_small, tgt_small = ref, tgt
+    for _ in range(levels):
+        ref_small = cv2.pyrDown(ref_small)
+        tgt_small = cv2.pyrDown(tgt_small)
+    dx, dy, _ = phase_correlate(ref_small, tgt_small)
+    ix, iy = int(round(dx * 2 ** levels)), int(round(dy * 2 ** levels))
+
+    h, w = ref.shape
+    ch, cw = min(crop, h - abs(iy)), min(crop, w - abs(ix))
+    y0 = min(max((h - ch) // 2, -iy, 0), h - ch - max(iy, 0))
+    x0 = min(max((w - cw) // 2, -ix, 0), w - cw - max(ix, 0))
+    ref_crop = ref[y0:y0 + ch, x0:x0 + cw]
+    tgt_crop = tgt[y0 + iy:y0 + iy + ch, x0 + ix:x0 + ix + cw]
+    fx, fy, response = phase_correlate(ref_crop, tgt_crop)
+    return ix + fx, iy + fy, response
+
+
+def read_frames(tasks, frames) :
+
+    for idx, path, matrix in tasks:
+        try:
+            with stage("decode", path) as record:
+                image = imread(path)
+                record["bytes_read"] = file_size(path)
+            frames.put((idx, path, matrix, image, None))
+            del image
+        except Exception as e:
+            frames.put((idx, path, matrix, None, e))
+    frames.put(None)
+
+
+def load_gray(path, preview=False) :
+
+    with stage("decode", path) as record:
+        image = imread(path)
+        record["bytes_read"] = file_size(path)
+    with stage("convert", path):
+        gray = np.mean(image, axis=2) if image.ndim == 3 else image
+        del image
+        return gray, make_preview(gray) if preview else None
+
+
+def prefetch_gray(paths, previews=False, depth=1) :
+
+    # 星を選択している間に、次のフレームの読み込み・グレースケール変換 (・表示用の縮小画像) を進めておく
+    frames = queue.Queue(maxsize=depth)
+
+    def worker():
+        for path in paths:
+            try:
+                frames.put((path, *load_gray(path, previews), None))
+            except Exception as e:
+                frames.put((path, None, None, e))
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    def iter_frames():
+        for _ in paths:
+            path, gray, preview, error = frames.get()
+            if error is not None:
+                raise error
+            yield path, gray, preview
+    return iter_frames()
+
+
+def warp_frame(image, matrix, width, height, frame=None) :
+
+    if matrix is None:
+        return image
+    with stage("warp", frame):
+        return cv2.warpAffine(image, matrix, (width, height), flags=cv2.INTER_LINEAR)
+
+
+def composite_frames(files, matrices, width, height, jobs=1, prefetch=4, reference_index=0, partial=None, frame_keys=None) :
+
+    # partial を渡すと合計だけでなく二乗和・最小・最大も部分スタックに積算する (frame_keys は部分スタックに記録する名前)
+    tasks = []
+    for idx, path in enumerate(files):
+        if idx != reference_index and matrices[idx] is None:
+            print(f"[Composite {idx+1}/{len(files)}] {os.path.basename(path)}")
+            print("*** Skipping due to missing star positions.")
+            continue
+        tasks.append((idx, path, matrices[idx]))
+
+    # 読み込みスレッド -> warp スレッドプール -> メインスレッドでファイル順に積算
+    frames = queue.Queue(maxsize=prefetch)
+    threading.Thread(target=read_frames, args=(tasks, frames), daemon=True).start()
+
+    composite = None
+    count = 0
+    pending = deque()
+
+    def accumulate_frame(idx, path, future) :
+        nonlocal composite, count
+        print(f"[Composite {idx+1}/{len(files)}] {os.path.basename(path)}")
+        try:
+            aligned = future.result()
+        except Exception as e:
+            print(f"*** Skipping: {e}")
+            return
+        with stage("compute", path):
+            if partial is not None:
+                accumulate(partial, aligned, frame_keys[idx] if frame_keys is not None else frame_key(path))
+                return
+            if composite is None:
+                composite = np.zeros(aligned.shape, dtype=np.float64)
+            np.add(composite, aligned, out=composite)
+        count += 1
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        while True:
+            item = frames.get()
+            if item is None:
+                break
+            idx, path, matrix, image, error = item
+            if error is not None:
+                print(f"[Composite {idx+1}/{len(files)}] {os.path.basename(path)}")
+                print(f"*** Skipping: failed to read ({error})")
+                continue
+            pending.append((idx, path, pool.submit(warp_frame, image, matrix, width, height, path)))
+            del image, item
+            if len(pending) >= jobs:
+                accumulate_frame(*pending.popleft())
+        while pending:
+            accumulate_frame(*pending.popleft())
+
+    if partial is not None:
+        return partial["sum"], partial["count"]
+    return composite, count
+
+
+SOLUTIONS_NAME = "alignment_solutions.json"
+DEFAULT_MAX_MEMORY = 2 * 1024 ** 3
+
+
+def load_solutions(path) :
+
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"*** Ignoring unreadable {path}: {e}")
+        return None
+
+
+def save_solutions(path, store) :
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(store, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def main(input_dir, output_file, box_size, auto=False, register="stars", jobs=0, reregister=False, solutions_file=None, quality=None,
+         shard=None, partial_file=None, interactive=True, max_memory=None) :
+
+    # interactive=False : 自動位置合わせに失敗したフレームは手動選択 (GUI) に回さずにスキップする (pipeline.py など無人実行用)
 
     files = sorted(glob(os.path.join(input_dir, "*.tif")))
     if not files:
         print("*** No TIFF files found.")
         return
 
-    ref_image = imread(files[0])
-    gray_ref = np.mean(ref_image, axis=2) if ref_image.ndim == 3 else ref_image
-    h, w = gray_ref.shape
-    
-    print("\n=== Starting star selecting phase ===")
-    ref_star1 = select_star_point(gray_ref, "    Click on reference star 1", box_size)
-    ref_star2 = select_star_point(gray_ref, "    Click on reference star 2", box_size)
-    if ref_star1 is None or ref_star2 is None:
-        print("*** Reference selection failed.")
-        return
-    ref_pts = [ref_star1, ref_star2]
+    if quality:
+        # 位置合わせ・コンポジットの前に低品質フレームを除外 (先頭の採用フレームが基準)
+        files = select_frames(files, quality, resolve_jobs(jobs))
+        if not files:
+            print("*** No frames passed the quality thresholds.")
+            return
 
-    tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=".pkl")
-    star_positions = []
+    with TiffFile(files[0]) as tif:
+        h, w = tif.pages[0].shape[:2]
+        frame_bytes = int(np.prod(tif.pages[0].shape)) * tif.pages[0].dtype.itemsize
 
-    for idx, path in enumerate(files):
-        print(f"\n[{idx+1}/{len(files)}] {os.path.basename(path)}")
+    if solutions_file is None:
+        # 分割処理で同じファイルを同時に書き換えないよう、担当ごとに別ファイルにする
+        name = SOLUTIONS_NAME if shard is None else SOLUTIONS_NAME.replace(".json", f"_{shard[0]}-{shard[1]}.json")
+        solutions_file = os.path.join(input_dir, name)
+    # 保存済みの位置合わせ結果は既定で再利用する (出力先や積算方法だけを変えた再実行では位置合わせを省く)
+    store = {"reference": {"path": os.path.basename(files[0]), "hash": frame_hash(files[0])}, "frames": {}}
+    stored = None if reregister else load_solutions(solutions_file)
+    if stored is not None and stored.get("reference", {}).get("hash") == store["reference"]["hash"]:
+        store = stored
+        print(f"    Reusing solutions from {solutions_file}")
+    elif stored is not None:
+        print(f"*** Reference frame changed. Ignoring {solutions_file}")
+
+    print("\n=== Starting star selecting phase ===")
+    ref_pts = store["reference"].get("points")
+    gray_ref = ref_preview = ref_lum = ref_stars = None
+    reused = 0
+    # 分割処理では基準フレーム (files[0]) は共通のまま、担当するフレームだけを位置合わせ・積算する
+    indices = shard_indices(len(files), shard)
+
+    method = register if register == "phase" else ("auto" if auto else "manual")
+    todo = []
+    for idx in indices:
+        path = files[idx]
         if idx == 0:
-            star_positions.append((ref_star1, ref_star2))
-        else:
-            image = imread(path)
-            gray = np.mean(image, axis=2) if image.ndim == 3 else image
-            star1 = select_star_point(gray, f"    Click on star 1 ({os.path.basename(path)})", box_size)
-            star2 = select_star_point(gray, f"    Click on star 2 ({os.path.basename(path)})", box_size)
+            continue
+        entry = store["frames"].get(os.path.basename(path))
+        digest = frame_hash(path)
+        # 無人実行でスキップしたフレームは、次に対話的に実行したときに改めて選択できるようにする。
+        # 自動の結果は方式 (--auto / --register phase) を変えたときは求め直す (手動で選んだ結果は常に再利用)
+        if entry is not None and entry.get("hash") == digest and not (interactive and entry.get("status") == "skipped") \
+                and (method == "manual" or entry.get("method") in ("manual", method)):
+            reused += 1
+            continue
+        todo.append((idx, path, digest))
+
+    # 手動選択では表示用の縮小画像も先読みスレッドで作っておく
+    manual = register != "phase" and not auto and interactive
+    frames = prefetch_gray([path for _, path, _ in todo], previews=manual)
+    if todo:
+        gray_ref, ref_preview = load_gray(files[0], preview=manual)
+
+    for (idx, path, digest), (_, gray, preview) in zip(todo, frames):
+        name = os.path.basename(path)
+        print(f"\n[{idx+1}/{len(files)}] {name}")
+        start = time.perf_counter()
+        with stage("register", path) as record:
+            entry = {"hash": digest, "method": method}
+            matrix = None
+            if register == "phase":
+                if ref_lum is None:
+                    ref_lum = gray_ref.astype(np.float32)
+                dx, dy, response = phase_shift(ref_lum, gray.astype(np.float32))
+                matrix = np.array([[1.0, 0.0, -dx], [0.0, 1.0, -dy]])
+                entry["response"] = response
+                print(f"    (dx, dy) = {dx:.2f}, {dy:.2f} (response {response:.3f})")
+            elif auto:
+                if ref_stars is None:
+                    ref_stars = detect_stars(gray_ref, box_size)
+                    print(f"    {len(ref_stars)} stars detected in reference frame.")
+                stars = detect_stars(gray, box_size)
+                matrix, n_matched, residual = match_stars(ref_stars, stars)
+                if matrix is None:
+                    print("*** Automatic matching failed." + (" Falling back to manual selection." if interactive else ""))
+                else:
+                    entry.update(stars=np.round(stars, 3).tolist(), residual=residual)
+                    print(f"    {n_matched} stars matched (rms {residual:.2f} px)")
+            record["method"] = entry["method"]
+
+        if matrix is None and not interactive:
+            print("*** Skipping image (manual selection disabled).")
+            entry["status"] = "skipped"
+        elif matrix is None:
+            if ref_pts is None:
+                ref_pts = select_reference_points(gray_ref, box_size, ref_preview)
+                if ref_pts is not None:
+                    store["reference"]["points"] = [list(map(float, pt)) for pt in ref_pts]
+            star1 = star2 = None
+            if ref_pts is not None:
+                if preview is None:
+                    preview = make_preview(gray)
+                star1 = select_star_point(gray, f"    Click on star 1 ({name})", box_size, preview)
+                star2 = select_star_point(gray, f"    Click on star 2 ({name})", box_size, preview)
             if star1 is None or star2 is None:
                 print("*** Skipping image due to star selection failure.")
-                star_positions.append(None)
             else:
-                star_positions.append((star1, star2))
-            del image, gray
-            gc.collect()
-
-    with open(tmp_file.name, "wb") as f:
-        pickle.dump(star_positions, f)
+                matrix = compute_transform(ref_pts, (star1, star2))
+                entry.update(method="manual", stars=[list(map(float, star1)), list(map(float, star2))],
+                             residual=transform_residual(matrix, [star1, star2], ref_pts))
+        print(f"    Registration time: {(time.perf_counter() - start) * 1000:.0f} ms")
 
-    print("\n=== Starting Compositing Phase ===")
-    with open(tmp_file.name, "rb") as f:
-        star_positions = pickle.load(f)
+        entry.setdefault("status", "failed" if matrix is None else "ok")
+        entry["matrix"] = None if matrix is None else matrix.tolist()
+        store["frames"][name] = entry
+        save_solutions(solutions_file, store)
+        del gray, preview
+        gc.collect()
 
-    composite = None
-    count = 0
+    save_solutions(solutions_file, store)
+    if reused:
+        print(f"    {reused} frame(s) reused from stored solutions.")
+    print(f"    Solutions: {solutions_file}")
+    matrices = []
+    for idx in indices:
+        entry = store["frames"].get(os.path.basename(files[idx]), {})
+        matrices.append(np.array(entry["matrix"]) if entry.get("status") == "ok" else None)
 
-    for idx, path in enumerate(files):
-        print(f"[Composite {idx+1}/{len(files)}] {os.path.basename(path)}")
-        image = imread(path)
-        if idx == 0:
-            aligned = image.astype(np.float64)
-        else:
-            if star_positions[idx] is None:
-                print("*** Skipping due to missing star positions.")
-                continue
-            gray = np.mean(image, axis=2) if image.ndim == 3 else image
-            matrix = compute_transform(ref_pts, star_positions[idx])
-            aligned = cv2.warpAffine(image, matrix, (w, h), flags=cv2.INTER_LINEAR).astype(np.float64)
+    print("\n=== Starting Compositing Phase ===")
+    # 先読み・warp 中のフレーム (入力と warp 後で2枚分) がコア数に比例して増えないよう、合計を max_memory 以内に抑える
+    slots = max(1, (max_memory or DEFAULT_MAX_MEMORY) // (2 * frame_bytes))
+    jobs = min(resolve_jobs(jobs), slots)
+    prefetch = max(1, min(slots - jobs, 2 * jobs))
+    print(f"    {jobs} warp thread(s), {prefetch} frame(s) prefetched")
 
-        if composite is None:
-            composite = aligned
-        else:
-            composite += aligned
-        count += 1
-        del image, aligned
-        gc.collect()
+    partial = keys = None
+    if partial_file is not None:
+        # 基準フレームを記録し、別の基準で位置合わせした部分スタックとはマージできないようにする
+        hashes = {os.path.basename(files[0]): store["reference"]["hash"]}
+        hashes.update((name, entry.get("hash")) for name, entry in store["frames"].items())
+        partial = empty_partial(frame_key(files[0], store["reference"]["hash"]))
+        keys = [frame_key(files[i], hashes.get(os.path.basename(files[i]))) for i in indices]
+    composite, count = composite_frames([files[i] for i in indices], matrices, w, h, jobs, prefetch,
+                                        reference_index=0 if indices[:1] == [0] else None, partial=partial, frame_keys=keys)
 
     if count == 0:
         print("*** Error")
         print("No images successfully processed.")
         return
 
+    if partial is not None:
+        save_partial(partial_file, partial)
+        print(f"    Partial: {partial_file} ({count} frames)")
+        return
+
     composite = np.clip(composite / count, 0, 65535).astype(np.uint16)
-    imwrite(output_file, composite)
+    with stage("encode", output_file) as record:
+        imwrite(output_file, composite)
+        record["bytes_written"] = file_size(output_file)
     print(f"    Output: {output_file}")
 
 
@@ -165,8 +593,27 @@ if __name__ == "__main__":
     parser.add_argument("input_dir", help="Directory with TIFF images")
     parser.add_argument("output_file", help="Output composite TIFF filename")
     parser.add_argument("--box", type=int, default=30, help="Box size for star region (default: 30)")
+    parser.add_argument("--auto", action="store_true", help="Detect and match stars automatically (manual selection is used only for frames that fail)")
+    parser.add_argument("--register", choices=["stars", "phase"], default="stars",
+                        help="stars: 2-star (or --auto) alignment, phase: FFT phase correlation for translation-only drift")
+    parser.add_argument("-j", "--jobs", type=int, default=0,
+                        help="Number of warp threads in the compositing phase, limited by --max-memory (0: all cores, default: 0)")
+    parser.add_argument("--max-memory", type=parse_memory_size, default=None,
+                        help="Memory budget for frames being read and warped in the compositing phase (e.g. 4G, default: 2G)")
+    parser.add_argument("--reregister", action="store_true",
+                        help="Discard the stored registration results and register every frame again (by default frames whose content is unchanged are reused)")
+    parser.add_argument("--solutions", default=None, help=f"Registration results file (default: <input_dir>/{SOLUTIONS_NAME})")
+    parser.add_argument("--partial", default=None,
+                        help="Write a partial stack (.npz) instead of output_file; combine them with partial_stack.py")
+    parser.add_argument("--shard", type=parse_shard, default=None,
+                        help="Only register and stack every N-th frame starting at K (K/N). The reference is always the first frame")
+    parser.add_argument("--no-manual", action="store_true",
+                        help="Skip frames that fail automatic registration instead of opening the manual star picker (unattended runs)")
+    add_quality_arguments(parser)
+    add_instrument_arguments(parser)
     args = parser.parse_args()
 
     print("BEGIN :: composite 2star-alignment")
-    main(args.input_dir, args.output_file, args.box)
+    run_instrumented(args, main, args.input_dir, args.output_file, args.box, args.auto, args.register, args.jobs, args.reregister,
+                     args.solutions, quality_thresholds(args), args.shard, args.partial, not args.no_manual, args.max_memory)
     print("END :: composite 2star-alignment")
@@ -2,13 +2,35 @@
 
 import os
 import argparse
+import tempfile
 import numpy as np
 import imageio.v2 as imageio
+from tiff_io import open_tiff, parse_memory_size
+from frame_quality import add_quality_arguments, quality_thresholds, select_frames
+from instrument import stage, file_size, add_instrument_arguments, run_instrumented
+from partial_stack import PARTIAL_METHODS, empty_partial, accumulate, save_partial, parse_shard, shard_indices, frame_key
 
-def load_tiff_images_from_directory(directory) :
+def list_tiff_files(directory) :
 
-    tiff_files = sorted([os.path.join(directory, f) for f in os.listdir(directory)
-                        if f.lower().endswith(('.tif', '.tiff'))])
+    return sorted([os.path.join(directory, f) for f in os.listdir(directory)
+                   if f.lower().endswith(('.tif', '.tiff'))])
+
+
+def load_tiff_image(tiff_file) :
+
+    with stage("decode", tiff_file) as record:
+        image = imageio.imread(tiff_file)
+        if image.dtype != np.uint16:
+            print(f"Warning: {tiff_file} is not 16bit. Converting to uint16.")
+            image = (image.astype(np.float32) * (65535.0 / np.max(image))).astype(np.uint16)
+        record["bytes_read"] = file_size(tiff_file)
+    return image
+
+
+def load_tiff_images_from_directory(directory, tiff_files=None) :
+
+    if tiff_files is None:
+        tiff_files = list_tiff_files(directory)
 
     if not tiff_files:
         print("*** Error ***")
@@ -19,11 +41,7 @@ def load_tiff_images_from_directory(directory) :
     images = []
     for tiff_file in tiff_files:
         try:
-            image = imageio.imread(tiff_file)
-            if image.dtype != np.uint16:
-                print(f"Warning: {tiff_file} is not 16bit. Converting to uint16.")
-                image = (image.astype(np.float32) * (65535.0 / np.max(image))).astype(np.uint16)
-            images.append(image)
+            images.append(load_tiff_image(tiff_file))
             print(f"Loaded : {tiff_file}")
         except Exception as e:
             print("*** Error ***")
@@ -33,14 +51,68 @@ def load_tiff_images_from_directory(directory) :
     return images if images else None
 
 
-def composite_images(images, method="mean") :
-    if not images:
+def open_tiff_frames_from_directory(directory, spill_dir=None, tiff_files=None) :
+
+    if tiff_files is None:
+        tiff_files = list_tiff_files(directory)
+
+    if not tiff_files:
         print("*** Error ***")
-        print("No valid images to composite.")
+        print("No TIFF files found in directory.")
         print("abort.")
         return None
 
-    images_stack = np.stack(images, axis=0)
+    frames = []
+    for tiff_file in tiff_files:
+        try:
+            frame = open_tiff(tiff_file, spill_dir)
+            scale = None
+            if frame.dtype != np.uint16:
+                print(f"Warning: {tiff_file} is not 16bit. Converting to uint16.")
+                scale = 65535.0 / np.max(frame)
+            frames.append((frame, scale))
+            print(f"Mapped : {tiff_file}")
+        except Exception as e:
+            print("*** Error ***")
+            print(f"Failed to open {tiff_file}: {e}")
+            continue
+
+    return frames if frames else None
+
+
+METHODS = ["mean", "max", "min", "median", "sigma-clip", "winsorized"]
+
+
+def sigma_clip_mean(channel_stack, kappa=3.0, iters=5) :
+
+    data = channel_stack.astype(np.float64)
+    for _ in range(iters):
+        center = np.nanmedian(data, axis=0)
+        sigma = np.nanstd(data, axis=0)
+        outliers = np.abs(data - center) > kappa * sigma
+        # 残りのサンプルがすべて除外される画素は前回の値のまま残す (全て NaN にしない)
+        outliers[:, np.all(outliers | np.isnan(data), axis=0)] = False
+        if not outliers.any():
+            break
+        data[outliers] = np.nan
+    return np.nanmean(data, axis=0)
+
+
+def winsorized_mean(channel_stack, kappa=3.0, iters=5) :
+
+    data = channel_stack.astype(np.float64)
+    for _ in range(iters):
+        center = np.median(data, axis=0)
+        sigma = np.std(data, axis=0)
+        clipped = np.clip(data, center - kappa * sigma, center + kappa * sigma)
+        if np.array_equal(clipped, data):
+            break
+        data = clipped
+    return np.mean(data, axis=0)
+
+
+def reduce_stack(images_stack, method="mean", kappa=3.0, iters=5) :
+
     composite = np.zeros_like(images_stack[0], dtype=np.uint16)
 
     for c in range(3):
@@ -50,30 +122,182 @@ def composite_images(images, method="mean") :
             composite[..., c] = np.clip(np.max(images_stack[..., c], axis=0), 0, 65535).astype(np.uint16)
         elif method == "min":
             composite[..., c] = np.min(images_stack[..., c], axis=0).astype(np.uint16)
+        elif method == "median":
+            composite[..., c] = np.clip(np.median(images_stack[..., c], axis=0), 0, 65535).astype(np.uint16)
+        elif method == "sigma-clip":
+            composite[..., c] = np.clip(sigma_clip_mean(images_stack[..., c], kappa, iters), 0, 65535).astype(np.uint16)
+        elif method == "winsorized":
+            composite[..., c] = np.clip(winsorized_mean(images_stack[..., c], kappa, iters), 0, 65535).astype(np.uint16)
         else:
             print("*** Error ***")
-            print("Invalid method. Use 'mean', 'max', or 'min'.")
+            print(f"Invalid method. Use one of {', '.join(METHODS)}.")
             print("abort.")
             return None
 
     return composite
 
 
+def composite_images(images, method="mean", kappa=3.0, iters=5) :
+    if not images:
+        print("*** Error ***")
+        print("No valid images to composite.")
+        print("abort.")
+        return None
+
+    images_stack = np.stack(images, axis=0)
+    return reduce_stack(images_stack, method, kappa, iters)
+
+
+# 1チャンネル分の作業領域 (bytes / frame / pixel)
+STACK_WORK_BYTES = {"mean": 0, "max": 0, "min": 0, "median": 4, "sigma-clip": 40, "winsorized": 40}
+
+
+def tile_rows_for_budget(n_frames, width, channels, method, max_memory) :
+
+    per_row = n_frames * width * (channels * 2 + STACK_WORK_BYTES.get(method, 40)) + width * channels * 8
+    return max_memory // per_row
+
+
+def composite_images_tiled(frames, method="mean", max_memory=1024 ** 3, kappa=3.0, iters=5) :
+    if not frames:
+        print("*** Error ***")
+        print("No valid images to composite.")
+        print("abort.")
+        return None
+
+    shape = frames[0][0].shape
+    if any(frame.shape != shape for frame, _ in frames):
+        print("*** Error ***")
+        print("All images must have the same shape.")
+        print("abort.")
+        return None
+
+    height, width = shape[:2]
+    channels = shape[2] if len(shape) == 3 else 1
+    composite = np.zeros(shape, dtype=np.uint16)
+    rows = tile_rows_for_budget(len(frames), width, channels, method, max_memory - composite.nbytes)
+    if rows < 1:
+        print("Warning: --max-memory is too small for one row of all frames. Using 1 row per tile.")
+        rows = 1
+    rows = min(rows, height)
+    print(f"    Tile : {rows} rows x {len(frames)} frames ({-(-height // rows)} tiles)")
+
+    for y0 in range(0, height, rows):
+        y1 = min(y0 + rows, height)
+        tile = np.empty((len(frames), y1 - y0) + shape[1:], dtype=np.uint16)
+        for i, (frame, scale) in enumerate(frames):
+            if scale is None:
+                tile[i] = frame[y0:y1]
+            else:
+                tile[i] = (frame[y0:y1].astype(np.float32) * scale).astype(np.uint16)
+        reduced = reduce_stack(tile, method, kappa, iters)
+        if reduced is None:
+            return None
+        composite[y0:y1] = reduced
+        del tile, reduced
+
+    return composite
+
+
+def stack_partial(tiff_files) :
+
+    # 1枚ずつ読み込んで部分スタックに積算 (全フレームを同時にメモリに置かない)
+    partial = empty_partial()
+    for tiff_file in tiff_files:
+        try:
+            image = load_tiff_image(tiff_file)
+            with stage("compute", tiff_file):
+                accumulate(partial, image, frame_key(tiff_file))
+            print(f"Loaded : {tiff_file}")
+        except Exception as e:
+            print("*** Error ***")
+            print(f"Failed to load {tiff_file}: {e}")
+    return partial
+
+
+def composite_directory(indir, outfile, method="mean", max_memory=None, kappa=3.0, iters=5, tiff_files=None) :
+
+    if max_memory is not None:
+        with tempfile.TemporaryDirectory(prefix="composite_") as spill_dir:
+            frames = open_tiff_frames_from_directory(indir, spill_dir, tiff_files)
+            if not frames:
+                return None
+            # タイルごとにメモリマップから読むため、読み込みも compute に含まれる
+            with stage("compute") as record:
+                composite_image = composite_images_tiled(frames, method, max_memory, kappa, iters)
+                record.update(method=method, frames=len(frames))
+            del frames
+    else:
+        images = load_tiff_images_from_directory(indir, tiff_files)
+        if not images:
+            return None
+        with stage("compute") as record:
+            composite_image = composite_images(images, method, kappa, iters)
+            record.update(method=method, frames=len(images))
+
+    if composite_image is None:
+        return None
+    with stage("encode", outfile) as record:
+        imageio.imwrite(outfile, composite_image, format='TIFF')
+        record["bytes_written"] = file_size(outfile)
+    print(f"    Output : {outfile}")
+    return outfile
+
+
+def composite_main(args) :
+
+    tiff_files = list_tiff_files(args.indir)
+    thresholds = quality_thresholds(args)
+    if thresholds:
+        tiff_files = select_frames(tiff_files, thresholds)
+
+    tiff_files = [tiff_files[i] for i in shard_indices(len(tiff_files), args.shard)]
+
+    if args.partial is not None:
+        partial = stack_partial(tiff_files)
+        if partial["count"] == 0:
+            print("*** Error ***")
+            print("No valid images to composite.")
+            return
+        save_partial(args.partial, partial)
+        print(f"    Partial : {args.partial} ({partial['count']} frames)")
+        return
+
+    composite_directory(args.indir, args.outfile, args.method, args.max_memory, args.kappa, args.iters, tiff_files)
+
+
 def main() :
 
     parser = argparse.ArgumentParser(description="TIFF Image Composite Script")
     parser.add_argument("indir", help="Input directory containing 16bit TIFF files")
     parser.add_argument("-o", "--outfile", default="composite.tif", help="Output filename (default: composite.tif)")
-    parser.add_argument("-m", "--method", choices=["mean", "max", "min"], default="mean", help="Composite method")
+    parser.add_argument("-m", "--method", choices=METHODS, default="mean", help="Composite method")
+    parser.add_argument("--kappa", type=float, default=3.0, help="Rejection threshold in sigma for sigma-clip / winsorized (default: 3.0)")
+    parser.add_argument("--iters", type=int, default=5, help="Max rejection iterations for sigma-clip / winsorized (default: 5)")
+    parser.add_argument("--max-memory", type=parse_memory_size, default=None,
+                        help="Stack tile by tile from memory-mapped frames within this budget (e.g. 2G, 512M)")
 
-    args = parser.parse_args()
-    images = load_tiff_images_from_directory(args.indir)
+    parser.add_argument("--partial", default=None,
+                        help="Write a partial stack (.npz) of the frames instead of a TIFF; combine them with partial_stack.py "
+                             f"(-m {'|'.join(PARTIAL_METHODS)} only)")
+    parser.add_argument("--shard", type=parse_shard, default=None, help="Only use every N-th frame starting at K (K/N, e.g. 0/4)")
 
-    if images:
-        composite_image = composite_images(images, args.method)
-        if composite_image is not None:
-            imageio.imwrite(args.outfile, composite_image, format='TIFF')
-            print(f"    Output : {args.outfile}")
+    add_quality_arguments(parser)
+    add_instrument_arguments(parser)
+
+    args = parser.parse_args()
+    if args.kappa <= 0:
+        parser.error("--kappa must be positive")
+    if args.iters < 1:
+        parser.error("--iters must be at least 1")
+    if args.partial is not None:
+        # 部分スタックは合計・二乗和・最小・最大だけを持つため、マージ時に求められる方式に限る
+        if args.method not in PARTIAL_METHODS:
+            parser.error(f"-m {args.method} cannot be used with --partial (choose from {', '.join(PARTIAL_METHODS)}, "
+                         f"or std when merging with partial_stack.py)")
+        if args.max_memory is not None:
+            parser.error("--max-memory cannot be used with --partial (frames are accumulated one at a time)")
+    run_instrumented(args, composite_main, args)
 
 
 if __name__ == "__main__" :
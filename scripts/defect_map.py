@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import numpy as np
+import tifffile
+from batch import copy_to_output, list_inputs, modify_files
+
+# マスターダークからホットピクセルの座標だけを抜き出した欠陥マップ (.npz)。
+# 補正は欠陥画素の座標と周囲の画素だけをインデックスで参照し、周囲の同色画素の中央値で置き換える。
+#   RGB の TIFF (H, W, 3)   : チャンネルごとに判定し、同じチャンネルの 5x5 近傍で置き換え
+#   ベイヤー配列 (H, W)      : 2x2 の色位相ごとに判定し、2 画素おきの同色 8 近傍で置き換え
+
+DEFECT_VERSION = 1
+DEFAULT_SIGMA = 5.0
+TIFF_EXTENSIONS = (".tif", ".tiff")
+
+
+def color_planes(shape) :
+
+    # 統計を取る単位 (RGB はチャンネル、ベイヤー配列は 2x2 の色位相) のスライス
+    if len(shape) == 3:
+        return [(slice(None), slice(None), c) for c in range(shape[2])]
+    return [(slice(py, None, 2), slice(px, None, 2)) for py in range(2) for px in range(2)]
+
+
+def find_defects(dark, sigma=DEFAULT_SIGMA) :
+
+    # 中央値 + sigma * (MAD から求めた標準偏差) を超える画素の座標 (N, ndim) を返す
+    coords = []
+    for plane in color_planes(dark.shape):
+        values = np.asarray(dark[plane], dtype=np.float32)
+        median = np.median(values)
+        std = max(1.4826 * np.median(np.abs(values - median)), 1.0)
+        hits = np.nonzero(values > median + sigma * std)
+        # 平面内の座標を元画像の座標に戻す
+        full = [hits[0] * (plane[0].step or 1) + (plane[0].start or 0),
+                hits[1] * (plane[1].step or 1) + (plane[1].start or 0)]
+        if len(plane) == 3:
+            full.append(np.full(len(hits[0]), plane[2]))
+        coords.append(np.stack(full, axis=1))
+    coords = np.concatenate(coords).astype(np.int32)
+    # 行・列・チャンネル順に並べておく
+    return coords[np.lexsort(coords.T[::-1])]
+
+
+def make_defect_map(coords, shape, sigma=DEFAULT_SIGMA) :
+
+    defects = {"coords": np.asarray(coords, dtype=np.int32).reshape(-1, len(shape)),
+               "shape": tuple(int(v) for v in shape), "sigma": float(sigma)}
+    defects["neighbours"], defects["valid"] = neighbour_index(defects["coords"], defects["shape"])
+    return defects
+
+
+def build_defect_map(dark_path, sigma=DEFAULT_SIGMA) :
+
+    dark = tifffile.imread(dark_path)
+    if dark.ndim not in (2, 3):
+        raise ValueError(f"unsupported image shape {dark.shape}")
+    return make_defect_map(find_defects(dark, sigma), dark.shape, sigma)
+
+
+def neighbour_index(coords, shape) :
+
+    # 各欠陥画素の近傍座標 (ndim 個の (N, K) 配列) と、画像内かつ欠陥でない近傍のマスク (N, K)
+    if len(shape) == 3:
+        step, radius = 1, 2
+    else:
+        step, radius = 2, 1
+    offsets = [(dy * step, dx * step) for dy in range(-radius, radius + 1) for dx in range(-radius, radius + 1)
+               if dy or dx]
+    dy = np.array([o[0] for o in offsets], dtype=np.int64)
+    dx = np.array([o[1] for o in offsets], dtype=np.int64)
+
+    ys = coords[:, 0:1].astype(np.int64) + dy
+    xs = coords[:, 1:2].astype(np.int64) + dx
+    valid = (ys >= 0) & (ys < shape[0]) & (xs >= 0) & (xs < shape[1])
+    np.clip(ys, 0, shape[0] - 1, out=ys)
+    np.clip(xs, 0, shape[1] - 1, out=xs)
+    neighbours = [ys, xs]
+    if len(shape) == 3:
+        neighbours.append(np.broadcast_to(coords[:, 2:3].astype(np.int64), ys.shape))
+
+    # 近傍が欠陥画素自身の場合も中央値から除く
+    flat_defects = np.ravel_multi_index(tuple(coords.T.astype(np.int64)), shape)
+    flat_neighbours = np.ravel_multi_index(tuple(neighbours), shape)
+    valid &= ~np.isin(flat_neighbours, flat_defects)
+    return neighbours, valid
+
+
+def save_defect_map(path, defects) :
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, version=DEFECT_VERSION, coords=defects["coords"], shape=np.array(defects["shape"]),
+                 sigma=defects["sigma"])
+    os.replace(tmp_path, path)
+
+
+def load_defect_map(path) :
+
+    with np.load(path) as data:
+        return make_defect_map(data["coords"], tuple(data["shape"]), float(data["sigma"]))
+
+
+def correct_defects(image, defects) :
+
+    # 欠陥画素を同色近傍の中央値で置き換える (image をその場で書き換え、それ以外の画素には触れない)
+    # 戻り値は実際に置き換えた画素数 (近傍がすべて欠陥・画像外の画素は置き換えない)
+    if image.shape != defects["shape"]:
+        raise ValueError("shape mismatch with the defect map")
+    coords = defects["coords"]
+    if len(coords) == 0:
+        return 0
+
+    values = image[tuple(defects["neighbours"])].astype(np.float32)
+    valid = defects["valid"]
+    values[~valid] = np.nan
+    # 近傍がすべて欠陥・画像外の画素はそのまま残す
+    usable = valid.any(axis=1)
+    replaced = np.nanmedian(values[usable], axis=1)
+    if np.issubdtype(image.dtype, np.integer):
+        info = np.iinfo(image.dtype)
+        replaced = np.clip(np.rint(replaced), info.min, info.max)
+    image[tuple(coords[usable].T)] = replaced.astype(image.dtype)
+    return int(np.count_nonzero(usable))
+
+
+def correct_file(path, defects, output_dir=None) :
+
+    path = copy_to_output(path, output_dir)
+
+    # 非圧縮 TIFF はメモリマップして欠陥画素のあるページだけを書き換える
+    try:
+        image = tifffile.memmap(path, mode="r+")
+    except ValueError:
+        image = tifffile.imread(path)
+        corrected = correct_defects(image, defects)
+        tifffile.imwrite(path, image)
+    else:
+        corrected = correct_defects(image, defects)
+        image.flush()
+        del image
+    return path, corrected
+
+
+def correct_files(files, defects, output_dir=None, jobs=0) :
+
+    return modify_files(lambda path, out_dir: correct_file(path, defects, out_dir), files, output_dir, jobs,
+                        lambda corrected: f"{corrected}/{len(defects['coords'])} pixel(s) corrected")
+
+
+def list_files(inputs) :
+
+    return list_inputs(inputs, TIFF_EXTENSIONS)
+
+
+if __name__ == "__main__" :
+
+    parser = argparse.ArgumentParser(description="Hot-pixel map built from a master dark, applied by replacing only the listed pixels.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p_build = subparsers.add_parser("build", help="Find hot pixels in a master dark (RGB TIFF or CFA mosaic from raw_calibration.py)")
+    p_build.add_argument("dark", help="Master dark frame")
+    p_build.add_argument("-o", "--outfile", default="defects.npz", help="Output filename (default: defects.npz)")
+    p_build.add_argument("--sigma", type=float, default=DEFAULT_SIGMA,
+                         help=f"Threshold above the median in robust standard deviations (default: {DEFAULT_SIGMA})")
+
+    p_apply = subparsers.add_parser("apply", help="Replace the defect pixels of TIFF files with the median of their neighbours")
+    p_apply.add_argument("defects", help="Defect map (.npz)")
+    p_apply.add_argument("inputs", nargs="+", help="TIFF files or directories")
+    p_apply.add_argument("-o", "--output-dir", default=None, help="Copy the files here first and modify the copies")
+    p_apply.add_argument("--in-place", action="store_true", help="Modify the input files themselves (no backup copies)")
+    p_apply.add_argument("-j", "--jobs", type=int, default=0, help="Number of threads (0: all cores, default: 0)")
+
+    args = parser.parse_args()
+    if args.command == "apply" and (args.output_dir is None) == (not args.in_place):
+        parser.error("give either -o/--output-dir or --in-place (apply does not rewrite the inputs unless asked)")
+
+    if args.command == "build":
+        defects = build_defect_map(args.dark, args.sigma)
+        save_defect_map(args.outfile, defects)
+        total = int(np.prod(defects["shape"]))
+        print(f"{len(defects['coords'])} defect pixel(s) ({100.0 * len(defects['coords']) / total:.4f} %)")
+        print(f"    Output : {args.outfile}")
+    else:
+        files = list_files(args.inputs)
+        if not files:
+            print("*** No TIFF files found.")
+        else:
+            failed = correct_files(files, load_defect_map(args.defects), args.output_dir, args.jobs)
+            print(f"\n{len(files) - failed}/{len(files)} file(s) processed.")
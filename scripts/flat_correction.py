@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 
 import os
+import time
 import argparse
+from functools import partial
 import numpy as np
 import imageio.v2 as imageio
 from glob import glob
 from tifffile import imwrite
+from tiff_io import open_tiff, create_tiff, row_blocks
+from batch import SHARED, map_ordered, resolve_jobs, shared_arrays
+from instrument import stage, file_size, add_instrument_arguments, run_instrumented
 
 def correct_image(image, flat_r, flat_g, flat_b):
     image = image.astype(np.float32)
@@ -21,27 +26,108 @@ def normalize_flat(flat_image, channel_index):
     return channel / np.max(channel)
 
 
-def process_images(input_dir, output_dir, flat_r_path, flat_g_path, flat_b_path):
+def correct_image_low_memory(path, out_path, flats, block_rows=256):
+    # flats : [(メモリマップした flat 画像, チャンネル最大値), ...] (R, G, B)
+    image = open_tiff(path)
+    out = create_tiff(out_path, image.shape, np.uint16)
+    for rows in row_blocks(image.shape[0], block_rows):
+        block = image[rows].astype(np.float32)
+        for c, (flat_image, flat_max) in enumerate(flats):
+            block[..., c] /= flat_image[rows, :, c].astype(np.float32) / flat_max
+        np.clip(block, 0, 65535, out=block)
+        out[rows] = block
+    out.flush()
+    del out
+
+
+def correct_image_model(path, out_path, model, block_rows=256):
+    # flat_model.py のモデルを行ブロックごとに評価して補正する (フルサイズのフラットは読まない)
+    from flat_model import CHANNELS, evaluate_flat_model
+
+    image = open_tiff(path)
+    height, width = image.shape[:2]
+    if (height, width) != (model["height"], model["width"]):
+        raise ValueError(f"shape mismatch with flat model ({model['width']}x{model['height']})")
+    out = create_tiff(out_path, image.shape, np.uint16)
+    for rows in row_blocks(height, block_rows):
+        block = image[rows].astype(np.float32)
+        for c, color in enumerate(CHANNELS):
+            block[..., c] /= evaluate_flat_model(model, color, rows)
+        np.clip(block, 0, 65535, out=block)
+        out[rows] = block
+    out.flush()
+    del out
+
+
+def open_flats_low_memory(flat_r_path, flat_g_path, flat_b_path):
+    flats = []
+    for c, flat_path in enumerate([flat_r_path, flat_g_path, flat_b_path]):
+        flat_image = open_tiff(flat_path)
+        flats.append((flat_image, np.max(flat_image[..., c])))
+    return flats
+
+
+def correct_file(path, output_dir, flat_paths=None, low_memory=False, block_rows=256, model=None):
+    start = time.perf_counter()
+    out_path = os.path.join(output_dir, os.path.basename(path))
+
+    if model is not None or low_memory:
+        # 行ブロック単位で読み書きするため decode / encode は分けずに記録
+        with stage("compute", path) as record:
+            if model is not None:
+                correct_image_model(path, out_path, model, block_rows)
+            else:
+                if "flats" not in SHARED:
+                    SHARED["flats"] = open_flats_low_memory(*flat_paths)
+                correct_image_low_memory(path, out_path, SHARED["flats"], block_rows)
+            record.update(bytes_read=file_size(path), bytes_written=file_size(out_path))
+    else:
+        with stage("decode", path) as record:
+            image = imageio.imread(path).astype(np.float32)
+            record["bytes_read"] = file_size(path)
+        with stage("compute", path):
+            corrected = correct_image(image, SHARED["flat_r"], SHARED["flat_g"], SHARED["flat_b"])
+        with stage("encode", path) as record:
+            imwrite(out_path, corrected)
+            record["bytes_written"] = file_size(out_path)
+    return time.perf_counter() - start
+
+
+def process_images(input_dir, output_dir, flat_r_path, flat_g_path, flat_b_path, low_memory=False, block_rows=256, jobs=1, model_path=None):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
     files = sorted(glob(os.path.join(input_dir, "*.tif")))
     #print(f"Found {len(files)} files.")
+    jobs = resolve_jobs(jobs)
 
-    flat_r_image = imageio.imread(flat_r_path)
-    flat_g_image = imageio.imread(flat_g_path)
-    flat_b_image = imageio.imread(flat_b_path)
+    model = None
+    if model_path is not None:
+        from flat_model import load_flat_model
+        model = load_flat_model(model_path)
 
-    flat_r = normalize_flat(flat_r_image, 0)  # Red
-    flat_g = normalize_flat(flat_g_image, 1)  # Green
-    flat_b = normalize_flat(flat_b_image, 2)  # Blue
+    shared = {}
+    if model is None and not low_memory:
+        flat_r_image = imageio.imread(flat_r_path)
+        flat_g_image = imageio.imread(flat_g_path)
+        flat_b_image = imageio.imread(flat_b_path)
 
-    for path in files:
-        print(f"    Processing {os.path.basename(path)} ...")
-        image = imageio.imread(path).astype(np.float32)
-        corrected = correct_image(image, flat_r, flat_g, flat_b)
-        out_path = os.path.join(output_dir, os.path.basename(path))
-        imwrite(out_path, corrected)
+        shared["flat_r"] = normalize_flat(flat_r_image, 0)  # Red
+        shared["flat_g"] = normalize_flat(flat_g_image, 1)  # Green
+        shared["flat_b"] = normalize_flat(flat_b_image, 2)  # Blue
+        del flat_r_image, flat_g_image, flat_b_image
+
+    worker = partial(correct_file, output_dir=output_dir, flat_paths=(flat_r_path, flat_g_path, flat_b_path),
+                     low_memory=low_memory, block_rows=block_rows, model=model)
+
+    with shared_arrays(shared, jobs) as (initializer, initargs):
+        for path, elapsed, error in map_ordered(worker, files, jobs, initializer=initializer, initargs=initargs):
+            print(f"    Processing {os.path.basename(path)} ...")
+            if error is not None:
+                print(f"    *** Failed {path}: {error}")
+                continue
+            print(f"        {elapsed * 1000:.0f} ms")
+    SHARED.pop("flats", None)
 
 
 if __name__ == "__main__" :
@@ -49,9 +135,18 @@ if __name__ == "__main__" :
     parser = argparse.ArgumentParser(description="Flat-field correction for RGB 16bit TIFF images.")
     parser.add_argument("input_dir", help="Input directory with TIFF images")
     parser.add_argument("output_dir", help="Output directory for corrected TIFF images")
-    parser.add_argument("--flat_r", required=True, help="Flat-field image for Red channel")
-    parser.add_argument("--flat_g", required=True, help="Flat-field image for Green channel")
-    parser.add_argument("--flat_b", required=True, help="Flat-field image for Blue channel")
+    parser.add_argument("--flat_r", default=None, help="Flat-field image for Red channel")
+    parser.add_argument("--flat_g", default=None, help="Flat-field image for Green channel")
+    parser.add_argument("--flat_b", default=None, help="Flat-field image for Blue channel")
+    parser.add_argument("--model", default=None, help="Vignetting model made by flat_model.py (used instead of --flat_r/g/b)")
+    parser.add_argument("--low-memory", action="store_true", help="Memory-map the TIFFs and correct in row blocks")
+    parser.add_argument("--block-rows", type=int, default=256, help="Rows per block in --low-memory mode (default: 256)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes (0: all cores, default: 1)")
+    add_instrument_arguments(parser)
     args = parser.parse_args()
 
-    process_images(args.input_dir, args.output_dir, args.flat_r, args.flat_g, args.flat_b)
+    if args.model is None and not (args.flat_r and args.flat_g and args.flat_b):
+        parser.error("--flat_r, --flat_g and --flat_b are required unless --model is given")
+
+    run_instrumented(args, process_images, args.input_dir, args.output_dir, args.flat_r, args.flat_g, args.flat_b,
+                     args.low_memory, args.block_rows, args.jobs, args.model)
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import json
+import argparse
+import numpy as np
+import cv2
+from numpy.polynomial import polynomial
+from tiff_io import open_tiff
+from flat_correction import normalize_flat
+
+CHANNELS = ["r", "g", "b"]
+
+
+def normalized_coords(n, length, size) :
+
+    # length 画素を n 点でサンプルした各点の座標 (画像中心を原点、長辺の半分を 1 とする)
+    centers = (np.arange(n, dtype=np.float64) + 0.5) * (length / n)
+    return (centers - length / 2.0) / (max(size) / 2.0)
+
+
+def fit_channel(flat_small, degree, size) :
+
+    h, w = flat_small.shape
+    v, u = np.meshgrid(normalized_coords(h, size[0], size), normalized_coords(w, size[1], size), indexing="ij")
+    terms = [(i, j) for i in range(degree + 1) for j in range(degree + 1 - i)]
+    design = np.stack([u.ravel() ** i * v.ravel() ** j for i, j in terms], axis=1)
+    solution = np.linalg.lstsq(design, flat_small.ravel().astype(np.float64), rcond=None)[0]
+
+    coeffs = np.zeros((degree + 1, degree + 1))
+    for (i, j), c in zip(terms, solution):
+        coeffs[i, j] = c
+    rms = float(np.sqrt(np.mean((design @ solution - flat_small.ravel()) ** 2)))
+    return coeffs, rms
+
+
+def fit_flat_model(flat_paths, degree=4, factor=32) :
+
+    model = {"type": "poly2d", "degree": degree, "channels": {}}
+    for c, (color, flat_path) in enumerate(zip(CHANNELS, flat_paths)):
+        flat_image = open_tiff(flat_path)
+        h, w = flat_image.shape[:2]
+        small = cv2.resize(np.ascontiguousarray(flat_image[..., c]), (max(w // factor, 1), max(h // factor, 1)),
+                           interpolation=cv2.INTER_AREA)
+        flat_small = normalize_flat(small[..., np.newaxis], 0)
+        coeffs, rms = fit_channel(flat_small, degree, (h, w))
+        model["channels"][color] = coeffs.tolist()
+        model["width"], model["height"] = w, h
+        print(f"    {color.upper()} : rms residual = {rms:.5f}")
+    return model
+
+
+def save_flat_model(path, model) :
+
+    with open(path, "w") as f:
+        json.dump(model, f, indent=1)
+
+
+def load_flat_model(path) :
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def evaluate_flat_model(model, color, rows) :
+
+    # rows : slice (行ブロック) -> shape (行数, 幅) の float32 フラット
+    height, width = model["height"], model["width"]
+    u = normalized_coords(width, width, (height, width))
+    v = normalized_coords(height, height, (height, width))[rows]
+    surface = polynomial.polygrid2d(u, v, np.array(model["channels"][color])).T
+    return surface.astype(np.float32)
+
+
+if __name__ == "__main__" :
+
+    parser = argparse.ArgumentParser(description="Fit a smooth per-channel vignetting model to flat frames.")
+    parser.add_argument("output", help="Output model file (JSON)")
+    parser.add_argument("--flat_r", required=True, help="Flat-field image for Red channel")
+    parser.add_argument("--flat_g", required=True, help="Flat-field image for Green channel")
+    parser.add_argument("--flat_b", required=True, help="Flat-field image for Blue channel")
+    parser.add_argument("--degree", type=int, default=4, help="Polynomial degree (default: 4)")
+    parser.add_argument("--factor", type=int, default=32, help="Downsampling factor before fitting (default: 32)")
+    args = parser.parse_args()
+
+    model = fit_flat_model([args.flat_r, args.flat_g, args.flat_b], args.degree, args.factor)
+    save_flat_model(args.output, model)
+    print(f"    Output : {args.output}")
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import argparse
+from functools import partial
+from glob import glob
+import numpy as np
+import cv2
+from tifffile import imread
+from batch import map_ordered, resolve_jobs
+
+QUALITY_NAME = "frame_quality.json"
+
+
+def measure_frame(path, factor=4, nsigma=5.0, radius=4, max_stars=200):
+    image = imread(path)
+    gray = np.mean(image, axis=2, dtype=np.float32) if image.ndim == 3 else image.astype(np.float32)
+    h, w = gray.shape
+    small = cv2.resize(gray, (max(w // factor, 1), max(h // factor, 1)), interpolation=cv2.INTER_AREA)
+    del image, gray
+
+    background = float(np.median(small))
+    noise = float(1.4826 * np.median(np.abs(small - background)))
+    signal = small - background
+
+    smooth = cv2.GaussianBlur(signal, (0, 0), 1.0)
+    local_max = cv2.dilate(smooth, np.ones((2 * radius + 1, 2 * radius + 1), np.uint8))
+    peaks = (smooth == local_max) & (smooth > nsigma * max(noise, 1e-6))
+    peaks[:radius, :] = peaks[-radius:, :] = False
+    peaks[:, :radius] = peaks[:, -radius:] = False
+    ys, xs = np.nonzero(peaks)
+    result = {"background": background, "noise": noise, "stars": int(len(ys)), "fwhm": None, "eccentricity": None}
+    order = np.argsort(smooth[ys, xs])[::-1][:max_stars]
+    ys, xs = ys[order], xs[order]
+
+    if len(ys) == 0:
+        return result
+
+    # 全ての星の切り出しをまとめて2次モーメントを計算
+    dy, dx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+    stamps = np.clip(signal[ys[:, None, None] + dy, xs[:, None, None] + dx], 0, None)
+    m0 = np.maximum(stamps.sum(axis=(1, 2)), 1e-6)
+    cx = (stamps * dx).sum(axis=(1, 2)) / m0
+    cy = (stamps * dy).sum(axis=(1, 2)) / m0
+    mxx = (stamps * (dx - cx[:, None, None]) ** 2).sum(axis=(1, 2)) / m0
+    myy = (stamps * (dy - cy[:, None, None]) ** 2).sum(axis=(1, 2)) / m0
+    mxy = (stamps * (dx - cx[:, None, None]) * (dy - cy[:, None, None])).sum(axis=(1, 2)) / m0
+    spread = np.sqrt(((mxx - myy) / 2) ** 2 + mxy ** 2)
+    major = np.maximum((mxx + myy) / 2 + spread, 1e-6)
+    minor = np.maximum((mxx + myy) / 2 - spread, 0)
+
+    result["fwhm"] = float(np.median(2.3548 * np.sqrt((major + minor) / 2)) * factor)
+    result["eccentricity"] = float(np.median(np.sqrt(1 - minor / major)))
+    return result
+
+
+def load_quality_table(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Warning: ignoring unreadable {path}: {e}")
+        return {}
+
+
+def save_quality_table(path, table):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(table, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def score_frames(files, table_file=None, factor=4, jobs=1):
+    # 結果はファイルのサイズ・更新時刻と共にキャッシュし、変更のないフレームは再計算しない
+    if table_file is None:
+        table_file = os.path.join(os.path.dirname(files[0]), QUALITY_NAME)
+    table = load_quality_table(table_file)
+
+    todo = []
+    for path in files:
+        st = os.stat(path)
+        entry = table.get(os.path.basename(path))
+        if entry is None or entry.get("size") != st.st_size or entry.get("mtime_ns") != st.st_mtime_ns or entry.get("factor") != factor:
+            todo.append(path)
+
+    if todo:
+        print(f"    Measuring quality of {len(todo)} frame(s) ...")
+    worker = partial(measure_frame, factor=factor)
+    for path, metrics, error in map_ordered(worker, todo, resolve_jobs(jobs)):
+        if error is not None:
+            print(f"*** Failed to measure {os.path.basename(path)}: {error}")
+            continue
+        st = os.stat(path)
+        metrics.update(size=st.st_size, mtime_ns=st.st_mtime_ns, factor=factor)
+        table[os.path.basename(path)] = metrics
+    if todo:
+        save_quality_table(table_file, table)
+
+    return {path: table[os.path.basename(path)] for path in files if os.path.basename(path) in table}
+
+
+def add_quality_arguments(parser):
+    group = parser.add_argument_group("frame rejection")
+    group.add_argument("--min-stars", type=int, default=None, help="Reject frames with fewer detected stars")
+    group.add_argument("--max-fwhm", type=float, default=None, help="Reject frames whose median FWHM (px) is larger")
+    group.add_argument("--max-eccentricity", type=float, default=None, help="Reject frames whose median star eccentricity is larger")
+    group.add_argument("--max-background", type=float, default=None, help="Reject frames whose background level is higher")
+    group.add_argument("--reject-worst", type=float, default=None, help="Reject this percentage of frames with the largest FWHM")
+    return group
+
+
+def quality_thresholds(args):
+    thresholds = {key: getattr(args, key) for key in ["min_stars", "max_fwhm", "max_eccentricity", "max_background", "reject_worst"]}
+    return thresholds if any(v is not None for v in thresholds.values()) else None
+
+
+def select_frames(files, thresholds, jobs=1):
+    if not thresholds or not files:
+        return files
+
+    scores = score_frames(files, jobs=jobs)
+    fwhm_limit = thresholds.get("max_fwhm")
+    if thresholds.get("reject_worst"):
+        values = [s["fwhm"] for s in scores.values() if s["fwhm"] is not None]
+        if values:
+            limit = float(np.percentile(values, 100 - thresholds["reject_worst"]))
+            fwhm_limit = limit if fwhm_limit is None else min(fwhm_limit, limit)
+
+    accepted = []
+    for path in files:
+        s = scores.get(path)
+        reasons = []
+        if s is None:
+            reasons.append("not measured")
+        else:
+            if thresholds.get("min_stars") is not None and s["stars"] < thresholds["min_stars"]:
+                reasons.append(f"stars {s['stars']}")
+            if fwhm_limit is not None and (s["fwhm"] is None or s["fwhm"] > fwhm_limit):
+                reasons.append(f"fwhm {s['fwhm']:.2f}" if s["fwhm"] is not None else "no stars")
+            if thresholds.get("max_eccentricity") is not None and (s["eccentricity"] is None or s["eccentricity"] > thresholds["max_eccentricity"]):
+                reasons.append(f"eccentricity {s['eccentricity']:.2f}" if s["eccentricity"] is not None else "no stars")
+            if thresholds.get("max_background") is not None and s["background"] > thresholds["max_background"]:
+                reasons.append(f"background {s['background']:.0f}")
+        if reasons:
+            print(f"    Rejected {os.path.basename(path)} : {', '.join(reasons)}")
+        else:
+            accepted.append(path)
+
+    print(f"    Quality : {len(accepted)}/{len(files)} frames accepted.")
+    return accepted
+
+
+if __name__ == "__main__" :
+
+    parser = argparse.ArgumentParser(description="Measure per-frame quality (background, noise, stars, FWHM, eccentricity).")
+    parser.add_argument("input_dir", help="Directory with TIFF images")
+    parser.add_argument("--factor", type=int, default=4, help="Downsampling factor for measurement (default: 4)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of processes (0: all cores, default: 1)")
+    add_quality_arguments(parser)
+    args = parser.parse_args()
+
+    files = sorted(glob(os.path.join(args.input_dir, "*.tif")))
+    if not files:
+        print("*** No TIFF files found.")
+    else:
+        scores = score_frames(files, factor=args.factor, jobs=args.jobs)
+        print(f"{'file':30s} {'bkg':>8s} {'noise':>7s} {'stars':>6s} {'fwhm':>6s} {'ecc':>5s}")
+        for path, s in scores.items():
+            fwhm = f"{s['fwhm']:6.2f}" if s["fwhm"] is not None else f"{'-':>6s}"
+            ecc = f"{s['eccentricity']:5.2f}" if s["eccentricity"] is not None else f"{'-':>5s}"
+            print(f"{os.path.basename(path):30s} {s['background']:8.1f} {s['noise']:7.1f} {s['stars']:6d} {fwhm} {ecc}")
+        thresholds = quality_thresholds(args)
+        if thresholds:
+            select_frames(files, thresholds, args.jobs)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import resource
+import threading
+from contextlib import contextmanager
+
+# 各フレーム・各段 (decode / compute / warp / encode) の処理時間・入出力バイト数・最大 RSS を
+# JSON Lines で記録する。出力先は環境変数で子プロセス (spawn) にも引き継ぐ。
+
+TRACE_ENV = "ASTRO_TRACE"
+
+_lock = threading.Lock()
+
+
+def configure(trace_path) :
+
+    if trace_path:
+        os.environ[TRACE_ENV] = os.path.abspath(trace_path)
+    else:
+        os.environ.pop(TRACE_ENV, None)
+
+
+def enabled() :
+
+    return bool(os.environ.get(TRACE_ENV))
+
+
+def peak_rss_mb() :
+
+    # ru_maxrss は Linux では KiB 単位
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def write_record(record) :
+
+    path = os.environ.get(TRACE_ENV)
+    if not path:
+        return
+    line = json.dumps(record, sort_keys=True) + "\n"
+    # 1行を1回の write で追記する (複数プロセス・スレッドから同じファイルに書く)
+    with _lock:
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        try:
+            os.write(fd, line.encode())
+        finally:
+            os.close(fd)
+
+
+@contextmanager
+def stage(name, frame=None) :
+
+    # with stage("decode", path) as record: record["bytes_read"] = ... のように値を追加できる
+    record = {}
+    if not enabled():
+        yield record
+        return
+    start, cpu_start = time.perf_counter(), time.thread_time()
+    try:
+        yield record
+    finally:
+        record.update(stage=name, seconds=round(time.perf_counter() - start, 6),
+                      cpu_seconds=round(time.thread_time() - cpu_start, 6), peak_rss_mb=round(peak_rss_mb(), 1),
+                      script=os.path.basename(sys.argv[0]), pid=os.getpid(), time=time.time())
+        if frame is not None:
+            record["frame"] = os.path.basename(frame)
+        write_record(record)
+
+
+def file_size(path) :
+
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+
+def add_instrument_arguments(parser) :
+
+    group = parser.add_argument_group("instrumentation")
+    group.add_argument("--trace", default=None, help="Append per-frame / per-stage timing records to this JSON Lines file")
+    group.add_argument("--profile", default=None, help="Run under cProfile and save the statistics to this file")
+    return group
+
+
+def run_instrumented(args, func, *func_args, **func_kwargs) :
+
+    configure(args.trace)
+    with stage("total"):
+        if not args.profile:
+            return func(*func_args, **func_kwargs)
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(func, *func_args, **func_kwargs)
+        finally:
+            profiler.dump_stats(args.profile)
+            print(f"\n    Profile : {args.profile}")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(20)
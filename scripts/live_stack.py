@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import argparse
+from glob import glob
+import numpy as np
+import rawpy
+from tifffile import imwrite
+from nef2tif_with_NR import DECODE_PARAMS, postprocess_raw
+from calibrate import load_calibration, calibrate_frame
+from defect_map import load_defect_map
+from alignment_loader import load_alignment
+from tiff_io import frame_hash
+from partial_stack import frame_key
+
+# 撮影中に届く NEF を1枚ずつ 現像 -> ダーク減算・フラット補正 -> 基準フレームへ位置合わせ -> 積算 する。
+# チェックポイントには 積算値 (uint32)・枚数・処理済みフレーム・基準フレームのキーだけを保存し、
+# 再起動時は続きから処理する。基準フレームの輝度は保存せず、再起動時に基準の NEF から作り直す。
+# uint16 のフレームの合計は 65537 枚まで uint32 で誤差なく求まり、24MP RGB で1回の書き込みは約 288 MB。
+
+CHECKPOINT_NAME = "live_stack.npz"
+PREVIEW_NAME = "live_composite.tif"
+CHECKPOINT_VERSION = 2
+
+
+def empty_stack():
+    return {"sum": None, "count": 0, "frames": {}, "registered_to": None, "reference": None}
+
+
+def load_checkpoint(path):
+    if not os.path.exists(path):
+        return empty_stack()
+    with np.load(path) as data:
+        stack = empty_stack()
+        stack["sum"] = data["sum"]
+        if stack["sum"].dtype != np.uint32:
+            # 以前の形式 (float64 の部分スタック + 基準フレームの輝度)
+            stack["sum"] = np.rint(stack["sum"]).astype(np.uint32)
+            stack["reference"] = data["reference"] if "reference" in data.files else None
+        stack["count"] = int(data["count"])
+        stack["registered_to"] = json.loads(str(data["registered_to"]))
+        stack["frames"] = json.loads(str(data["state"]))["frames"]
+    return stack
+
+
+def save_checkpoint(path, stack):
+    # 積算値と処理済みリストを1ファイルにまとめて rename で置き換える (途中で落ちても二重加算しない)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, version=CHECKPOINT_VERSION, sum=stack["sum"], count=stack["count"],
+                 registered_to=np.array(json.dumps(stack["registered_to"])),
+                 state=np.array(json.dumps({"frames": stack["frames"]})))
+    os.replace(tmp_path, path)
+
+
+def save_preview(path, stack):
+    imwrite(path + ".tmp", (stack["sum"] / stack["count"]).astype(np.uint16))
+    os.replace(path + ".tmp", path)
+
+
+def accumulate(stack, frame):
+    if stack["sum"] is None:
+        stack["sum"] = np.zeros(frame.shape, dtype=np.uint32)
+    elif frame.shape != stack["sum"].shape:
+        raise ValueError("shape mismatch")
+    np.add(stack["sum"], frame, out=stack["sum"])
+    stack["count"] += 1
+
+
+def new_files(watch_dir, frames, settle):
+    # 書き込み途中のファイルを避けるため、更新から settle 秒経ったものだけを対象にする
+    now = time.time()
+    return [path for path in sorted(glob(os.path.join(watch_dir, "*.NEF")))
+            if os.path.basename(path) not in frames and now - os.path.getmtime(path) >= settle]
+
+
+def develop_frame(path, dark=None, flat=None, defects=None):
+    with rawpy.imread(path) as raw:
+        rgb = postprocess_raw(raw, DECODE_PARAMS)
+    if (dark is not None and rgb.shape != dark.shape) or (flat is not None and rgb.shape != flat.shape) \
+            or (defects is not None and rgb.shape != defects["shape"]):
+        raise ValueError("shape mismatch with the calibration frames")
+    return calibrate_frame(rgb, dark, flat, defects)
+
+
+def register_frame(alignment, gray, reference, register, box_size, cache):
+    if register == "phase":
+        dx, dy, response = alignment.phase_shift(reference, gray)
+        print(f"    (dx, dy) = {dx:.2f}, {dy:.2f} (response {response:.3f})")
+        return np.array([[1.0, 0.0, -dx], [0.0, 1.0, -dy]]), {"response": response}
+
+    if "ref_stars" not in cache:
+        cache["ref_stars"] = alignment.detect_stars(reference, box_size)
+        print(f"    {len(cache['ref_stars'])} stars detected in reference frame.")
+    matrix, n_matched, residual = alignment.match_stars(cache["ref_stars"], alignment.detect_stars(gray, box_size))
+    if matrix is None:
+        return None, {}
+    print(f"    {n_matched} stars matched (rms {residual:.2f} px)")
+    return matrix, {"residual": residual}
+
+
+def load_reference(watch_dir, stack, dark, flat, defects):
+    # 再起動時は、チェックポイントに記録した基準フレームを現像し直して輝度を作る
+    name = stack["registered_to"].rsplit(":", 1)[0]
+    path = os.path.join(watch_dir, name)
+    if not os.path.exists(path) or frame_key(path) != stack["registered_to"]:
+        raise RuntimeError(f"reference frame {name} is missing or changed in {watch_dir}")
+    frame = develop_frame(path, dark, flat, defects)
+    return np.mean(frame, axis=2, dtype=np.float32)
+
+
+def process_frame(path, stack, alignment, dark, flat, defects, register, box_size, cache):
+    frame = develop_frame(path, dark, flat, defects)
+    gray = np.mean(frame, axis=2, dtype=np.float32)
+    digest = frame_hash(path)
+    entry = {"size": os.path.getsize(path), "hash": digest}
+
+    if stack["reference"] is None:
+        # 最初に届いたフレームを基準にする
+        stack["reference"] = gray
+        stack["registered_to"] = frame_key(path, digest)
+        aligned = frame
+        entry["reference"] = True
+    else:
+        if gray.shape != stack["reference"].shape:
+            raise ValueError("shape mismatch with the reference frame")
+        matrix, info = register_frame(alignment, gray, stack["reference"], register, box_size, cache)
+        if matrix is None:
+            raise RuntimeError("registration failed")
+        entry.update(info, matrix=matrix.tolist())
+        h, w = gray.shape
+        aligned = alignment.warp_frame(frame, matrix, w, h)
+
+    accumulate(stack, aligned)
+    return entry
+
+
+def watch(watch_dir, work_dir, dark_path=None, flat_paths=(None, None, None), register="auto", box_size=50,
+          interval=10.0, settle=5.0, once=False, defects_path=None, checkpoint_every=1):
+
+    os.makedirs(work_dir, exist_ok=True)
+    checkpoint = os.path.join(work_dir, CHECKPOINT_NAME)
+    preview = os.path.join(work_dir, PREVIEW_NAME)
+    stack = load_checkpoint(checkpoint)
+    if stack["count"]:
+        print(f"    Resuming : {stack['count']} frame(s) stacked, {len(stack['frames'])} processed")
+
+    alignment = load_alignment()
+    defects = load_defect_map(defects_path) if defects_path is not None else None
+    dark, flat = load_calibration(dark_path, *flat_paths, defects)
+    if stack["registered_to"] is not None and stack["reference"] is None:
+        stack["reference"] = load_reference(watch_dir, stack, dark, flat, defects)
+    cache = {}
+    # 最後に保存してから積算したフレーム数 (保存前に落ちたフレームは再起動時に処理し直す)
+    pending = 0
+
+    print(f"Watching {watch_dir} (Ctrl-C to stop)")
+    try:
+        while True:
+            files = new_files(watch_dir, stack["frames"], settle)
+            for path in files:
+                name = os.path.basename(path)
+                print(f"\n[{len(stack['frames']) + 1}] {name}")
+                start = time.perf_counter()
+                try:
+                    entry = process_frame(path, stack, alignment, dark, flat, defects, register, box_size, cache)
+                    entry["status"] = "ok"
+                except Exception as e:
+                    print(f"*** Skipping: {e}")
+                    entry = {"status": "failed", "error": str(e)}
+                stack["frames"][name] = entry
+                pending += 1
+                if stack["count"] and pending >= checkpoint_every:
+                    save_checkpoint(checkpoint, stack)
+                    save_preview(preview, stack)
+                    pending = 0
+                print(f"    {stack['count']} frame(s) stacked ({(time.perf_counter() - start):.1f} s)")
+
+            if once and not files:
+                break
+            if not files:
+                time.sleep(interval)
+    except KeyboardInterrupt:
+        print("\nStopped.")
+
+    # Ctrl-C が積算と記録の間に入った場合は、最後のチェックポイントのままにする (再起動時に処理し直す)
+    stacked = sum(entry["status"] == "ok" for entry in stack["frames"].values())
+    if stack["count"] and pending and stacked == stack["count"]:
+        save_checkpoint(checkpoint, stack)
+        save_preview(preview, stack)
+    if stack["count"]:
+        print(f"    Output : {preview} ({stack['count']} frames)")
+
+
+if __name__ == "__main__" :
+
+    parser = argparse.ArgumentParser(description="Watch a directory for new NEF files and stack them as they arrive.")
+    parser.add_argument("watch_dir", help="Directory where the camera writes NEF files")
+    parser.add_argument("work_dir", help=f"Directory for the checkpoint ({CHECKPOINT_NAME}) and the current stack ({PREVIEW_NAME})")
+    parser.add_argument("--dark", default=None, help="Master dark frame of the light frames (16-bit TIFF)")
+    parser.add_argument("--flat_r", default=None, help="Flat-field image for Red channel")
+    parser.add_argument("--flat_g", default=None, help="Flat-field image for Green channel")
+    parser.add_argument("--flat_b", default=None, help="Flat-field image for Blue channel")
+    parser.add_argument("--defects", default=None, help="Defect map from defect_map.py (hot pixels replaced before dark subtraction)")
+    parser.add_argument("--register", choices=["auto", "phase"], default="auto",
+                        help="auto: automatic star matching, phase: FFT phase correlation (default: auto)")
+    parser.add_argument("--box", type=int, default=50, help="Box size for star region (default: 50)")
+    parser.add_argument("--interval", type=float, default=10.0, help="Polling interval in seconds (default: 10)")
+    parser.add_argument("--settle", type=float, default=5.0, help="Wait until a file is unchanged for this many seconds (default: 5)")
+    parser.add_argument("--once", action="store_true", help="Process the files already present and exit")
+    parser.add_argument("--checkpoint-every", type=int, default=1,
+                        help="Save the checkpoint and the current stack every N frames (default: 1)")
+    args = parser.parse_args()
+
+    flats = [args.flat_r, args.flat_g, args.flat_b]
+    if any(flats) and not all(flats):
+        parser.error("--flat_r, --flat_g and --flat_b must be given together")
+
+    print("BEGIN :: live stack")
+    watch(args.watch_dir, args.work_dir, args.dark, flats, args.register, args.box, args.interval, args.settle, args.once, args.defects,
+          args.checkpoint_every)
+    print("END :: live stack")
@@ -1,29 +1,57 @@
 #!/usr/bin/env python3
 
 import matplotlib
-matplotlib.use('TkAgg')
+import os
 import argparse
 import tifffile
 import numpy as np
 import cv2
-import matplotlib.pyplot as plt
-import tkinter as tk
-from tkinter import ttk
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
+
+COLOR_MAP = {'r': 0, 'g': 1, 'b': 2}
+
+
+def percentile_from_counts(counts, q):
+    # np.percentile (linear) と同じ値をヒストグラムから求める
+    cdf = np.cumsum(counts)
+    pos = q / 100.0 * (cdf[-1] - 1)
+    lo, hi = int(np.floor(pos)), int(np.ceil(pos))
+    v_lo = np.searchsorted(cdf, lo, side='right')
+    v_hi = np.searchsorted(cdf, hi, side='right')
+    return v_lo + (pos - lo) * (v_hi - v_lo)
+
+
+def scale_channel(channel, scale_factor):
+    return (channel * scale_factor).clip(0, 65535).astype(np.uint16)
+
+
+def save_channel_image(output_file, image, channel, corrected):
+    output = np.zeros_like(image)
+    output[:, :, channel] = corrected
+    tifffile.imwrite(output_file, output)
+    print(f"    Output : '{output_file}'")
 
 
 class ExposureAdjuster:
     def __init__(self, image, color_channel, output_file):
+        # Tk のバックエンドは GUI を開くときだけ読み込む (main_batch は pipeline.py からも呼ばれる)
+        matplotlib.use('TkAgg')
+        import matplotlib.pyplot as plt
+        import tkinter as tk
+        from tkinter import ttk
+        from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+
         self.output_file = output_file
         self.original = image
-        self.modified = np.zeros_like(image)
-        self.color_map = {'r': 0, 'g': 1, 'b': 2}
+        self.color_map = COLOR_MAP
         self.channel = self.color_map[color_channel]
-        self.modified[:, :, self.channel] = image[:, :, self.channel]
-        self.channel_data = self.modified[:, :, self.channel]
-        self.corrected = self.channel_data.copy()
+        self.channel_data = image[:, :, self.channel]
         self.scale_factor = 1.0
 
+        # ヒストグラムは1度だけ数え、露出変更時は各値の移動先でビンを組み直す
+        self.counts = np.bincount(self.channel_data.ravel(), minlength=65536)
+        self.values = np.arange(len(self.counts))
+
         self.root = tk.Tk()
         self.root.title("Exposure Correction")
 
@@ -39,7 +67,7 @@ class ExposureAdjuster:
         self.ax.set_xlim(0, 65535)
 
         ttk.Label(self.root, text='Set Peak Value:').pack()
-        self.peak_var = tk.IntVar(value=int(np.median(self.channel_data)))
+        self.peak_var = tk.IntVar(value=int(percentile_from_counts(self.counts, 50)))
         self.entry = ttk.Entry(self.root, textvariable=self.peak_var, width=10)
         self.entry.pack()
         self.apply_button = ttk.Button(self.root, text='Apply', command=lambda: self.update_exposure(self.peak_var.get()))
@@ -55,33 +83,56 @@ class ExposureAdjuster:
     def update_exposure(self, value):
         value = float(value)
         self.scale_factor = 65535.0 / value
-        corrected = (self.channel_data * self.scale_factor).clip(0, 65535).astype(np.uint16)
-        self.corrected = corrected
+        corrected_values = scale_channel(self.values, self.scale_factor)
 
-        hist, bin_edges = np.histogram(self.corrected, bins=1000, range=(0, 65535))
+        hist, bin_edges = np.histogram(corrected_values, bins=1000, range=(0, 65535), weights=self.counts)
         bin_centers = (bin_edges[:-1] + bin_edges[1:]) / 2
         self.hist_line.set_data(bin_centers, hist + 1)
         self.ax.set_ylim(1, np.max(hist + 1) * 1.1)
         self.canvas.draw()
 
     def save_image(self):
-        output = np.zeros_like(self.original)
-        output[:, :, self.channel] = self.corrected
-        tifffile.imwrite(self.output_file, output)
-        print(f"    Output : '{self.output_file}'")
+        corrected = scale_channel(self.channel_data, self.scale_factor)
+        save_channel_image(self.output_file, self.original, self.channel, corrected)
 
 
-def main(input_file, color, output_file):
+def load_flat(input_file):
     image = tifffile.imread(input_file)
     if image.dtype != np.uint16 or image.ndim != 3 or image.shape[2] != 3:
         raise ValueError("Only 16-bit 3-channel RGB TIFF images are supported.")
+    return image
+
+
+def main(input_file, color, output_file):
+    image = load_flat(input_file)
     ExposureAdjuster(image, color, output_file)
 
+
+def main_batch(input_file, colors, peak=None, percentile=50.0, output_base=None):
+    # フラットを1度だけ読み込み、GUIなしで各チャンネルを出力する
+    image = load_flat(input_file)
+    base = os.path.splitext(input_file)[0] if output_base is None else output_base
+    for color in colors:
+        channel = COLOR_MAP[color]
+        channel_data = image[:, :, channel]
+        channel_peak = peak if peak is not None else percentile_from_counts(np.bincount(channel_data.ravel(), minlength=65536), percentile)
+        print(f"*** {color.upper()} channel : peak = {channel_peak:.1f}")
+        save_channel_image(f"{base}_{color}.tif", image, channel, scale_channel(channel_data, 65535.0 / float(channel_peak)))
+
 if __name__ == "__main__" :
     
     parser = argparse.ArgumentParser()
     parser.add_argument("input", help="Input 16-bit TIFF file")
-    parser.add_argument("--color", required=True, choices=['r', 'g', 'b'], help="Color channel to adjust")
+    parser.add_argument("--color", choices=['r', 'g', 'b'], help="Color channel to adjust (batch mode: all channels if omitted)")
     parser.add_argument('--output', default='corrected_output.tif', help='Output TIFF filename')
+    parser.add_argument("--batch", action="store_true", help="No GUI. Write <input>_r/_g/_b.tif from --peak or --percentile")
+    parser.add_argument("--peak", type=float, default=None, help="Peak value mapped to 65535 in batch mode")
+    parser.add_argument("--percentile", type=float, default=50.0, help="Per-channel percentile used as the peak in batch mode (default: 50 = median)")
     args = parser.parse_args()
-    main(args.input, args.color, args.output)
+
+    if args.batch:
+        main_batch(args.input, [args.color] if args.color else ['r', 'g', 'b'], args.peak, args.percentile)
+    elif args.color is None:
+        parser.error("--color is required unless --batch is given")
+    else:
+        main(args.input, args.color, args.output)
@@ -4,12 +4,163 @@ import rawpy
 import numpy as np
 import os
 import argparse
+import json
+import hashlib
+from functools import partial
 from glob import glob
 from tifffile import imwrite
 from rawpy import DemosaicAlgorithm
 from rawpy import FBDDNoiseReductionMode
+from batch import map_ordered, resolve_jobs
+from tiff_io import read_exif
+from instrument import stage, file_size, add_instrument_arguments, run_instrumented
+
+MANIFEST_NAME = ".nef2tif_manifest.json"
+
+DECODE_PARAMS = {
+    "output_bps": 16,
+    "gamma": [1, 1],
+    "no_auto_bright": True,
+    "use_camera_wb": True,
+    "demosaic_algorithm": "AMAZE",
+    "fbdd_noise_reduction": "Full",
+    "median_filter_passes": 1,
+    # 14bit相当の範囲(0-16383)から16bit範囲(0-65535)へスケーリング
+    "scale": 65535.0 / 16383.0,
+}
+
+# 選別用のプレビュー : 1/2 サイズ (デモザイクなし)、NR なし、8bit ガンマ補正・自動露出
+DRAFT_PARAMS = {
+    "output_bps": 8,
+    "gamma": [2.222, 4.5],
+    "no_auto_bright": False,
+    "use_camera_wb": True,
+    "demosaic_algorithm": "LINEAR",
+    "fbdd_noise_reduction": "Off",
+    "median_filter_passes": 0,
+    "half_size": True,
+}
+
+# カメラ内 JPEG サムネイルをそのまま書き出す (最速)
+THUMB_PARAMS = {"thumbnail": True, "extension": ".jpg"}
+
+
+def postprocess_raw(raw, params=DECODE_PARAMS):
+    # RAWを16bitで展開（線形補正、ガンマ補正なし）
+    rgb = raw.postprocess(
+        output_bps=params["output_bps"],
+        gamma=tuple(params["gamma"]),
+        no_auto_bright=params["no_auto_bright"],
+        use_camera_wb=params["use_camera_wb"],
+        demosaic_algorithm=DemosaicAlgorithm[params["demosaic_algorithm"]],
+        fbdd_noise_reduction=FBDDNoiseReductionMode[params["fbdd_noise_reduction"]],
+        median_filter_passes=params["median_filter_passes"],
+        half_size=params.get("half_size", False),
+        user_flip=params.get("user_flip")
+    )
+    if "scale" not in params:
+        return rgb
+    return (rgb.astype(np.float32) * params["scale"]).clip(0, 65535).astype(np.uint16)
+
+
+def output_name(path, params=DECODE_PARAMS):
+    return os.path.splitext(os.path.basename(path))[0] + params.get("extension", ".tif")
+
+
+def convert_file(path, output_dir, params=DECODE_PARAMS):
+    out_path = os.path.join(output_dir, output_name(path, params))
+
+    thumb = None
+    with stage("decode", path) as record:
+        with rawpy.imread(path) as raw:
+            if params.get("thumbnail"):
+                thumb = raw.extract_thumb()
+            else:
+                rgb = postprocess_raw(raw, params)
+        record["bytes_read"] = file_size(path)
+
+    with stage("encode", path) as record:
+        if thumb is not None and thumb.format == rawpy.ThumbFormat.JPEG:
+            with open(out_path, "wb") as f:
+                f.write(thumb.data)
+        else:
+            if thumb is not None:
+                out_path = os.path.splitext(out_path)[0] + ".tif"
+                rgb = thumb.data
+            imwrite(out_path, rgb)
+        record["bytes_written"] = file_size(out_path)
+    return out_path
+
+
+def file_hash(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def load_manifest(output_dir):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f).get("files", {})
+    except (OSError, ValueError) as e:
+        print(f"Warning: ignoring unreadable manifest {path}: {e}")
+        return {}
+
+
+def save_manifest(output_dir, entries):
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"version": 1, "files": entries}, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def manifest_entry(path, out_path, params, use_hash):
+    st = os.stat(path)
+    entry = {
+        "source": os.path.basename(path),
+        # 埋め込みサムネイルが JPEG でない場合は .tif で書き出すため、実際のファイル名を残す
+        "output": os.path.basename(out_path),
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "output_size": os.path.getsize(out_path),
+        "params": params,
+        # キャリブレーションライブラリ (calib_library.py) が TIF ディレクトリから撮影条件を引くために残す
+        "exif": read_exif(path),
+    }
+    if use_hash:
+        entry["sha256"] = file_hash(path)
+    return entry
+
+
+def is_up_to_date(entry, path, out_path, params, use_hash):
+    if entry is None or entry.get("params") != params:
+        return False
+    if not os.path.exists(out_path) or os.path.getsize(out_path) != entry.get("output_size"):
+        return False
+    st = os.stat(path)
+    if st.st_size != entry.get("size"):
+        return False
+    if use_hash:
+        return entry.get("sha256") == file_hash(path)
+    return st.st_mtime_ns == entry.get("mtime_ns")
+
+
+def main(input_dir, output_dir, jobs=1, force=False, use_hash=False, draft=None, draft_dir=None, strip_orientation=False):
+    params = DECODE_PARAMS
+    if draft is not None:
+        # プレビューはサイエンス用 TIF と混ざらないよう別ディレクトリに出力する
+        output_dir = draft_dir if draft_dir is not None else os.path.join(output_dir, "draft")
+        params = THUMB_PARAMS if draft == "thumb" else DRAFT_PARAMS
+    if strip_orientation and not params.get("thumbnail"):
+        # NEF の Orientation を無視してセンサーの向きのまま現像 (delete_exif.bash を別に実行する必要はない)
+        params = dict(params, user_flip=0)
 
-def main(input_dir, output_dir):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
@@ -18,36 +169,55 @@ def main(input_dir, output_dir):
         print("*** No NEF files found.")
         return
 
-    print(f"Found {len(files)} NEF files.")
+    # JSON で往復させた値と比較するため正規化しておく
+    params = json.loads(json.dumps(params))
+    entries = {} if force else load_manifest(output_dir)
 
+    todo = []
     for path in files:
-        print(f"Processing {os.path.basename(path)} ...")
-        with rawpy.imread(path) as raw:
-            print("Assuming RAW bit depth is 14 bits")
-
-            # RAWを16bitで展開（線形補正、ガンマ補正なし）
-            rgb = raw.postprocess(
-                output_bps=16,
-                gamma=(1, 1),
-                no_auto_bright=True,
-                use_camera_wb=True,
-                demosaic_algorithm=DemosaicAlgorithm.AMAZE,
-                fbdd_noise_reduction=FBDDNoiseReductionMode.Full,
-                median_filter_passes=1
-            )
-
-            # 14bit相当の範囲(0-16383)から16bit範囲(0-65535)へスケーリング
-            rgb = (rgb.astype(np.float32) * (65535.0 / 16383.0)).clip(0, 65535).astype(np.uint16)
-
-            out_name = os.path.splitext(os.path.basename(path))[0] + ".tif"
-            out_path = os.path.join(output_dir, out_name)
-            imwrite(out_path, rgb)
+        # manifest は要求した出力名 (output_name) をキーにし、実際に書いたファイルは entry["output"] で参照する
+        out_name = output_name(path, params)
+        entry = entries.get(out_name)
+        out_path = os.path.join(output_dir, entry.get("output", out_name) if entry else out_name)
+        if is_up_to_date(entry, path, out_path, params, use_hash):
+            continue
+        todo.append(path)
+
+    jobs = resolve_jobs(jobs)
+    print(f"Found {len(files)} NEF files. ({len(files) - len(todo)} up to date, {len(todo)} to convert, {jobs} jobs)")
+    if draft is None:
+        print("Assuming RAW bit depth is 14 bits")
+
+    failed = []
+    worker = partial(convert_file, output_dir=output_dir, params=params)
+    for idx, (path, out_path, error) in enumerate(map_ordered(worker, todo, jobs)):
+        if error is not None:
+            print(f"*** [{idx+1}/{len(todo)}] Failed {os.path.basename(path)}: {error}")
+            failed.append(path)
+            continue
+        print(f"[{idx+1}/{len(todo)}] {os.path.basename(path)} -> {os.path.basename(out_path)}")
+        entries[output_name(path, params)] = manifest_entry(path, out_path, params, use_hash)
+        save_manifest(output_dir, entries)
 
-    print(f"\n✅ Conversion completed. TIFs saved to: {output_dir}")
+    if failed:
+        print(f"\n*** {len(failed)} file(s) failed:")
+        for path in failed:
+            print(f"    {path}")
+    print(f"\n✅ Conversion completed. {'Previews' if draft else 'TIFs'} saved to: {output_dir}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("input_dir", help="Directory containing NEF files")
     parser.add_argument("output_dir", help="Directory to save TIF files")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of decoding processes (0: all cores, default: 1)")
+    parser.add_argument("--force", action="store_true", help=f"Ignore {MANIFEST_NAME} and convert every file")
+    parser.add_argument("--hash", action="store_true", help="Compare source files by SHA-256 instead of mtime")
+    parser.add_argument("--draft", nargs="?", const="half", choices=["half", "thumb"], default=None,
+                        help="Write quick previews for culling instead of science TIFs (half: half-size decode without NR, thumb: embedded JPEG)")
+    parser.add_argument("--draft-dir", default=None, help="Directory for --draft previews (default: <output_dir>/draft)")
+    parser.add_argument("--strip-orientation", action="store_true",
+                        help="Ignore the EXIF Orientation of the NEF files (same result as running delete_exif.bash first)")
+    add_instrument_arguments(parser)
     args = parser.parse_args()
-    main(args.input_dir, args.output_dir)
+    run_instrumented(args, main, args.input_dir, args.output_dir, args.jobs, args.force, args.hash, args.draft, args.draft_dir,
+                     args.strip_orientation)
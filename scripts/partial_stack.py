@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import argparse
+import numpy as np
+from tifffile import imwrite
+from tiff_io import frame_hash
+
+# フレームの部分集合ごとに 合計・二乗和・最小・最大・枚数 を保存した部分スタック (.npz)。
+# uint16 フレームの合計は float64 で誤差なく求まるため、どの順序・分割でマージしても
+# 1プロセスでコンポジットした結果と一致する。
+# 位置合わせの基準フレーム (registered_to) が同じ部分スタックだけをマージできる (位置合わせなしは None)。
+
+PARTIAL_METHODS = ["mean", "max", "min"]
+PARTIAL_VERSION = 1
+
+
+def parse_shard(text) :
+
+    # "K/N" : N 分割した K 番目 (0 始まり)
+    index, total = (int(v) for v in text.split("/"))
+    if not 0 <= index < total:
+        raise ValueError(f"invalid shard {text}")
+    return index, total
+
+
+def shard_indices(n_items, shard) :
+
+    if shard is None:
+        return list(range(n_items))
+    index, total = shard
+    return list(range(index, n_items, total))
+
+
+def frame_key(path, digest=None) :
+
+    # マシンごとにマウント先が違っても同じフレームを同じキーにする (ファイル名 + 内容のハッシュ)
+    return f"{os.path.basename(path)}:{digest or frame_hash(path)}"
+
+
+def empty_partial(registered_to=None) :
+
+    return {"sum": None, "sumsq": None, "min": None, "max": None, "count": 0, "frames": [],
+            "registered_to": registered_to}
+
+
+def accumulate(partial, frame, name=None) :
+
+    if partial["sum"] is None:
+        partial["sum"] = np.zeros(frame.shape, dtype=np.float64)
+        partial["sumsq"] = np.zeros(frame.shape, dtype=np.float64)
+        partial["min"] = frame.copy()
+        partial["max"] = frame.copy()
+    elif frame.shape != partial["sum"].shape:
+        raise ValueError("shape mismatch")
+    else:
+        np.minimum(partial["min"], frame, out=partial["min"])
+        np.maximum(partial["max"], frame, out=partial["max"])
+
+    np.add(partial["sum"], frame, out=partial["sum"])
+    square = frame.astype(np.float64)
+    np.multiply(square, square, out=square)
+    np.add(partial["sumsq"], square, out=partial["sumsq"])
+    partial["count"] += 1
+    if name is not None:
+        partial["frames"].append(name)
+
+
+def save_partial(path, partial, **extra) :
+
+    if partial["count"] == 0:
+        raise ValueError("empty partial stack")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, version=PARTIAL_VERSION, sum=partial["sum"], sumsq=partial["sumsq"],
+                 min=partial["min"], max=partial["max"], count=partial["count"],
+                 frames=np.array(json.dumps(partial["frames"])),
+                 registered_to=np.array(json.dumps(partial.get("registered_to"))), **extra)
+    os.replace(tmp_path, path)
+
+
+def load_partial(path) :
+
+    with np.load(path) as data:
+        partial = {key: data[key] for key in data.files if key not in ("version", "count", "frames", "registered_to")}
+        partial["count"] = int(data["count"])
+        partial["frames"] = json.loads(str(data["frames"]))
+        partial["registered_to"] = json.loads(str(data["registered_to"])) if "registered_to" in data.files else None
+    return partial
+
+
+def merge_partials(partials) :
+
+    merged = None
+    seen = set()
+    for partial in partials:
+        # 基準フレームが異なる部分スタックを足すとずれたまま重なるため拒否する
+        if merged is None:
+            merged = empty_partial(partial.get("registered_to"))
+        elif partial.get("registered_to") != merged["registered_to"]:
+            raise ValueError(f"partial stacks registered to different reference frames: "
+                             f"{merged['registered_to']}, {partial.get('registered_to')}")
+        duplicated = seen.intersection(partial["frames"])
+        if duplicated:
+            raise ValueError(f"frames stacked twice: {', '.join(sorted(duplicated))}")
+        seen.update(partial["frames"])
+
+        if merged["sum"] is None:
+            merged.update({key: partial[key].copy() for key in ["sum", "sumsq", "min", "max"]})
+        elif partial["sum"].shape != merged["sum"].shape:
+            raise ValueError("shape mismatch")
+        else:
+            np.add(merged["sum"], partial["sum"], out=merged["sum"])
+            np.add(merged["sumsq"], partial["sumsq"], out=merged["sumsq"])
+            np.minimum(merged["min"], partial["min"], out=merged["min"])
+            np.maximum(merged["max"], partial["max"], out=merged["max"])
+        merged["count"] += partial["count"]
+        merged["frames"] += partial["frames"]
+    return merged if merged is not None else empty_partial()
+
+
+def finalize_partial(partial, method="mean") :
+
+    if method == "mean":
+        result = partial["sum"] / partial["count"]
+    elif method == "max":
+        result = partial["max"]
+    elif method == "min":
+        result = partial["min"]
+    elif method == "std":
+        mean = partial["sum"] / partial["count"]
+        result = np.sqrt(np.maximum(partial["sumsq"] / partial["count"] - mean * mean, 0))
+    else:
+        raise ValueError(f"unsupported method {method}")
+    return np.clip(result, 0, 65535).astype(np.uint16)
+
+
+if __name__ == "__main__" :
+
+    parser = argparse.ArgumentParser(description="Merge partial stacks (.npz) written with --partial into the final TIFF.")
+    parser.add_argument("outfile", help="Output TIFF filename")
+    parser.add_argument("partials", nargs="+", help="Partial stack files")
+    parser.add_argument("-m", "--method", choices=PARTIAL_METHODS + ["std"], default="mean", help="Composite method (default: mean)")
+    parser.add_argument("--save-partial", default=None, help="Also write the merged partial stack (for merging in several levels)")
+    args = parser.parse_args()
+
+    def iter_partials(paths):
+        # 1つずつ読み込んでマージ (メモリ上には常に2つ分だけ)
+        for path in paths:
+            partial = load_partial(path)
+            print(f"Loaded : {path} ({partial['count']} frames)")
+            yield partial
+
+    try:
+        merged = merge_partials(iter_partials(args.partials))
+    except ValueError as e:
+        parser.error(str(e))
+
+    if args.save_partial:
+        save_partial(args.save_partial, merged)
+        print(f"    Partial : {args.save_partial}")
+    imwrite(args.outfile, finalize_partial(merged, args.method))
+    print(f"    Output : {args.outfile} ({merged['count']} frames)")
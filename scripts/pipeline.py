@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import shutil
+import hashlib
+import argparse
+from glob import glob
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tiff_io import parse_memory_size
+from composite_simple import composite_directory
+from subtract import subtract_images
+from calibrate import calibrate_images
+from defect_map import build_defect_map, save_defect_map
+from mkVignetRawImage import main_batch
+from alignment_loader import load_alignment
+from calib_library import LIBRARY_ENV, DEFAULT_LIBRARY, library_dir, frame_settings, select_master, add_master, master_path
+
+# astroPhoto_stage1〜4.bash の処理を1プロセス内の依存グラフとして実行する。
+# 各ノードの出力は (パラメータ・入力ファイル・依存ノード・スクリプト) のハッシュで
+# キャッシュし、変更のあったノードとその下流だけを作り直す。
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+CACHE_NAME = ".astro_cache"
+
+
+def fingerprint_dir(directory):
+    return [(os.path.basename(path), st.st_size, st.st_mtime_ns)
+            for path in sorted(glob(os.path.join(directory, "*.tif")))
+            for st in [os.stat(path)]]
+
+
+def source_hash(names):
+    h = hashlib.sha256()
+    for name in names:
+        with open(os.path.join(TOOLS_DIR, name), "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def node_key(node, keys):
+    desc = {"name": node["name"],
+            "params": node["params"],
+            "inputs": [fingerprint_dir(d) for d in node["inputs"]],
+            "deps": [keys[d] for d in node["deps"]],
+            "sources": source_hash(node["sources"])}
+    return hashlib.sha256(json.dumps(desc, sort_keys=True).encode()).hexdigest()
+
+
+def build_node(node, key, cache_dir, deps):
+    name = node["name"]
+    final_dir = os.path.join(cache_dir, f"{name}-{key[:16]}")
+    if os.path.isdir(final_dir):
+        print(f"[{name}] cached ({os.path.basename(final_dir)})")
+        return os.path.join(final_dir, node["output"])
+
+    # 途中で失敗しても不完全な出力がキャッシュとして残らないよう、一時ディレクトリで作ってから rename
+    tmp_dir = final_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    out_path = os.path.join(tmp_dir, node["output"])
+    print(f"[{name}] BEGIN")
+    try:
+        node["run"](out_path, deps)
+        if not os.path.exists(out_path):
+            raise RuntimeError(f"{name}: no output was produced")
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    os.replace(tmp_dir, final_dir)
+
+    # 同じノードの古いキャッシュは削除
+    for stale in glob(os.path.join(cache_dir, f"{name}-*")):
+        if stale != final_dir:
+            shutil.rmtree(stale, ignore_errors=True)
+    print(f"[{name}] END")
+    return os.path.join(final_dir, node["output"])
+
+
+def run_graph(nodes, cache_dir, workers=2):
+    os.makedirs(cache_dir, exist_ok=True)
+    pending = {node["name"]: node for node in nodes}
+    keys, outputs, running = {}, {}, {}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while pending or running:
+            # 依存ノードが揃ったものから投入 (独立した枝は並列に実行される)
+            for name, node in list(pending.items()):
+                if all(d in outputs for d in node["deps"]):
+                    keys[name] = node_key(node, keys)
+                    deps = {d: outputs[d] for d in node["deps"]}
+                    running[executor.submit(build_node, node, keys[name], cache_dir, deps)] = name
+                    del pending[name]
+            if not running:
+                raise RuntimeError(f"unresolved dependencies: {', '.join(pending)}")
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                outputs[running.pop(future)] = future.result()
+    return outputs
+
+
+def make_node(name, output, run, deps=(), inputs=(), params=None, sources=()):
+    return {"name": name, "output": output, "run": run, "deps": list(deps), "inputs": list(inputs),
+            "params": params or {}, "sources": list(sources)}
+
+
+def build_graph(light_dir, dark_light_dir=None, flat_dir=None, dark_flat_dir=None,
+                register="auto", box_size=50, percentile=50.0, max_memory=None, jobs=1,
+                library=None, temperature=None, defect_sigma=None):
+
+    composite_sources = ["composite_simple.py", "tiff_io.py"]
+    nodes = []
+
+    def composite_node(name, output, indir=None, dep=None, kind=None, settings_dir=None):
+        def run(out, deps):
+            composite_directory(deps[dep] if dep else indir, out, "mean", max_memory)
+            # 新しく作ったマスターはライブラリに登録し、次回以降のスタックを省く
+            settings = frame_settings(settings_dir) if library is not None and kind is not None else None
+            if settings is not None and None not in (settings["iso"], settings["exposure"]) and os.path.exists(out):
+                add_master(library, kind, out, settings, temperature)
+        return make_node(name, output, run, [dep] if dep else [], [] if dep else [indir],
+                         {"method": "mean"}, composite_sources)
+
+    def library_node(name, output, entry):
+        path = master_path(library, entry)
+        print(f"    Library : {name} <- {entry['file']}")
+        return make_node(name, output, lambda out, deps: shutil.copyfile(path, out),
+                         params={"library": entry["file"], "sha256": entry["sha256"]}, sources=["calib_library.py"])
+
+    # ライブラリのマスターは、対応する入力ディレクトリが NONE のときだけ使う (指定されたフレームは常に優先)
+    light_settings = frame_settings(light_dir) if library is not None else None
+    dark_entry = flat_entry = None
+    if light_settings is not None:
+        if dark_light_dir is None:
+            dark_entry = select_master(library, "dark", light_settings, temperature)
+        if flat_dir is None:
+            flat_entry = select_master(library, "flat", light_settings, temperature)
+
+    ### Master dark frame of the light frames
+    if dark_entry is not None:
+        nodes.append(library_node("dark_light", "drk_light_16bit.tif", dark_entry))
+    elif dark_light_dir is not None:
+        nodes.append(composite_node("dark_light", "drk_light_16bit.tif", indir=dark_light_dir,
+                                    kind="dark", settings_dir=dark_light_dir))
+
+    ### Master flat frame (dark subtracted) and RGB flats
+    if flat_entry is not None:
+        nodes.append(library_node("flat_master", "flat_16bit.tif", flat_entry))
+    elif flat_dir is not None:
+        if dark_flat_dir is not None:
+            nodes.append(composite_node("dark_flat", "drk_flat_16bit.tif", indir=dark_flat_dir))
+            nodes.append(make_node("flat_sub", "f_drk_subt",
+                                   lambda out, deps: subtract_images(flat_dir, deps["dark_flat"], out, jobs=jobs),
+                                   ["dark_flat"], [flat_dir], sources=["subtract.py", "batch.py"]))
+            nodes.append(composite_node("flat_master", "flat_16bit.tif", dep="flat_sub", kind="flat", settings_dir=flat_dir))
+        else:
+            nodes.append(composite_node("flat_master", "flat_16bit.tif", indir=flat_dir, kind="flat", settings_dir=flat_dir))
+
+    if flat_entry is not None or flat_dir is not None:
+        def run_flat_channels(out, deps):
+            os.makedirs(out)
+            main_batch(deps["flat_master"], ["r", "g", "b"], percentile=percentile,
+                       output_base=os.path.join(out, "flat_16bit"))
+        nodes.append(make_node("flat_channels", "flat", run_flat_channels, ["flat_master"],
+                               params={"percentile": percentile}, sources=["mkVignetRawImage.py"]))
+
+    ### Hot-pixel map from the master dark
+    if defect_sigma is not None and any(n["name"] == "dark_light" for n in nodes):
+        nodes.append(make_node("defects", "defects.npz",
+                               lambda out, deps: save_defect_map(out, build_defect_map(deps["dark_light"], defect_sigma)),
+                               ["dark_light"], params={"sigma": defect_sigma}, sources=["defect_map.py"]))
+
+    ### Light frames : (hot-pixel replacement +) dark subtraction + flat correction in a single pass
+    def run_lights(out, deps):
+        flats = [None] * 3
+        if "flat_channels" in deps:
+            flats = [os.path.join(deps["flat_channels"], f"flat_16bit_{c}.tif") for c in "rgb"]
+        calibrate_images(light_dir, out, deps.get("dark_light"), *flats, deps.get("defects"))
+    cal_deps = [d for d in ["dark_light", "flat_channels", "defects"] if any(n["name"] == d for n in nodes)]
+    nodes.append(make_node("lights_cal", "l_flat_corr", run_lights, cal_deps, [light_dir],
+                           sources=["calibrate.py", "flat_correction.py", "defect_map.py"]))
+
+    ### Alignment and composite
+    def run_composite(out, deps):
+        alignment = load_alignment()
+        # グラフのワーカースレッドからは GUI を開けないため、自動位置合わせに失敗したフレームはスキップする
+        alignment.main(deps["lights_cal"], out, box_size, auto=(register == "auto"),
+                       register="phase" if register == "phase" else "stars", jobs=jobs,
+                       solutions_file=os.path.join(os.path.dirname(out), alignment.SOLUTIONS_NAME),
+                       interactive=False, max_memory=max_memory)
+    nodes.append(make_node("composite", "composite.tif", run_composite, ["lights_cal"],
+                           params={"register": register, "box": box_size},
+                           sources=["composite_2star-alignment.py", "frame_quality.py"]))
+    return nodes
+
+
+def dir_or_none(text):
+    return None if text == "NONE" else text
+
+
+if __name__ == "__main__" :
+
+    parser = argparse.ArgumentParser(description="Run the whole stage1-4 pipeline in one process, rebuilding only stale intermediates.")
+    parser.add_argument("light_dir", help="Light frame dir")
+    parser.add_argument("dark_light_dir", type=dir_or_none, help="Dark frame of the light frame dir (NONE: skip)")
+    parser.add_argument("flat_dir", type=dir_or_none, help="Flat frame dir (NONE: skip)")
+    parser.add_argument("dark_flat_dir", type=dir_or_none, help="Dark frame of the flat frame dir (NONE: skip)")
+    parser.add_argument("-o", "--outfile", default="composite.tif", help="Output filename (default: composite.tif)")
+    parser.add_argument("--register", choices=["auto", "phase"], default="auto",
+                        help="auto: automatic star matching, phase: FFT phase correlation (default: auto)")
+    parser.add_argument("--box", type=int, default=50, help="Box size for star region (default: 50)")
+    parser.add_argument("--percentile", type=float, default=50.0, help="Percentile used as the peak of each flat channel (default: 50)")
+    parser.add_argument("--max-memory", type=parse_memory_size, default=None, help="Memory budget for stacking master frames and for frames in flight while compositing (e.g. 2G)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Processes for subtraction / threads for warping (0: all cores, default: 1)")
+    parser.add_argument("--workers", type=int, default=2, help="Number of graph nodes run in parallel (default: 2)")
+    parser.add_argument("--library", nargs="?", const="", default=None,
+                        help=f"Use a matching master from the calibration library for each frame dir given as NONE, and add newly stacked masters to it (default: ${LIBRARY_ENV} or {DEFAULT_LIBRARY})")
+    parser.add_argument("--temperature", type=float, default=None, help="Temperature of the light frames (C) used to pick library masters")
+    parser.add_argument("--defects", type=float, default=None, metavar="SIGMA",
+                        help="Build a hot-pixel map from the light dark at this threshold and replace those pixels before dark subtraction")
+    parser.add_argument("--cache-dir", default=CACHE_NAME, help=f"Cache directory for intermediates (default: {CACHE_NAME})")
+    args = parser.parse_args()
+
+    nodes = build_graph(args.light_dir, args.dark_light_dir, args.flat_dir, args.dark_flat_dir,
+                        args.register, args.box, args.percentile, args.max_memory, args.jobs,
+                        None if args.library is None else library_dir(args.library), args.temperature, args.defects)
+    outputs = run_graph(nodes, args.cache_dir, args.workers)
+    shutil.copyfile(outputs["composite"], args.outfile)
+    print(f"    Output : {args.outfile}")
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+from functools import partial
+from glob import glob
+import numpy as np
+import rawpy
+from tifffile import imread, imwrite
+from nef2tif_with_NR import DECODE_PARAMS, postprocess_raw
+from batch import SHARED, map_ordered, resolve_jobs, shared_arrays
+from defect_map import load_defect_map, make_defect_map, correct_defects
+
+# ベイヤー配列 (raw_image_visible) のままダーク・フラット処理を行い、デモザイクは最後に1回だけ行う
+# マスターは uint16 の1面 (2 B/px) で保存・共有する。uint16 RGB の TIFF (6 B/px) の 1/3 の大きさ
+#   ダーク : 平均を丸めた raw 値 (ブラックレベルを含む)
+#   フラット : CFA の色ごとに最大値で正規化した値 × FLAT_SCALE
+
+FLAT_SCALE = 65535.0
+
+
+def list_raw_files(input_dir):
+    return sorted(glob(os.path.join(input_dir, "*.NEF")))
+
+
+def black_level_map(raw):
+    return np.array(raw.black_level_per_channel, dtype=np.float32)[raw.raw_colors_visible]
+
+
+def to_uint16(image):
+    return np.clip(np.rint(image), 0, 65535).astype(np.uint16)
+
+
+def load_master_dark(path):
+    # 以前の float32 のマスターも uint16 に丸めて扱う
+    dark = imread(path)
+    return dark if dark.dtype == np.uint16 else to_uint16(dark)
+
+
+def load_master_flat(path):
+    flat = imread(path)
+    if flat.dtype != np.uint16:
+        # 以前の float32 (正規化済み) のマスター
+        flat = to_uint16(flat * FLAT_SCALE)
+    # 0 で割らないよう最小値を 1 にする
+    return np.maximum(flat, 1)
+
+
+def stack_mosaics(files):
+    total = None
+    count = 0
+    for path in files:
+        try:
+            with rawpy.imread(path) as raw:
+                mosaic = raw.raw_image_visible
+                if total is None:
+                    total = np.zeros(mosaic.shape, dtype=np.float64)
+                    colors = raw.raw_colors_visible.copy()
+                    black = black_level_map(raw)
+                if mosaic.shape != total.shape:
+                    print(f"Skipping {path}: shape mismatch.")
+                    continue
+                np.add(total, mosaic, out=total)
+            count += 1
+            print(f"Loaded : {path}")
+        except Exception as e:
+            print("*** Error ***")
+            print(f"Failed to load {path}: {e}")
+    if count == 0:
+        return None, None, None
+    return (total / count).astype(np.float32), colors, black
+
+
+def make_master_dark(input_dir, output_file):
+    files = list_raw_files(input_dir)
+    if not files:
+        print("*** No NEF files found.")
+        return
+    dark, _, _ = stack_mosaics(files)
+    if dark is None:
+        return
+    imwrite(output_file, to_uint16(dark))
+    print(f"    Output : {output_file}")
+
+
+def make_master_flat(input_dir, output_file, dark_file=None):
+    files = list_raw_files(input_dir)
+    if not files:
+        print("*** No NEF files found.")
+        return
+    flat, colors, black = stack_mosaics(files)
+    if flat is None:
+        return
+
+    flat -= load_master_dark(dark_file) if dark_file is not None else black
+    np.maximum(flat, 0, out=flat)
+    # CFA の色ごとに最大値で正規化 (flat_correction.normalize_flat と同じ考え方)
+    for color in np.unique(colors):
+        mask = colors == color
+        flat[mask] *= FLAT_SCALE / np.max(flat[mask])
+    imwrite(output_file, np.maximum(to_uint16(flat), 1))
+    print(f"    Output : {output_file}")
+
+
+def calibrate_mosaic(raw, dark=None, flat=None, defects=None):
+    # dark : ブラックレベルを含む uint16 のダーク (None ならブラックレベルだけを引く)
+    # flat : FLAT_SCALE 倍した uint16 のフラット
+    mosaic = raw.raw_image_visible
+    black = black_level_map(raw)
+    frame = mosaic.astype(np.float32)
+    if defects is not None:
+        correct_defects(frame, defects)
+    frame -= dark if dark is not None else black
+    np.maximum(frame, 0, out=frame)
+    if flat is not None:
+        frame *= FLAT_SCALE
+        frame /= flat
+    # postprocess 側でブラックレベルが引かれるため戻しておく
+    frame += black
+    np.clip(frame, 0, raw.white_level, out=frame)
+    mosaic[...] = np.rint(frame, out=frame)
+
+
+def calibrate_raw_file(path, output_dir, params=DECODE_PARAMS):
+    with rawpy.imread(path) as raw:
+        dark, flat = SHARED.get("dark"), SHARED.get("flat")
+        shape = raw.raw_image_visible.shape
+        if (dark is not None and dark.shape != shape) or (flat is not None and flat.shape != shape):
+            raise ValueError("shape mismatch")
+        defects = None
+        if "defect_coords" in SHARED:
+            if tuple(SHARED["defect_shape"]) != shape:
+                raise ValueError("shape mismatch with the defect map")
+            # 近傍の索引は欠陥画素の数に比例する小さな計算なので、フレームごとに作り直す
+            defects = make_defect_map(SHARED["defect_coords"], shape)
+        calibrate_mosaic(raw, dark, flat, defects)
+        rgb = postprocess_raw(raw, params)
+
+    out_path = os.path.join(output_dir, os.path.splitext(os.path.basename(path))[0] + ".tif")
+    imwrite(out_path, rgb)
+    return out_path
+
+
+def calibrate_raw_images(input_dir, output_dir, dark_file=None, flat_file=None, jobs=1, defects_file=None):
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    files = list_raw_files(input_dir)
+    if not files:
+        print("*** No NEF files found.")
+        return
+
+    jobs = resolve_jobs(jobs)
+    print(f"Found {len(files)} NEF files. ({jobs} jobs)")
+
+    # マスターは uint16 のまま共有し、各フレームの float32 に昇格させて補正する
+    shared = {}
+    if dark_file is not None:
+        shared["dark"] = load_master_dark(dark_file)
+    if flat_file is not None:
+        shared["flat"] = load_master_flat(flat_file)
+
+    if defects_file is not None:
+        # 欠陥画素の座標もダーク・フラットと同じく共有し、呼び出しごとに入れ替わるようにする
+        defects = load_defect_map(defects_file)
+        shared["defect_coords"] = defects["coords"]
+        shared["defect_shape"] = np.array(defects["shape"])
+        # ライトと同じ画素を置き換えてから共有する
+        if "dark" in shared:
+            correct_defects(shared["dark"], defects)
+
+    worker = partial(calibrate_raw_file, output_dir=output_dir)
+    with shared_arrays(shared, jobs) as (initializer, initargs):
+        for idx, (path, out_path, error) in enumerate(map_ordered(worker, files, jobs, initializer=initializer, initargs=initargs)):
+            if error is not None:
+                print(f"*** [{idx+1}/{len(files)}] Failed {os.path.basename(path)}: {error}")
+            else:
+                print(f"[{idx+1}/{len(files)}] {os.path.basename(path)} -> {os.path.basename(out_path)}")
+
+    print(f"\nCalibrated images saved to: {output_dir}")
+
+
+if __name__ == "__main__" :
+
+    parser = argparse.ArgumentParser(description="Dark and flat calibration on the Bayer mosaic before demosaicing.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    p_dark = subparsers.add_parser("dark", help="Make a master dark mosaic from NEF files")
+    p_dark.add_argument("input_dir", help="Directory containing dark NEF files")
+    p_dark.add_argument("-o", "--outfile", default="dark_cfa.tif", help="Output filename (default: dark_cfa.tif)")
+
+    p_flat = subparsers.add_parser("flat", help="Make a normalized master flat mosaic from NEF files")
+    p_flat.add_argument("input_dir", help="Directory containing flat NEF files")
+    p_flat.add_argument("-o", "--outfile", default="flat_cfa.tif", help="Output filename (default: flat_cfa.tif)")
+    p_flat.add_argument("--dark", default=None, help="Master dark mosaic of the flat frames (default: black level)")
+
+    p_cal = subparsers.add_parser("calibrate", help="Calibrate light NEF files and demosaic them to TIFF")
+    p_cal.add_argument("input_dir", help="Directory containing light NEF files")
+    p_cal.add_argument("output_dir", help="Directory to save calibrated TIF files")
+    p_cal.add_argument("--dark", default=None, help="Master dark mosaic of the light frames")
+    p_cal.add_argument("--flat", default=None, help="Master flat mosaic")
+    p_cal.add_argument("--defects", default=None, help="Defect map built from the dark mosaic with defect_map.py")
+    p_cal.add_argument("-j", "--jobs", type=int, default=1, help="Number of processes (0: all cores, default: 1)")
+
+    args = parser.parse_args()
+    if args.command == "dark":
+        make_master_dark(args.input_dir, args.outfile)
+    elif args.command == "flat":
+        make_master_flat(args.input_dir, args.outfile, args.dark)
+    else:
+        calibrate_raw_images(args.input_dir, args.output_dir, args.dark, args.flat, args.jobs, args.defects)
@@ -1,12 +1,63 @@
 #!/usr/bin/env python3
 
 import os
+import time
 import argparse
+from functools import partial
 from glob import glob
 import numpy as np
 import imageio.v2 as imageio
+from tiff_io import open_tiff, create_tiff, row_blocks
+from batch import SHARED, map_ordered, resolve_jobs, shared_arrays
+from instrument import stage, file_size, add_instrument_arguments, run_instrumented
 
-def subtract_images(input_dir, subtract_file, output_dir):
+def subtract_frame_low_memory(path, ref, out_path, block_rows=256):
+    image = open_tiff(path)
+    if image.shape != ref.shape:
+        return False
+
+    out = create_tiff(out_path, image.shape, np.uint16)
+    for rows in row_blocks(image.shape[0], block_rows):
+        block = image[rows]
+        if block.dtype == np.uint16 and ref.dtype == np.uint16:
+            # uint16 のまま飽和減算 : a - min(a, b)
+            np.subtract(block, np.minimum(block, ref[rows]), out=out[rows])
+        else:
+            out[rows] = np.clip(block.astype(np.int32) - ref[rows], 0, 65535)
+    out.flush()
+    del out
+    return True
+
+
+def subtract_frame(path, output_dir, subtract_file=None, low_memory=False, block_rows=256):
+    start = time.perf_counter()
+    out_path = os.path.join(output_dir, os.path.basename(path))
+
+    if low_memory:
+        if "ref" not in SHARED:
+            SHARED["ref"] = open_tiff(subtract_file)
+        with stage("compute", path) as record:
+            if not subtract_frame_low_memory(path, SHARED["ref"], out_path, block_rows):
+                raise ValueError("shape mismatch")
+            record.update(bytes_read=file_size(path), bytes_written=file_size(out_path))
+    else:
+        ref = SHARED["ref"]
+        with stage("decode", path) as record:
+            image = imageio.imread(path).astype(np.int32)
+            record["bytes_read"] = file_size(path)
+
+        if image.shape != ref.shape:
+            raise ValueError("shape mismatch")
+
+        with stage("compute", path):
+            subtracted = np.clip(image - ref, 0, 65535).astype(np.uint16)
+        with stage("encode", path) as record:
+            imageio.imwrite(out_path, subtracted, format="TIFF")
+            record["bytes_written"] = file_size(out_path)
+    return time.perf_counter() - start
+
+
+def subtract_images(input_dir, subtract_file, output_dir, low_memory=False, block_rows=256, jobs=1):
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
@@ -15,23 +66,22 @@ def subtract_images(input_dir, subtract_file, output_dir):
         print("*** No TIFF files found in input directory.")
         return
 
-    print(f"Found {len(files)} files.")
-
-    ref = imageio.imread(subtract_file).astype(np.int32)
-
-    for path in files:
-        print(f"Processing {os.path.basename(path)} ...")
-        image = imageio.imread(path).astype(np.int32)
-
-        if image.shape != ref.shape:
-            print(f"Skipping {path}: shape mismatch.")
-            continue
+    jobs = resolve_jobs(jobs)
+    print(f"Found {len(files)} files. ({jobs} jobs)")
 
-        subtracted = np.clip(image - ref, 0, 65535).astype(np.uint16)
+    # 参照画像は uint16 のまま共有し、各フレームの int32 に昇格させて減算する
+    shared = {} if low_memory else {"ref": imageio.imread(subtract_file)}
+    worker = partial(subtract_frame, output_dir=output_dir, subtract_file=subtract_file,
+                     low_memory=low_memory, block_rows=block_rows)
 
-        out_name = os.path.basename(path)
-        out_path = os.path.join(output_dir, out_name)
-        imageio.imwrite(out_path, subtracted, format="TIFF")
+    with shared_arrays(shared, jobs) as (initializer, initargs):
+        for path, elapsed, error in map_ordered(worker, files, jobs, initializer=initializer, initargs=initargs):
+            print(f"Processing {os.path.basename(path)} ...")
+            if error is not None:
+                print(f"Skipping {path}: {error}")
+                continue
+            print(f"    {elapsed * 1000:.0f} ms")
+    SHARED.pop("ref", None)
 
     print(f"\nSubtracted images saved to: {output_dir}")
 
@@ -40,6 +90,10 @@ if __name__ == "__main__":
     parser.add_argument("input_dir", help="Directory containing input TIFF images")
     parser.add_argument("subtract_file", help="Reference TIFF file to subtract from all input images")
     parser.add_argument("output_dir", help="Directory to save subtracted TIFF images")
+    parser.add_argument("--low-memory", action="store_true", help="Memory-map the TIFFs and subtract in row blocks")
+    parser.add_argument("--block-rows", type=int, default=256, help="Rows per block in --low-memory mode (default: 256)")
+    parser.add_argument("-j", "--jobs", type=int, default=1, help="Number of worker processes (0: all cores, default: 1)")
+    add_instrument_arguments(parser)
     args = parser.parse_args()
 
-    subtract_images(args.input_dir, args.subtract_file, args.output_dir)
+    run_instrumented(args, subtract_images, args.input_dir, args.subtract_file, args.output_dir, args.low_memory, args.block_rows, args.jobs)
@@ -0,0 +1,66 @@
+import os
+import numpy as np
+import pytest
+from tifffile import imread, imwrite
+from batch import SHARED, map_ordered, shared_arrays
+from subtract import subtract_images
+from flat_correction import process_images
+
+
+def shared_sum(key):
+    # spawn したワーカーで共有メモリから読んだ配列の合計
+    return float(SHARED[key].sum())
+
+
+def test_shared_arrays_attach_in_workers():
+    array = np.arange(1000, dtype=np.uint16).reshape(10, 100)
+    with shared_arrays({"ref": array}, jobs=2) as (initializer, initargs):
+        results = list(map_ordered(shared_sum, ["ref"] * 4, 2, initializer=initializer, initargs=initargs))
+    assert [result for _, result, _ in results] == [float(array.sum())] * 4
+    assert all(error is None for _, _, error in results)
+    assert "ref" not in SHARED
+
+
+def test_map_ordered_reports_errors_in_order():
+    results = list(map_ordered(shared_sum, ["missing", "missing"], 1))
+    assert [item for item, _, _ in results] == ["missing", "missing"]
+    assert all(isinstance(error, KeyError) for _, _, error in results)
+
+
+@pytest.fixture
+def frames(tmp_path):
+    rng = np.random.default_rng(0)
+    shape = (24, 32, 3)
+    os.makedirs(tmp_path / "lights")
+    for i in range(5):
+        imwrite(str(tmp_path / "lights" / f"light_{i}.tif"), rng.integers(0, 65536, shape, dtype=np.uint16))
+    imwrite(str(tmp_path / "dark.tif"), rng.integers(0, 3000, shape, dtype=np.uint16))
+    flats = []
+    for c in "rgb":
+        path = str(tmp_path / f"flat_{c}.tif")
+        imwrite(path, rng.integers(20000, 40000, shape, dtype=np.uint16))
+        flats.append(path)
+    return tmp_path, flats
+
+
+def assert_same_dirs(a, b):
+    names = sorted(os.listdir(a))
+    assert names == sorted(os.listdir(b)) and len(names) == 5
+    for name in names:
+        np.testing.assert_array_equal(imread(os.path.join(a, name)), imread(os.path.join(b, name)))
+
+
+@pytest.mark.parametrize("low_memory", [False, True])
+def test_parallel_subtract_matches_serial(frames, low_memory):
+    root, _ = frames
+    subtract_images(str(root / "lights"), str(root / "dark.tif"), str(root / "serial"), low_memory, jobs=1)
+    subtract_images(str(root / "lights"), str(root / "dark.tif"), str(root / "parallel"), low_memory, jobs=2)
+    assert_same_dirs(root / "serial", root / "parallel")
+
+
+@pytest.mark.parametrize("low_memory", [False, True])
+def test_parallel_flat_correction_matches_serial(frames, low_memory):
+    root, flats = frames
+    process_images(str(root / "lights"), str(root / "serial"), *flats, low_memory, jobs=1)
+    process_images(str(root / "lights"), str(root / "parallel"), *flats, low_memory, jobs=2)
+    assert_same_dirs(root / "serial", root / "parallel")
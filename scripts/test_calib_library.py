@@ -0,0 +1,45 @@
+import numpy as np
+import pytest
+from tifffile import imwrite
+from nef2tif_with_NR import save_manifest
+from calib_library import add_master, select_master
+from pipeline import build_graph
+
+LIGHT = {"model": "NIKON Z 6", "iso": 1600, "exposure": 30.0, "date": "2025:03:27 22:00:00",
+         "lens": "NIKKOR Z 24-70mm f/4 S", "focal_length": 24.0, "aperture": 4.0}
+
+
+@pytest.fixture
+def library(tmp_path):
+    library = str(tmp_path / "library")
+    source = str(tmp_path / "master.tif")
+    imwrite(source, np.zeros((4, 4, 3), np.uint16))
+    add_master(library, "dark", source, dict(LIGHT, date="2025:03:01 22:00:00"))
+    add_master(library, "flat", source, dict(LIGHT, focal_length=70.0))
+    return library
+
+
+def test_flat_requires_matching_optics(library, tmp_path):
+    assert select_master(library, "flat", LIGHT) is None
+    assert select_master(library, "flat", dict(LIGHT, focal_length=70.0)) is not None
+    # 光学系が分からないフレームにはフラットを選ばない
+    assert select_master(library, "flat", dict(LIGHT, focal_length=70.0, lens=None)) is None
+    assert select_master(library, "dark", dict(LIGHT, lens=None))["kind"] == "dark"
+    assert select_master(library, "dark", dict(LIGHT, iso=3200)) is None
+    assert select_master(library, "dark", LIGHT, max_days=7) is None
+
+
+def test_pipeline_uses_library_only_for_none_dirs(library, tmp_path):
+    lights = tmp_path / "lights"
+    lights.mkdir()
+    save_manifest(str(lights), {"a.NEF": {"exif": dict(LIGHT, focal_length=70.0)}})
+    darks = tmp_path / "darks"
+    darks.mkdir()
+
+    nodes = {node["name"]: node for node in build_graph(str(lights), None, None, None, library=library)}
+    assert "library" in nodes["dark_light"]["params"] and "library" in nodes["flat_master"]["params"]
+
+    # 指定されたディレクトリは、ライブラリに合うマスターがあっても使う
+    nodes = {node["name"]: node for node in build_graph(str(lights), str(darks), None, None, library=library)}
+    assert nodes["dark_light"]["inputs"] == [str(darks)]
+    assert "library" in nodes["flat_master"]["params"]
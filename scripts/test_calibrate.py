@@ -0,0 +1,52 @@
+import os
+import numpy as np
+import pytest
+from tifffile import imread, imwrite
+from calibrate import calibrate_images
+from subtract import subtract_images
+from flat_correction import process_images
+
+
+@pytest.fixture
+def frames(tmp_path):
+    rng = np.random.default_rng(0)
+    shape = (24, 32, 3)
+    os.makedirs(tmp_path / "lights")
+    for i in range(3):
+        light = rng.integers(0, 65536, shape, dtype=np.uint16)
+        # ダーク以下の画素と飽和した画素も含める
+        light[0, 0] = 0
+        light[0, 1] = 65535
+        imwrite(str(tmp_path / "lights" / f"light_{i}.tif"), light)
+    imwrite(str(tmp_path / "dark.tif"), rng.integers(0, 3000, shape, dtype=np.uint16))
+    flats = []
+    for c in "rgb":
+        path = str(tmp_path / f"flat_{c}.tif")
+        imwrite(path, rng.integers(20000, 40000, shape, dtype=np.uint16))
+        flats.append(path)
+    return tmp_path, flats
+
+
+def read_dir(directory):
+    return {name: imread(os.path.join(directory, name)) for name in sorted(os.listdir(directory))}
+
+
+def test_single_pass_matches_two_steps(frames):
+    root, flats = frames
+    subtract_images(str(root / "lights"), str(root / "dark.tif"), str(root / "l_drk_subt"))
+    process_images(str(root / "l_drk_subt"), str(root / "two_steps"), *flats)
+    calibrate_images(str(root / "lights"), str(root / "single_pass"), str(root / "dark.tif"), *flats)
+
+    expected, result = read_dir(root / "two_steps"), read_dir(root / "single_pass")
+    assert list(result) == list(expected) and len(result) == 3
+    for name in expected:
+        np.testing.assert_array_equal(result[name], expected[name])
+
+
+def test_dark_only_matches_subtract(frames):
+    root, _ = frames
+    subtract_images(str(root / "lights"), str(root / "dark.tif"), str(root / "subtracted"))
+    calibrate_images(str(root / "lights"), str(root / "single_pass"), str(root / "dark.tif"))
+    expected, result = read_dir(root / "subtracted"), read_dir(root / "single_pass")
+    for name in expected:
+        np.testing.assert_array_equal(result[name], expected[name])
@@ -0,0 +1,101 @@
+import cv2
+import numpy as np
+import pytest
+import tifffile
+from alignment_loader import load_alignment
+
+al = load_alignment()
+
+
+def star_field(shape=(512, 768), n=80, seed=0):
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    image = rng.normal(100, 2, shape)
+    for y, x, a in zip(rng.uniform(0, shape[0], n), rng.uniform(0, shape[1], n), rng.uniform(500, 5000, n)):
+        image += a * np.exp(-((xx - x) ** 2 + (yy - y) ** 2) / 4.5)
+    return image.astype(np.float32)
+
+
+def shifted(image, dx, dy):
+    matrix = np.float32([[1, 0, dx], [0, 1, dy]])
+    return cv2.warpAffine(image, matrix, image.shape[::-1], flags=cv2.INTER_CUBIC)
+
+
+@pytest.mark.parametrize("dx, dy", [(3.3, -1.7), (-12.6, 8.25)])
+def test_phase_correlate_subpixel(dx, dy):
+    ref = star_field()
+    fx, fy, response = al.phase_correlate(ref, shifted(ref, dx, dy))
+    assert abs(fx - dx) < 0.15 and abs(fy - dy) < 0.15
+    assert response > 0.5
+
+
+def test_phase_correlate_integer_shift():
+    ref = star_field()
+    tgt = np.roll(ref, (5, -9), axis=(0, 1))
+    fx, fy, _ = al.phase_correlate(ref, tgt)
+    assert abs(fx + 9) < 0.05 and abs(fy - 5) < 0.05
+
+
+def test_phase_shift_large_offset():
+    # 切り出し範囲より大きなずれは縮小画像の粗い推定で拾う
+    ref = star_field(shape=(768, 1024))
+    dx, dy = -85.4, 120.6
+    fx, fy, _ = al.phase_shift(ref, shifted(ref, dx, dy), levels=3, crop=256)
+    assert abs(fx - dx) < 0.15 and abs(fy - dy) < 0.15
+
+
+def write_frame(path, dx, dy):
+    frame = np.clip(shifted(star_field(shape=(256, 384)), dx, dy), 0, 65535).astype(np.uint16)
+    tifffile.imwrite(str(path), np.repeat(frame[:, :, None], 3, axis=2))
+
+
+def test_solutions_round_trip(tmp_path):
+    path = str(tmp_path / "solutions.json")
+    store = {"reference": {"path": "a.tif", "hash": "abc"},
+             "frames": {"b.tif": {"hash": "def", "status": "ok", "matrix": [[1.0, 0.0, 2.5], [0.0, 1.0, -1.0]]}}}
+    al.save_solutions(path, store)
+    assert al.load_solutions(path) == store
+    assert al.load_solutions(str(tmp_path / "missing.json")) is None
+    (tmp_path / "broken.json").write_text("{")
+    assert al.load_solutions(str(tmp_path / "broken.json")) is None
+
+
+def test_frame_hash_follows_content(tmp_path):
+    path = tmp_path / "a.tif"
+    path.write_bytes(b"x" * 5000)
+    digest = al.frame_hash(str(path))
+    path.write_bytes(b"x" * 4999 + b"y")
+    assert al.frame_hash(str(path)) != digest
+
+
+def test_rerun_reuses_solutions(tmp_path, capsys):
+    frames = tmp_path / "frames"
+    frames.mkdir()
+    for i, (dx, dy) in enumerate([(0, 0), (2.5, -1.5), (-4.0, 3.25)]):
+        write_frame(frames / f"f{i}.tif", dx, dy)
+    output = str(tmp_path / "stack.tif")
+    al.main(str(frames), output, 30, register="phase", jobs=1)
+    solutions = al.load_solutions(str(frames / al.SOLUTIONS_NAME))
+    assert [solutions["frames"][n]["status"] for n in ("f1.tif", "f2.tif")] == ["ok", "ok"]
+    assert abs(solutions["frames"]["f1.tif"]["matrix"][0][2] + 2.5) < 0.15
+
+    capsys.readouterr()
+    al.main(str(frames), output, 30, register="phase", jobs=1)
+    out = capsys.readouterr().out
+    assert "2 frame(s) reused" in out
+    assert "(dx, dy)" not in out
+
+    # 内容の変わったフレームだけ位置合わせし直す
+    write_frame(frames / "f2.tif", 6.0, 1.0)
+    al.main(str(frames), output, 30, register="phase", jobs=1)
+    out = capsys.readouterr().out
+    assert "1 frame(s) reused" in out
+    solutions = al.load_solutions(str(frames / al.SOLUTIONS_NAME))
+    assert abs(solutions["frames"]["f2.tif"]["matrix"][0][2] + 6.0) < 0.15
+
+    # 自動の位置合わせで保存した結果は、方式を変えるか --reregister で求め直す
+    capsys.readouterr()
+    al.main(str(frames), output, 30, auto=True, jobs=1, interactive=False)
+    assert "reused" not in capsys.readouterr().out
+    al.main(str(frames), output, 30, register="phase", jobs=1, reregister=True)
+    assert "reused" not in capsys.readouterr().out
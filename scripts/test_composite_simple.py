@@ -0,0 +1,71 @@
+import sys
+import numpy as np
+import pytest
+import composite_simple
+from composite_simple import METHODS, composite_images, composite_images_tiled, tile_rows_for_budget, \
+    sigma_clip_mean, winsorized_mean
+
+
+def make_frames(n=5, shape=(37, 23, 3), seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 65536, shape, dtype=np.uint16) for _ in range(n)]
+
+
+@pytest.mark.parametrize("method", METHODS)
+def test_tiled_matches_in_memory(method):
+    frames = make_frames()
+    expected = composite_images(frames, method)
+    # 数行ずつのタイルになる小さな予算
+    tiled = composite_images_tiled([(f, None) for f in frames], method, max_memory=20000)
+    np.testing.assert_array_equal(tiled, expected)
+
+
+def test_tile_rows_fit_budget():
+    rows = tile_rows_for_budget(10, 100, 3, "mean", 1 << 20)
+    assert rows * 10 * 100 * 3 * 2 <= 1 << 20
+    assert tile_rows_for_budget(10, 100, 3, "sigma-clip", 1 << 20) < rows
+
+
+def test_tiled_rejects_shape_mismatch():
+    frames = [(np.zeros((4, 4, 3), np.uint16), None), (np.zeros((5, 4, 3), np.uint16), None)]
+    assert composite_images_tiled(frames, "mean") is None
+
+
+def test_sigma_clip_rejects_outlier():
+    stack = np.full((8, 4, 4), 1000, dtype=np.uint16)
+    stack[3, 1, 2] = 60000
+    result = sigma_clip_mean(stack, kappa=3.0)
+    np.testing.assert_allclose(result, 1000)
+
+
+def test_sigma_clip_never_rejects_every_sample():
+    rng = np.random.default_rng(1)
+    stack = rng.normal(1000, 50, (7, 16, 16)).astype(np.uint16)
+    with np.errstate(all="raise"):
+        result = sigma_clip_mean(stack, kappa=0.1)
+    assert np.all(np.isfinite(result))
+    assert np.all((result >= stack.min(axis=0)) & (result <= stack.max(axis=0)))
+
+
+def test_winsorized_limits_outlier():
+    stack = np.full((8, 2, 2), 1000, dtype=np.uint16)
+    stack[0, 0, 0] = 60000
+    result = winsorized_mean(stack, kappa=3.0)
+    assert 1000 <= result[0, 0] < stack[:, 0, 0].mean()
+    np.testing.assert_allclose(result[1, 1], 1000)
+
+
+def test_median_method():
+    frames = make_frames(n=5)
+    expected = np.median(np.stack(frames), axis=0).astype(np.uint16)
+    np.testing.assert_array_equal(composite_images(frames, "median"), expected)
+
+
+@pytest.mark.parametrize("options", [["-m", "median"], ["-m", "sigma-clip"], ["--max-memory", "1G"]])
+def test_partial_rejects_unsupported_options(options, tmp_path, monkeypatch, capsys):
+    # 部分スタックでは使えない方式・オプションは黙って無視せずエラーにする
+    monkeypatch.setattr(sys, "argv", ["composite_simple.py", str(tmp_path), "--partial", str(tmp_path / "p.npz")] + options)
+    monkeypatch.setattr(composite_simple, "run_instrumented", lambda *args: pytest.fail("should not run"))
+    with pytest.raises(SystemExit):
+        composite_simple.main()
+    assert "--partial" in capsys.readouterr().err
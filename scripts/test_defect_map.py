@@ -0,0 +1,135 @@
+import os
+import sys
+import runpy
+import numpy as np
+import pytest
+import tifffile
+from defect_map import correct_defects, correct_file, correct_files, find_defects, list_files, load_defect_map, \
+    make_defect_map, save_defect_map
+
+
+def flat_dark(shape, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.normal(200, 5, shape).clip(0).astype(np.uint16)
+
+
+def test_find_defects_rgb():
+    dark = flat_dark((40, 50, 3))
+    dark[3, 4, 1] = 5000
+    dark[39, 49, 2] = 9000
+    assert find_defects(dark).tolist() == [[3, 4, 1], [39, 49, 2]]
+
+
+def test_find_defects_cfa():
+    # ベイヤー配列は色位相ごとに判定するため、明るい位相の画素は欠陥にならない
+    dark = flat_dark((40, 50))
+    dark[1::2, 1::2] += 1000
+    dark[6, 7] = 9000
+    dark[20, 20] = 9000
+    assert find_defects(dark).tolist() == [[6, 7], [20, 20]]
+
+
+def test_correct_rgb_uses_same_channel_median():
+    image = np.zeros((20, 20, 3), dtype=np.uint16)
+    image[..., 0] = 100
+    image[..., 1] = 500
+    image[8, 8, 0] = 60000
+    defects = make_defect_map([[8, 8, 0]], image.shape)
+    before = image.copy()
+    assert correct_defects(image, defects) == 1
+    assert image[8, 8, 0] == 100
+    # 欠陥画素以外には触れない
+    image[8, 8, 0] = before[8, 8, 0]
+    np.testing.assert_array_equal(image, before)
+
+
+def test_correct_cfa_uses_same_color_neighbours():
+    image = np.full((20, 20), 1000, dtype=np.float32)
+    image[0::2, 0::2] = 300
+    image[10, 10] = 9000
+    assert correct_defects(image, make_defect_map([[10, 10]], image.shape)) == 1
+    assert image[10, 10] == 300
+
+
+def test_correct_skips_defect_neighbours():
+    image = np.full((20, 20, 3), 100, dtype=np.uint16)
+    image[5:8, 5:8, 1] = 60000
+    # 3x3 のかたまりの中心も、かたまりの外側の近傍だけで置き換える
+    coords = [[y, x, 1] for y in range(5, 8) for x in range(5, 8)]
+    assert correct_defects(image, make_defect_map(coords, image.shape)) == 9
+    assert np.all(image[5:8, 5:8, 1] == 100)
+
+
+def test_unrepairable_pixels_are_not_counted():
+    # 同色近傍がすべて欠陥の中心画素は置き換えられず、置き換えた画素数にも含めない
+    image = np.full((20, 20), 100, dtype=np.uint16)
+    coords = [[y, x] for y in range(6, 11, 2) for x in range(6, 11, 2)]
+    image[6:11:2, 6:11:2] = 60000
+    assert correct_defects(image, make_defect_map(coords, image.shape)) == 8
+    assert image[8, 8] == 60000
+    assert np.count_nonzero(image == 60000) == 1
+
+
+def test_shape_mismatch():
+    defects = make_defect_map([[1, 1]], (10, 10))
+    with pytest.raises(ValueError):
+        correct_defects(np.zeros((10, 12), np.uint16), defects)
+    assert correct_defects(np.zeros((10, 10), np.uint16), make_defect_map([], (10, 10))) == 0
+
+
+def test_map_round_trip_and_file_correction(tmp_path):
+    image = np.full((16, 16, 3), 100, dtype=np.uint16)
+    image[4, 5, 2] = 60000
+    defects = make_defect_map([[4, 5, 2]], image.shape, sigma=4.0)
+    save_defect_map(str(tmp_path / "defects.npz"), defects)
+    loaded = load_defect_map(str(tmp_path / "defects.npz"))
+    np.testing.assert_array_equal(loaded["coords"], defects["coords"])
+    assert loaded["shape"] == image.shape and loaded["sigma"] == 4.0
+
+    tifffile.imwrite(str(tmp_path / "a.tif"), image)
+    (tmp_path / "out").mkdir()
+    out_path, corrected = correct_file(str(tmp_path / "a.tif"), loaded, str(tmp_path / "out"))
+    assert corrected == 1
+    assert tifffile.imread(out_path)[4, 5, 2] == 100
+    # 出力先を指定したときは元のファイルを書き換えない
+    assert tifffile.imread(str(tmp_path / "a.tif"))[4, 5, 2] == 60000
+
+
+def run_apply(argv, monkeypatch):
+    monkeypatch.setattr(sys, "argv", ["defect_map.py", "apply"] + argv)
+    runpy.run_path(os.path.join(os.path.dirname(__file__), "defect_map.py"), run_name="__main__")
+
+
+def test_apply_needs_output_dir_or_in_place(tmp_path, monkeypatch, capsys):
+    image = np.full((8, 8, 3), 100, dtype=np.uint16)
+    image[4, 5, 2] = 60000
+    in_dir = tmp_path / "in"
+    in_dir.mkdir()
+    tifffile.imwrite(str(in_dir / "a.tif"), image)
+    tifffile.imwrite(str(in_dir / "b.TIFF"), image)
+    save_defect_map(str(tmp_path / "defects.npz"), make_defect_map([[4, 5, 2]], image.shape))
+    assert [os.path.basename(p) for p in list_files([str(in_dir)])] == ["a.tif", "b.TIFF"]
+
+    # 出力先も --in-place もなければ入力を書き換えずにエラー
+    for argv in [[], ["-o", str(tmp_path / "out"), "--in-place"]]:
+        with pytest.raises(SystemExit):
+            run_apply([str(tmp_path / "defects.npz"), str(in_dir)] + argv, monkeypatch)
+        assert "--in-place" in capsys.readouterr().err
+    assert tifffile.imread(str(in_dir / "a.tif"))[4, 5, 2] == 60000
+
+    run_apply([str(tmp_path / "defects.npz"), str(in_dir), "-o", str(tmp_path / "out")], monkeypatch)
+    assert tifffile.imread(str(tmp_path / "out" / "b.TIFF"))[4, 5, 2] == 100
+    assert tifffile.imread(str(in_dir / "a.tif"))[4, 5, 2] == 60000
+
+    run_apply([str(tmp_path / "defects.npz"), str(in_dir / "a.tif"), "--in-place"], monkeypatch)
+    assert tifffile.imread(str(in_dir / "a.tif"))[4, 5, 2] == 100
+
+
+def test_correct_files_reports_failures(tmp_path, capsys):
+    image = np.full((8, 8, 3), 100, dtype=np.uint16)
+    tifffile.imwrite(str(tmp_path / "a.tif"), image)
+    defects = make_defect_map([[4, 5, 2]], image.shape)
+    failed = correct_files([str(tmp_path / "a.tif"), str(tmp_path / "missing.tif")], defects, str(tmp_path / "out"), jobs=2)
+    assert failed == 1
+    out = capsys.readouterr().out
+    assert "a.tif : 1/1 pixel(s) corrected" in out and "*** Failed" in out
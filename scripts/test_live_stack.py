@@ -0,0 +1,98 @@
+import os
+import numpy as np
+import pytest
+from tifffile import imread
+import live_stack
+
+
+SHAPE = (48, 64, 3)
+
+
+def make_base(seed=0):
+    # 背景 + ガウス星のフレーム
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:SHAPE[0], :SHAPE[1]]
+    base = np.full(SHAPE[:2], 1000.0)
+    for cy, cx in rng.uniform(8, 40, (12, 2)):
+        base += 20000.0 * np.exp(-((y - cy) ** 2 + (x - cx) ** 2) / 4.0)
+    return base
+
+
+@pytest.fixture
+def camera(tmp_path, monkeypatch):
+    # develop_frame を差し替え、ファイル名から合成フレームを返す (全フレーム同じ位置で明るさだけ違う)
+    watch_dir = tmp_path / "incoming"
+    watch_dir.mkdir()
+    base = make_base()
+    frames = {}
+    developed = []
+
+    def add(name, offset):
+        (watch_dir / name).write_bytes(name.encode() * 10)
+        frames[name] = np.repeat((base + offset)[:, :, None], 3, axis=2).astype(np.uint16)
+
+    def develop_frame(path, dark=None, flat=None, defects=None):
+        developed.append(os.path.basename(path))
+        return frames[os.path.basename(path)]
+
+    monkeypatch.setattr(live_stack, "develop_frame", develop_frame)
+    return {"dir": str(watch_dir), "add": add, "frames": frames, "developed": developed}
+
+
+def run(camera, work_dir, **kwargs):
+    live_stack.watch(camera["dir"], str(work_dir), register="phase", settle=0.0, once=True, **kwargs)
+    return live_stack.load_checkpoint(os.path.join(str(work_dir), live_stack.CHECKPOINT_NAME))
+
+
+def expected_sum(camera, names):
+    return np.sum([camera["frames"][name].astype(np.uint32) for name in names], axis=0)
+
+
+def test_resume_does_not_double_count(camera, tmp_path):
+    work_dir = tmp_path / "work"
+    for i, name in enumerate(["a.NEF", "b.NEF", "c.NEF"]):
+        camera["add"](name, 10 * i)
+    stack = run(camera, work_dir)
+    assert stack["count"] == 3
+    assert stack["registered_to"].startswith("a.NEF:")
+    np.testing.assert_array_equal(stack["sum"], expected_sum(camera, ["a.NEF", "b.NEF", "c.NEF"]))
+
+    # 基準フレームの輝度は保存せず、再起動時に基準の NEF を現像し直す
+    with np.load(work_dir / live_stack.CHECKPOINT_NAME) as data:
+        assert sorted(data.files) == ["count", "registered_to", "state", "sum", "version"]
+        assert data["sum"].dtype == np.uint32
+
+    camera["add"]("d.NEF", 30)
+    camera["developed"].clear()
+    stack = run(camera, work_dir)
+    assert camera["developed"] == ["a.NEF", "d.NEF"]
+    assert stack["count"] == 4
+    assert sorted(stack["frames"]) == ["a.NEF", "b.NEF", "c.NEF", "d.NEF"]
+    names = ["a.NEF", "b.NEF", "c.NEF", "d.NEF"]
+    np.testing.assert_array_equal(stack["sum"], expected_sum(camera, names))
+
+    preview = imread(str(work_dir / live_stack.PREVIEW_NAME))
+    np.testing.assert_array_equal(preview, (expected_sum(camera, names) / 4).astype(np.uint16))
+
+    # 新しいフレームがなければ何も足さない
+    stack = run(camera, work_dir)
+    assert stack["count"] == 4
+
+
+def test_checkpoint_every_saves_at_exit(camera, tmp_path):
+    work_dir = tmp_path / "work"
+    for i, name in enumerate(["a.NEF", "b.NEF", "c.NEF"]):
+        camera["add"](name, 10 * i)
+    stack = run(camera, work_dir, checkpoint_every=2)
+    assert stack["count"] == 3
+    np.testing.assert_array_equal(stack["sum"], expected_sum(camera, ["a.NEF", "b.NEF", "c.NEF"]))
+
+
+def test_missing_reference_frame_is_an_error(camera, tmp_path):
+    work_dir = tmp_path / "work"
+    camera["add"]("a.NEF", 0)
+    camera["add"]("b.NEF", 10)
+    run(camera, work_dir)
+    os.remove(os.path.join(camera["dir"], "a.NEF"))
+    with pytest.raises(RuntimeError, match="reference frame a.NEF"):
+        run(camera, work_dir)
@@ -0,0 +1,78 @@
+import os
+import pytest
+import nef2tif_with_NR as nef2tif
+
+
+@pytest.fixture
+def converted(monkeypatch):
+    # 現像の代わりに出力ファイルを書くだけにして、変換したファイルを記録する
+    calls = []
+
+    def fake_convert(path, output_dir, params=nef2tif.DECODE_PARAMS):
+        out_path = os.path.join(output_dir, nef2tif.output_name(path, params))
+        if params.get("thumbnail"):
+            # JPEG でないサムネイルは .tif で書き出される
+            out_path = os.path.splitext(out_path)[0] + ".tif"
+        with open(out_path, "wb") as f:
+            f.write(b"out:" + os.path.basename(path).encode())
+        calls.append(os.path.basename(path))
+        return out_path
+
+    monkeypatch.setattr(nef2tif, "convert_file", fake_convert)
+    return calls
+
+
+@pytest.fixture
+def nef_dir(tmp_path):
+    d = tmp_path / "nef"
+    d.mkdir()
+    for name in ["a.NEF", "b.NEF"]:
+        (d / name).write_bytes(b"raw " + name.encode())
+    return d
+
+
+def run(nef_dir, out_dir, calls, **kwargs):
+    calls.clear()
+    nef2tif.main(str(nef_dir), str(out_dir), **kwargs)
+    return sorted(calls)
+
+
+def test_rerun_skips_unchanged(nef_dir, tmp_path, converted):
+    out = tmp_path / "out"
+    assert run(nef_dir, out, converted) == ["a.NEF", "b.NEF"]
+    assert run(nef_dir, out, converted) == []
+
+
+def test_changed_source_is_reconverted(nef_dir, tmp_path, converted):
+    out = tmp_path / "out"
+    run(nef_dir, out, converted)
+    (nef_dir / "b.NEF").write_bytes(b"new content")
+    assert run(nef_dir, out, converted) == ["b.NEF"]
+
+
+def test_missing_output_is_reconverted(nef_dir, tmp_path, converted):
+    out = tmp_path / "out"
+    run(nef_dir, out, converted)
+    (out / "a.tif").unlink()
+    assert run(nef_dir, out, converted) == ["a.NEF"]
+
+
+def test_changed_params_and_force(nef_dir, tmp_path, converted):
+    out = tmp_path / "out"
+    run(nef_dir, out, converted)
+    assert run(nef_dir, out, converted, strip_orientation=True) == ["a.NEF", "b.NEF"]
+    assert run(nef_dir, out, converted, strip_orientation=True, force=True) == ["a.NEF", "b.NEF"]
+
+
+def test_hash_ignores_touched_files(nef_dir, tmp_path, converted):
+    out = tmp_path / "out"
+    run(nef_dir, out, converted, use_hash=True)
+    st = os.stat(nef_dir / "a.NEF")
+    os.utime(nef_dir / "a.NEF", ns=(st.st_atime_ns, st.st_mtime_ns + 10 ** 9))
+    assert run(nef_dir, out, converted, use_hash=True) == []
+
+
+def test_thumbnail_written_as_tif_is_up_to_date(nef_dir, tmp_path, converted):
+    out = tmp_path / "draft"
+    assert run(nef_dir, tmp_path, converted, draft="thumb", draft_dir=str(out)) == ["a.NEF", "b.NEF"]
+    assert run(nef_dir, tmp_path, converted, draft="thumb", draft_dir=str(out)) == []
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+from partial_stack import accumulate, empty_partial, finalize_partial, frame_key, load_partial, merge_partials, \
+    parse_shard, save_partial, shard_indices
+
+
+def make_frames(n=7, shape=(9, 11, 3), seed=0):
+    rng = np.random.default_rng(seed)
+    return [rng.integers(0, 65536, shape, dtype=np.uint16) for _ in range(n)]
+
+
+def stack(frames, indices, registered_to=None):
+    partial = empty_partial(registered_to)
+    for i in indices:
+        accumulate(partial, frames[i], f"f{i}.tif:hash{i}")
+    return partial
+
+
+def test_shard_indices_cover_every_frame_once():
+    assert parse_shard("1/3") == (1, 3)
+    with pytest.raises(ValueError):
+        parse_shard("3/3")
+    shards = [shard_indices(10, (k, 3)) for k in range(3)]
+    assert sorted(sum(shards, [])) == list(range(10))
+
+
+@pytest.mark.parametrize("method", ["mean", "max", "min", "std"])
+def test_sharded_merge_matches_full_stack(method):
+    frames = make_frames()
+    full = stack(frames, range(len(frames)))
+    shards = [stack(frames, shard_indices(len(frames), (k, 3))) for k in range(3)]
+    # マージの順序によらず一致する
+    merged = merge_partials(reversed(shards))
+    assert merged["count"] == len(frames)
+    np.testing.assert_array_equal(finalize_partial(merged, method), finalize_partial(full, method))
+
+
+def test_finalize_mean_and_std():
+    frames = make_frames()
+    data = np.stack(frames).astype(np.float64)
+    partial = stack(frames, range(len(frames)))
+    np.testing.assert_array_equal(finalize_partial(partial, "mean"), data.mean(axis=0).astype(np.uint16))
+    np.testing.assert_allclose(finalize_partial(partial, "std"), data.std(axis=0), atol=1)
+    with pytest.raises(ValueError):
+        finalize_partial(partial, "median")
+
+
+def test_merge_rejects_duplicate_frames():
+    frames = make_frames()
+    with pytest.raises(ValueError, match="stacked twice"):
+        merge_partials([stack(frames, [0, 1]), stack(frames, [1, 2])])
+
+
+def test_merge_rejects_different_reference():
+    frames = make_frames()
+    with pytest.raises(ValueError, match="different reference frames"):
+        merge_partials([stack(frames, [0, 1], "f0.tif:hash0"), stack(frames, [2, 3], "g0.tif:other")])
+    merged = merge_partials([stack(frames, [0, 1], "f0.tif:hash0"), stack(frames, [2, 3], "f0.tif:hash0")])
+    assert merged["registered_to"] == "f0.tif:hash0"
+
+
+def test_save_load_round_trip(tmp_path):
+    frames = make_frames()
+    partial = stack(frames, [0, 2, 4], "f0.tif:hash0")
+    path = str(tmp_path / "part.npz")
+    save_partial(path, partial)
+    loaded = load_partial(path)
+    assert loaded["count"] == 3
+    assert loaded["frames"] == partial["frames"]
+    assert loaded["registered_to"] == "f0.tif:hash0"
+    for key in ["sum", "sumsq", "min", "max"]:
+        np.testing.assert_array_equal(loaded[key], partial[key])
+    with pytest.raises(ValueError):
+        save_partial(str(tmp_path / "empty.npz"), empty_partial())
+
+
+def test_frame_key_ignores_directory(tmp_path):
+    # マシンごとにマウント先が違っても同じキーになり、内容が違えば別のキーになる
+    for name in ["a", "b"]:
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "f0.tif").write_bytes(b"frame")
+    assert frame_key(str(tmp_path / "a" / "f0.tif")) == frame_key(str(tmp_path / "b" / "f0.tif"))
+    (tmp_path / "b" / "f0.tif").write_bytes(b"other")
+    assert frame_key(str(tmp_path / "a" / "f0.tif")) != frame_key(str(tmp_path / "b" / "f0.tif"))
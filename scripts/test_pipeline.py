@@ -0,0 +1,31 @@
+import os
+import shutil
+import numpy as np
+import pytest
+from tifffile import imread
+from benchmark import generate_dataset
+from pipeline import build_graph, run_graph
+
+
+@pytest.fixture(scope="module")
+def dataset(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp("data")
+    generate_dataset(str(data_dir), 320, 240, 4, n_stars=80, max_shift=5.0, max_angle=0.2)
+    os.makedirs(data_dir / "flats")
+    for i in range(2):
+        shutil.copyfile(data_dir / "flat.tif", data_dir / "flats" / f"flat_{i}.tif")
+    return data_dir
+
+
+def test_pipeline_end_to_end(dataset, tmp_path, capsys):
+    nodes = build_graph(str(dataset / "lights"), str(dataset / "darks"), str(dataset / "flats"), None, box_size=20)
+    outputs = run_graph(nodes, str(tmp_path / "cache"))
+    assert set(outputs) == {"dark_light", "flat_master", "flat_channels", "lights_cal", "composite"}
+    composite = imread(outputs["composite"])
+    assert composite.shape == (240, 320, 3) and composite.dtype == np.uint16
+    assert len(os.listdir(outputs["lights_cal"])) == 4
+
+    # 入力が変わらなければすべてキャッシュから返す
+    capsys.readouterr()
+    assert run_graph(nodes, str(tmp_path / "cache")) == outputs
+    assert "BEGIN" not in capsys.readouterr().out
@@ -0,0 +1,109 @@
+import numpy as np
+import pytest
+from tifffile import imread, imwrite
+import raw_calibration
+from raw_calibration import FLAT_SCALE, calibrate_mosaic, calibrate_raw_images, load_master_dark, load_master_flat, \
+    make_master_dark, make_master_flat
+
+SHAPE = (16, 20)
+BLACK = [512, 520, 528, 516]
+WHITE = 16383
+
+
+class StubRaw:
+    # rawpy.RawPy のうち raw_calibration.py が使う属性だけを持つ RGGB のモザイク
+
+    def __init__(self, mosaic):
+        self.raw_image_visible = mosaic.astype(np.uint16)
+        self.raw_colors_visible = np.tile(np.array([[0, 1], [3, 2]], dtype=np.uint8), (SHAPE[0] // 2, SHAPE[1] // 2))
+        self.black_level_per_channel = BLACK
+        self.white_level = WHITE
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+def black_map():
+    return np.array(BLACK, dtype=np.float64)[StubRaw(np.zeros(SHAPE)).raw_colors_visible]
+
+
+@pytest.fixture
+def scene():
+    rng = np.random.default_rng(0)
+    dark_current = rng.integers(0, 50, SHAPE).astype(np.float64)
+    dark_current[3, 4] = 3000
+    signal = rng.integers(100, 5000, SHAPE).astype(np.float64)
+    flat = rng.uniform(0.5, 1.0, SHAPE)
+    return dark_current, signal, flat
+
+
+def test_calibrate_mosaic_restores_black_level(scene):
+    dark_current, signal, flat = scene
+    black = black_map()
+    raw = StubRaw(np.rint(black + dark_current + signal * flat))
+    # ダークはブラックレベルを含む raw 値、フラットは FLAT_SCALE 倍の uint16
+    calibrate_mosaic(raw, (black + dark_current).astype(np.uint16), np.rint(flat * FLAT_SCALE).astype(np.uint16))
+    np.testing.assert_allclose(raw.raw_image_visible, black + signal, atol=1)
+
+
+def test_calibrate_mosaic_without_dark_subtracts_black(scene):
+    _, signal, _ = scene
+    black = black_map()
+    raw = StubRaw(black + signal)
+    calibrate_mosaic(raw)
+    np.testing.assert_array_equal(raw.raw_image_visible, black + signal)
+
+    # ブラックレベル未満は黒に、補正後の値は白レベルで止める
+    raw = StubRaw(np.where(signal > 2500, WHITE, 0))
+    calibrate_mosaic(raw, flat=np.full(SHAPE, FLAT_SCALE / 4, dtype=np.uint16))
+    assert raw.raw_image_visible.max() == WHITE
+    np.testing.assert_array_equal(raw.raw_image_visible[signal <= 2500], black[signal <= 2500])
+
+
+def test_masters_are_uint16_and_calibrate_frames(scene, tmp_path, monkeypatch):
+    dark_current, signal, flat = scene
+    black = black_map()
+    rng = np.random.default_rng(1)
+    mosaics = {}
+    for kind, count in [("dark", 3), ("flat", 2), ("light", 2)]:
+        (tmp_path / kind).mkdir()
+        for i in range(count):
+            path = tmp_path / kind / f"{kind}_{i}.NEF"
+            path.write_bytes(b"")
+            if kind == "dark":
+                mosaics[str(path)] = black + dark_current + rng.integers(-2, 3, SHAPE)
+            elif kind == "flat":
+                mosaics[str(path)] = black + 10000 * flat
+            else:
+                mosaics[str(path)] = np.rint(black + dark_current + signal * flat)
+    monkeypatch.setattr(raw_calibration.rawpy, "imread", lambda path: StubRaw(mosaics[path]))
+    # デモザイクの代わりに補正後のモザイクをそのまま書き出す
+    monkeypatch.setattr(raw_calibration, "postprocess_raw", lambda raw, params: raw.raw_image_visible.copy())
+
+    make_master_dark(str(tmp_path / "dark"), str(tmp_path / "dark_cfa.tif"))
+    make_master_flat(str(tmp_path / "flat"), str(tmp_path / "flat_cfa.tif"))
+    for name in ["dark_cfa.tif", "flat_cfa.tif"]:
+        master = imread(str(tmp_path / name))
+        assert master.dtype == np.uint16 and master.shape == SHAPE
+    np.testing.assert_allclose(load_master_dark(str(tmp_path / "dark_cfa.tif")), black + dark_current, atol=2)
+
+    calibrate_raw_images(str(tmp_path / "light"), str(tmp_path / "out"),
+                         str(tmp_path / "dark_cfa.tif"), str(tmp_path / "flat_cfa.tif"))
+    for i in range(2):
+        result = imread(str(tmp_path / "out" / f"light_{i}.tif"))
+        # フラットは CFA の色ごとの最大値で正規化されるため、信号には色ごとの最大値が掛かる
+        colors = StubRaw(np.zeros(SHAPE)).raw_colors_visible
+        for color in range(4):
+            mask = colors == color
+            np.testing.assert_allclose(result[mask], black[mask] + signal[mask] * flat[mask].max(), rtol=1e-3, atol=3)
+
+
+def test_legacy_float_masters(tmp_path):
+    imwrite(str(tmp_path / "dark.tif"), np.full(SHAPE, 600.4, dtype=np.float32))
+    imwrite(str(tmp_path / "flat.tif"), np.full(SHAPE, 0.5, dtype=np.float32))
+    assert load_master_dark(str(tmp_path / "dark.tif")).dtype == np.uint16
+    assert load_master_dark(str(tmp_path / "dark.tif"))[0, 0] == 600
+    np.testing.assert_array_equal(load_master_flat(str(tmp_path / "flat.tif")), np.rint(0.5 * FLAT_SCALE))
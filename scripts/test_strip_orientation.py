@@ -0,0 +1,108 @@
+import os
+import struct
+import numpy as np
+import pytest
+import tifffile
+from strip_orientation import ORIENTATION, EXIF_IFD, SUB_IFDS, list_files, strip_files, strip_orientation
+
+
+def make_image():
+    return np.arange(4 * 6 * 3, dtype=np.uint16).reshape(4, 6, 3)
+
+
+def write_tiff(path, byteorder, orientation=6):
+    tifffile.imwrite(str(path), make_image(), byteorder=byteorder, extratags=[(ORIENTATION, "H", 1, orientation, True)])
+
+
+def read_orientation(path):
+    with tifffile.TiffFile(str(path)) as tif:
+        return tif.pages[0].tags["Orientation"].value
+
+
+def write_ifd_tree(path, order):
+    # IFD0 -> SubIFD x 2 (ポインタの配列) と EXIF IFD。すべての IFD に Orientation を持つ最小の TIFF
+    def ifd(entries, next_offset=0):
+        data = struct.pack(order + "H", len(entries))
+        for tag, typ, count, value in entries:
+            if typ == 3:
+                data += struct.pack(order + "HHIH2x", tag, typ, count, value)
+            else:
+                data += struct.pack(order + "HHII", tag, typ, count, value)
+        return data + struct.pack(order + "I", next_offset)
+
+    ifd0_size = 2 + 12 * 3 + 4
+    leaf_size = 2 + 12 + 4
+    sub_array = 8 + ifd0_size
+    sub_ifds = [sub_array + 8, sub_array + 8 + leaf_size]
+    exif = sub_ifds[1] + leaf_size
+    data = (b"II" if order == "<" else b"MM") + struct.pack(order + "HI", 42, 8)
+    data += ifd([(ORIENTATION, 3, 1, 6), (SUB_IFDS, 4, 2, sub_array), (EXIF_IFD, 4, 1, exif)])
+    data += struct.pack(order + "II", *sub_ifds)
+    data += ifd([(ORIENTATION, 3, 1, 8)]) + ifd([(ORIENTATION, 3, 1, 1)]) + ifd([(ORIENTATION, 3, 1, 3)])
+    path.write_bytes(data)
+
+
+def orientation_values(path, order):
+    data = path.read_bytes()
+    values = []
+    position = 0
+    while True:
+        position = data.find(struct.pack(order + "HHI", ORIENTATION, 3, 1), position)
+        if position < 0:
+            return values
+        values.append(struct.unpack(order + "H", data[position + 8:position + 10])[0])
+        position += 2
+
+
+@pytest.mark.parametrize("byteorder", ["<", ">"])
+def test_strip_tifffile_output(byteorder, tmp_path):
+    path = tmp_path / "a.tif"
+    write_tiff(path, byteorder)
+    size = path.stat().st_size
+    assert strip_orientation(str(path)) == 1
+    assert read_orientation(path) == 1
+    # 画素データ・ファイルサイズは変わらない
+    assert path.stat().st_size == size
+    np.testing.assert_array_equal(tifffile.imread(str(path)), make_image())
+    assert strip_orientation(str(path)) == 0
+
+
+@pytest.mark.parametrize("order", ["<", ">"])
+def test_strip_sub_ifds_and_exif_ifd(order, tmp_path):
+    path = tmp_path / "a.nef"
+    write_ifd_tree(path, order)
+    assert orientation_values(path, order) == [6, 8, 1, 3]
+    # 既に 1 のものは書き換えない
+    assert strip_orientation(str(path)) == 3
+    assert orientation_values(path, order) == [1, 1, 1, 1]
+
+
+def test_rejects_non_tiff_and_bigtiff(tmp_path):
+    (tmp_path / "a.tif").write_bytes(b"not a tiff file")
+    with pytest.raises(ValueError, match="not a TIFF"):
+        strip_orientation(str(tmp_path / "a.tif"))
+
+    tifffile.imwrite(str(tmp_path / "b.tif"), make_image(), bigtiff=True)
+    original = (tmp_path / "b.tif").read_bytes()
+    with pytest.raises(ValueError, match="BigTIFF"):
+        strip_orientation(str(tmp_path / "b.tif"))
+    assert (tmp_path / "b.tif").read_bytes() == original
+
+
+def test_output_dir_leaves_source_untouched(tmp_path, capsys):
+    src = tmp_path / "in"
+    src.mkdir()
+    write_tiff(src / "a.tif", "<")
+    write_tiff(src / "b.TIF", ">", orientation=8)
+    (src / "notes.txt").write_text("ignored")
+    (src / "c.tif").write_bytes(b"broken")
+    originals = {p.name: p.read_bytes() for p in src.iterdir()}
+
+    files = list_files([str(src)])
+    assert [os.path.basename(f) for f in files] == ["a.tif", "b.TIF", "c.tif"]
+    assert strip_files(files, str(tmp_path / "out"), jobs=2) == 1
+    assert "*** Failed" in capsys.readouterr().out
+
+    assert {p.name: p.read_bytes() for p in src.iterdir()} == originals
+    assert read_orientation(tmp_path / "out" / "a.tif") == 1
+    assert read_orientation(tmp_path / "out" / "b.TIF") == 1
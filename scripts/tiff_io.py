@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+
+import os
+import hashlib
+import numpy as np
+import tifffile
+
+
+def parse_memory_size(text) :
+
+    units = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+    text = text.strip().upper().rstrip("B")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def open_tiff(path, spill_dir=None) :
+
+    # 非圧縮TIFFはそのままメモリマップ、それ以外は一度デコードして .npy に退避
+    try:
+        return tifffile.memmap(path, mode="r")
+    except ValueError:
+        image = tifffile.imread(path)
+        if spill_dir is None:
+            return image
+        spill_path = os.path.join(spill_dir, os.path.basename(path) + ".npy")
+        spill = np.lib.format.open_memmap(spill_path, mode="w+", dtype=image.dtype, shape=image.shape)
+        spill[...] = image
+        spill.flush()
+        del spill, image
+        return np.load(spill_path, mmap_mode="r")
+
+
+def read_exif(path) :
+
+    # NEF も TIFF 構造なので、画素データは読まずにタグだけ参照する
+    try:
+        with tifffile.TiffFile(path) as tif:
+            tags = tif.pages[0].tags
+            exif = tags["ExifTag"].value if "ExifTag" in tags else {}
+            model = tags["Model"].value if "Model" in tags else None
+            date = tags["DateTime"].value if "DateTime" in tags else None
+    except (tifffile.TiffFileError, OSError):
+        return None
+
+    def rational(value):
+        if isinstance(value, tuple):
+            return value[0] / value[1] if value[1] else None
+        return value
+
+    exposure = rational(exif.get("ExposureTime"))
+    iso = exif.get("ISOSpeedRatings", exif.get("PhotographicSensitivity"))
+    if isinstance(iso, tuple):
+        iso = iso[0]
+    focal_length = rational(exif.get("FocalLength"))
+    aperture = rational(exif.get("FNumber"))
+    lens = exif.get("LensModel")
+    return {"model": model.strip("\x00 ") if model else None,
+            "iso": int(iso) if iso else None,
+            "exposure": float(exposure) if exposure else None,
+            "date": exif.get("DateTimeOriginal", date),
+            # フラットの照合用 (レンズ・焦点距離・絞り)
+            "lens": (lens.strip("\x00 ") or None) if lens else None,
+            "focal_length": float(focal_length) if focal_length else None,
+            "aperture": float(aperture) if aperture else None}
+
+
+def frame_hash(path, sample_size=1 << 20) :
+
+    # ファイル全体を読まずに済むよう、サイズと先頭・中央・末尾の内容から求める
+    size = os.path.getsize(path)
+    h = hashlib.sha256(str(size).encode())
+    with open(path, "rb") as f:
+        for offset in (0, max(size // 2 - sample_size // 2, 0), max(size - sample_size, 0)):
+            f.seek(offset)
+            h.update(f.read(sample_size))
+    return h.hexdigest()
+
+
+def create_tiff(path, shape, dtype=np.uint16) :
+
+    return tifffile.memmap(path, shape=shape, dtype=dtype)
+
+
+def row_blocks(height, block_rows) :
+
+    for y0 in range(0, height, block_rows):
+        yield slice(y0, min(y0 + block_rows, height))